@@ -1,49 +1,2169 @@
-import tkinter as tk
-from tkinter import ttk, messagebox
 from datetime import datetime, timedelta
-from tkcalendar import Calendar
-import requests
 import hashlib
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, Border, Side
-from openpyxl.utils import get_column_letter
-import urllib3
-from urllib3.exceptions import InsecureRequestWarning
 import os
+import sys
+import argparse
 import tempfile
+from urllib.parse import urlsplit
 import json
-from collections import defaultdict
+import re
+import codecs
+import gzip
+import zlib
+import sqlite3
+import time
+import random
+import queue
+import threading
+import traceback
+import reprlib
+import tracemalloc
+import logging
+from logging.handlers import RotatingFileHandler
+from array import array
+from collections import defaultdict, namedtuple, deque
+from itertools import chain, islice, repeat
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-# Отключаем предупреждения о сертификатах
-urllib3.disable_warnings(InsecureRequestWarning)
+# Тяжелые модули импортируются при первом использовании: пакетный режим не загружает tkinter,
+# а окно программы открывается, не дожидаясь requests, numpy и openpyxl
+tk = ttk = messagebox = Calendar = None
+requests = HTTPAdapter = None
+np = None
+Workbook = NamedStyle = WriteOnlyCell = Font = Alignment = Border = Side = get_column_letter = None
 
-class IikoOlapReporterGUI:
+
+def load_gui_modules():
+    """Импортирует tkinter и tkcalendar (нужны только окну программы)"""
+    global tk, ttk, messagebox, Calendar
+    if tk is None:
+        import tkinter
+        from tkinter import ttk as tk_ttk, messagebox as tk_messagebox
+        from tkcalendar import Calendar as tk_calendar
+        ttk, messagebox, Calendar = tk_ttk, tk_messagebox, tk_calendar
+        tk = tkinter
+
+
+def load_http_modules():
+    """Импортирует requests при создании первого пула соединений"""
+    global requests, HTTPAdapter
+    if requests is None:
+        import requests as requests_module
+        from requests.adapters import HTTPAdapter as http_adapter
+        import urllib3
+        from urllib3.exceptions import InsecureRequestWarning
+        # Отключаем предупреждения о сертификатах
+        urllib3.disable_warnings(InsecureRequestWarning)
+        HTTPAdapter = http_adapter
+        requests = requests_module
+
+
+def load_numpy():
+    """Импортирует numpy перед построением колонок "Планы" и сверткой выручки по категориям"""
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+def load_excel_modules():
+    """Импортирует openpyxl при создании первой Excel-книги"""
+    global Workbook, NamedStyle, WriteOnlyCell, Font, Alignment, Border, Side, get_column_letter
+    if Workbook is None:
+        from openpyxl.styles import Font as xl_font, Alignment as xl_alignment, Border as xl_border
+        from openpyxl.styles import Side as xl_side, NamedStyle as xl_named_style
+        from openpyxl.cell import WriteOnlyCell as xl_cell
+        from openpyxl.utils import get_column_letter as xl_column_letter
+        from openpyxl import Workbook as xl_workbook
+        NamedStyle, WriteOnlyCell, get_column_letter = xl_named_style, xl_cell, xl_column_letter
+        Font, Alignment, Border, Side = xl_font, xl_alignment, xl_border, xl_side
+        Workbook = xl_workbook
+
+# Максимальное число баз, опрашиваемых одновременно
+DEFAULT_MAX_WORKERS = 4
+
+# Таймауты HTTP-запросов (подключение, ожидание очередной порции данных), сек
+REQUEST_TIMEOUT = (15, 300)
+
+# Сколько секунд при закрытии окна ждать остановки отмененного задания перед выходом из баз
+JOB_STOP_TIMEOUT_SECONDS = 15
+
+# Размер порции при потоковом чтении ответа сервера
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Через сколько секунд без обращений токен считается устаревшим (сервер iiko отзывает ключ примерно через час)
+TOKEN_TTL_SECONDS = 45 * 60
+
+# Размер пула keep-alive соединений на один хост
+CONNECTION_POOL_SIZE = 32
+
+# Режимы разбивки периода на окна: подпись в интерфейсе -> режим
+CHUNK_MODES = {
+    "Авто": "auto",
+    "Без разбивки": None,
+    "По дням": "day",
+    "По неделям": "week",
+    "По месяцам": "month",
+}
+
+# Максимальное число окон одной базы, загружаемых одновременно
+DEFAULT_CHUNK_WORKERS = 3
+
+# Показатели OLAP-пресетов, которые суммируются при объединении окон
+OLAP_MEASURE_FIELDS = ('DishDiscountSumInt', 'GuestNum', 'DishAmountInt', 'UniqOrderId')
+
+# Отчеты OLAP v2 (режим свертки на сервере): тип отчета и фильтры, добавляемые к фильтру по дате
+OLAP_V2_REPORT_TYPE = "SALES"
+OLAP_V2_FILTERS = {
+    'DeletedWithWriteoff': {'filterType': 'IncludeValues', 'values': ['NOT_DELETED']},
+    'OrderDeleted': {'filterType': 'IncludeValues', 'values': ['NOT_DELETED']},
+}
+
+# Размер пакета строк при векторной свертке отчета "Выручка динамика"
+REVENUE_BATCH_SIZE = 50000
+
+# Каталог служебных данных приложения (кэш ответов и т.п.)
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".iiko_reporter")
+
+# Сколько секунд считаются актуальными данные незакрытого (текущего) дня
+CACHE_TODAY_TTL_SECONDS = 10 * 60
+
+# Предельный размер дискового кэша OLAP-ответов
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Сколько секунд справочники актов списания (склады, счета, концепции, товары) берутся из кэша
+DIRECTORY_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Справочников базы, загружаемых одновременно
+DIRECTORY_WORKERS = 4
+
+# Товаров в одном запросе /v2/entities/products/list?ids=... (ограничено длиной адреса запроса)
+PRODUCT_BATCH_SIZE = 100
+
+# Параметров в одном SQL-запросе поиска по id (предел переменных SQLite)
+SQL_BATCH_SIZE = 500
+
+# Версия схемы локального хранилища (PRAGMA user_version)
+WAREHOUSE_SCHEMA_VERSION = 1
+
+# Сколько дней до последнего загруженного перезагружается в инкрементальном режиме (поздние правки)
+DEFAULT_RECHECK_DAYS = 2
+
+# Способы записи итогов по неделям и группам в отчете "Планы": подпись в интерфейсе -> режим.
+# "sum" - формулы SUM по ячейкам дней, "values" - готовые значения,
+# "subtotal" - формулы SUBTOTAL по непрерывным диапазонам (вложенные SUBTOTAL не суммируются повторно)
+TOTALS_MODES = {
+    "Формулы SUM": "sum",
+    "Значения": "values",
+    "Формулы SUBTOTAL": "subtotal",
+}
+
+# Названия месяцев по номеру
+MONTH_NAMES = {
+    1: "Январь",
+    2: "Февраль",
+    3: "Март",
+    4: "Апрель",
+    5: "Май",
+    6: "Июнь",
+    7: "Июль",
+    8: "Август",
+    9: "Сентябрь",
+    10: "Октябрь",
+    11: "Ноябрь",
+    12: "Декабрь"
+}
+
+# Количество групп (столбцов) отчета "Выручка динамика" для каждой базы; по умолчанию 4
+REVENUE_GROUPS_BY_BASE = {
+    "Курск Ленина ММ": 4,
+    "Анапа ММ": 1,
+    "Курчатов CХ и Пекарни": 2,
+    "Белгород СХ": 4,
+    "Казань 1, 2, 3 СХ Железногорск Брянск": 5,
+    "СХ Орел": 4,
+    "Старый Оскол СХ": 2,
+    "ИП Лозовская Пекарни": 4,
+    "ИП Касаткин": 13
+}
+
+# Периоды, доступные для выбора в окне и в пакетном режиме ("Другой..." - даты задаются вручную)
+PERIODS = (
+    "Сегодня",
+    "Вчера",
+    "Текущая неделя",
+    "Прошлая неделя",
+    "Текущий месяц",
+    "С начала месяца",
+    "Прошлый месяц",
+    "Текущий год",
+    "Прошлый год",
+    "Другой..."
+)
+
+# Файл конфигурации баз по умолчанию
+BASES_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bases_config.json")
+
+# Предзагрузка по расписанию: время запусков, периоды и отчеты по умолчанию
+PREFETCH_TIMES = ("03:00",)
+PREFETCH_PERIODS = ("Вчера", "С начала месяца")
+PREFETCH_REPORTS = ("plans", "revenue", "writeoff")
+
+# Случайное смещение старта запуска предзагрузки и старта каждой базы (секунды)
+PREFETCH_JITTER_SECONDS = 15 * 60
+PREFETCH_BASE_JITTER_SECONDS = 30
+
+# Сколько баз одного сервера iiko загружается одновременно при предзагрузке
+PREFETCH_PER_HOST = 1
+
+# Сколько последних снимков ответов хранится для каждой пары (отчет, база)
+SNAPSHOT_KEEP = 10
+
+# Версия формата снимков (первая строка файла - метаданные)
+SNAPSHOT_FORMAT_VERSION = 1
+
+# Журнал приложения: сообщения идут в кольцевой буфер окна лога и, по желанию, в файл
+logger = logging.getLogger("iiko_reporter")
+
+# Сколько последних сообщений лога хранится в памяти
+LOG_BUFFER_SIZE = 5000
+
+# Период пакетного вывода накопившихся сообщений в окно лога, мс
+LOG_FLUSH_INTERVAL_MS = 200
+
+# Сколько последних строк остается в окне лога
+LOG_UI_MAX_LINES = 3000
+
+# Файл лога (включается в интерфейсе) и ротация
+LOG_FILE = os.path.join(APP_DATA_DIR, "iiko_reporter.log")
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+# Уровни лога: подпись в интерфейсе -> уровень logging
+LOG_LEVELS = {
+    "Обычный": logging.INFO,
+    "Подробный (отладка)": logging.DEBUG,
+    "Только предупреждения и ошибки": logging.WARNING,
+}
+
+# Метрики этапов запусков: папка JSON-файлов и сколько последних файлов хранится
+METRICS_DIR = os.path.join(APP_DATA_DIR, "metrics")
+METRICS_KEEP = 100
+
+# Название строки сводки метрик для этапов, относящихся ко всей книге, а не к одной базе
+METRICS_WORKBOOK = "Книга Excel"
+
+# Кассеты HTTP: версия формата и ключ, который записывается вместо настоящего токена
+CASSETTE_FORMAT_VERSION = 1
+CASSETTE_TOKEN = "cassette-token"
+
+# Параметры запросов, которые не попадают в кассету и не участвуют в сопоставлении при воспроизведении
+CASSETTE_SECRET_PARAMS = ('key', 'login', 'pass')
+
+# Скорость воспроизведения кассеты: с исходными задержками сервера или без задержек
+REPLAY_TIMINGS = ("original", "max")
+
+# Результат загрузки одной базы: успех, данные или текст ошибки, время выполнения
+BaseResult = namedtuple("BaseResult", ["base_name", "ok", "data", "error", "elapsed"])
+
+
+class ReportFetchError(Exception):
+    """Ошибка получения данных из базы"""
+
+
+class TokenRejectedError(ReportFetchError):
+    """Сервер отклонил ключ авторизации (истек или отозван)"""
+
+
+class JobCancelled(BaseException):
+    """Задание отменено пользователем.
+
+    Наследуется от BaseException, чтобы не перехватываться обработчиками `except Exception`
+    внутри циклов загрузки и экспорта.
+    """
+
+
+def period_dates(period, today=None):
+    """Возвращает (начало, конец) периода из PERIODS или None для "Другой..." и неизвестных значений"""
+    today = today or datetime.now()
+    if period == "Сегодня":
+        start_date = today
+        end_date = today
+    elif period == "Вчера":
+        start_date = today - timedelta(days=1)
+        end_date = today - timedelta(days=1)
+    elif period == "Текущая неделя":
+        start_date = today - timedelta(days=today.weekday())
+        end_date = start_date + timedelta(days=6)
+    elif period == "Прошлая неделя":
+        start_date = today - timedelta(days=today.weekday() + 7)
+        end_date = start_date + timedelta(days=6)
+    elif period == "Текущий месяц":
+        start_date = today.replace(day=1)
+        end_date = (today.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    elif period == "С начала месяца":
+        start_date = today.replace(day=1)
+        end_date = today
+    elif period == "Прошлый месяц":
+        start_date = (today.replace(day=1) - timedelta(days=1)).replace(day=1)
+        end_date = today.replace(day=1) - timedelta(days=1)
+    elif period == "Текущий год":
+        start_date = today.replace(month=1, day=1)
+        end_date = today.replace(month=12, day=31)
+    elif period == "Прошлый год":
+        start_date = today.replace(year=today.year-1, month=1, day=1)
+        end_date = today.replace(year=today.year-1, month=12, day=31)
+    else:  # "Другой..."
+        return None
+    return start_date, end_date
+
+
+def resolve_chunk_mode(mode, date_from, date_to):
+    """Определяет размер окна для режима "auto" по длине периода"""
+    if mode != "auto":
+        return mode
+    days = (date_to - date_from).days + 1
+    if days <= 31:
+        return None
+    if days <= 92:
+        return "week"
+    return "month"
+
+
+def split_date_range(date_from, date_to, mode):
+    """Разбивает период [date_from, date_to] (включительно) на окна по дням, неделям или месяцам"""
+    if not mode:
+        return [(date_from, date_to)]
+    windows = []
+    current = date_from
+    while current <= date_to:
+        if mode == "day":
+            window_end = current
+        elif mode == "week":
+            window_end = current + timedelta(days=6 - current.weekday())  # До воскресенья
+        elif mode == "month":
+            window_end = (current.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        else:
+            raise ValueError(f"Неизвестный режим разбивки периода: {mode}")
+        window_end = min(window_end, date_to)
+        windows.append((current, window_end))
+        current = window_end + timedelta(days=1)
+    return windows
+
+
+def _is_whole_window(window, mode):
+    """Окно разбивки совпадает с целой календарной неделей (пн-вс) или целым месяцем"""
+    start, end = window
+    if mode == "week":
+        return start.weekday() == 0 and end.weekday() == 6
+    return start.day == 1 and (end + timedelta(days=1)).day == 1
+
+
+def cache_windows(date_from, date_to, refresh_from=None):
+    """Окна режима "Авто" при загрузке с кэшем.
+
+    Период до месяца разбивается по дням: дневные окна кэша переиспользуются скользящими периодами
+    вроде "С начала месяца". В более длинном периоде целые календарные недели (до 92 дней) или
+    месяцы (дольше) загружаются одним окном, как без кэша (resolve_chunk_mode), а неполные недели
+    и месяцы на краях периода - по дням. Дни начиная с refresh_from (перепроверка инкрементального
+    режима) всегда идут отдельными окнами.
+    """
+    mode = resolve_chunk_mode("auto", date_from, date_to)
+    stable_to = date_to if refresh_from is None else min(date_to, refresh_from - timedelta(days=1))
+    windows = []
+    tail_from = date_from
+    if mode and stable_to >= date_from:
+        for window in split_date_range(date_from, stable_to, mode):
+            windows.extend([window] if _is_whole_window(window, mode) else split_date_range(*window, "day"))
+        tail_from = stable_to + timedelta(days=1)
+    windows.extend(split_date_range(tail_from, date_to, "day"))
+    return windows
+
+
+def olap_v2_request(group_fields, aggregate_fields, date_from, date_to, report_type=OLAP_V2_REPORT_TYPE,
+                    filters=None):
+    """Тело запроса POST /v2/reports/olap: строки группируются по group_fields, показатели
+    aggregate_fields суммируются на сервере за даты открытия смены [date_from, date_to]"""
+    request_filters = {
+        'OpenDate.Typed': {
+            'filterType': 'DateRange',
+            'periodType': 'CUSTOM',
+            'from': date_from.strftime('%Y-%m-%dT00:00:00.000'),
+            'to': (date_to + timedelta(days=1)).strftime('%Y-%m-%dT00:00:00.000'),
+            'includeLow': True,
+            'includeHigh': False
+        }
+    }
+    request_filters.update(OLAP_V2_FILTERS if filters is None else filters)
+    return {
+        'reportType': report_type,
+        'buildSummary': 'false',
+        'groupByRowFields': list(group_fields),
+        'groupByColFields': [],
+        'aggregateFields': list(aggregate_fields),
+        'filters': request_filters
+    }
+
+
+def _sum_measure(left, right):
+    """Складывает значения показателя, допуская пустые и строковые значения"""
+    if left is None or left == "":
+        return right
+    if right is None or right == "":
+        return left
+    if isinstance(left, (int, float)) and isinstance(right, (int, float)):
+        return left + right
+    try:
+        return float(left) + float(right)
+    except (ValueError, TypeError):
+        return left
+
+
+def merge_olap_rows(chunks, measure_fields=OLAP_MEASURE_FIELDS):
+    """Объединяет строки нескольких окон в одну таблицу.
+
+    Строки с одинаковыми значениями измерений (все поля, кроме показателей) суммируются,
+    как если бы сервер вернул весь период одним отчетом.
+    """
+    merged = {}
+    for rows in chunks:
+        for row in rows:
+            if not isinstance(row, dict):
+                continue
+            key = tuple(sorted((field, str(value)) for field, value in row.items() if field not in measure_fields))
+            existing = merged.get(key)
+            if existing is None:
+                merged[key] = dict(row)
+                continue
+            for field in measure_fields:
+                if field in row:
+                    existing[field] = _sum_measure(existing.get(field), row[field])
+    return list(merged.values())
+
+
+def open_json_stream(session, url, params=None, key=None, cancel_event=None, on_bytes=None, json_body=None):
+    """Выполняет GET-запрос (POST с телом json_body, если оно задано) и возвращает итератор
+    элементов JSON-массива ответа (см. JsonArrayStream).
+
+    Тело ответа читается порциями по мере перебора, поэтому в памяти не оказываются одновременно
+    сырой ответ, декодированная строка и полное дерево объектов.
+    Возвращает None, если сервер ответил не 200, и выбрасывает TokenRejectedError при 401/403.
+    """
+    if json_body is None:
+        response = session.get(url, params=params, stream=True, timeout=REQUEST_TIMEOUT)
+    else:
+        response = session.post(url, params=params, json=json_body, stream=True, timeout=REQUEST_TIMEOUT)
+    if response.status_code in (401, 403):
+        response.close()
+        raise TokenRejectedError(f"Ключ авторизации отклонен сервером ({response.status_code})")
+    if response.status_code != 200:
+        response.close()
+        return None
+
+    def chunks():
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if cancel_event is not None and cancel_event.is_set():
+                raise JobCancelled()
+            if on_bytes:
+                on_bytes(len(chunk))
+            yield chunk
+
+    def items():
+        try:
+            yield from JsonArrayStream(chunks(), key)
+        finally:
+            response.close()
+
+    return items()
+
+
+class JsonArrayStream:
+    """Потоковый разбор JSON: по одному выдает элементы массива, не держа в памяти весь ответ.
+
+    key=None - массив на верхнем уровне документа; иначе массив в поле key объекта верхнего уровня
+    (остальные поля объекта пропускаются). chunks - итератор байтовых порций ответа.
+    """
+
+    _decoder = json.JSONDecoder()
+    _whitespace = " \t\r\n"
+    # Остаток буфера из одних символов числа: число могло быть разрезано границей порции ("1." + "5")
+    _number_tail = re.compile(r'[0-9.eE+\-]*\Z')
+
+    def __init__(self, chunks, key=None):
+        self.chunks = iter(chunks)
+        self.key = key
+        self.text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Дочитывает следующую порцию; возвращает False в конце потока"""
+        if self.eof:
+            return False
+        # Отбрасываем уже разобранную часть буфера
+        if self.pos > 0 and self.pos * 2 >= len(self.buf):
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            text = self.text_decoder.decode(chunk)
+            if text:
+                self.buf += text
+                return True
+        self.buf += self.text_decoder.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def _peek(self):
+        """Пропускает пробелы и возвращает следующий символ ('' в конце потока)"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self._whitespace:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Ожидался символ '{char}' в позиции {self.pos}")
+        self.pos += 1
+
+    def _decode_value(self):
+        """Разбирает очередное JSON-значение, дочитывая поток, пока значение не будет полным"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+                # Число считается полным, только если за ним есть разделитель или поток закончился
+                incomplete = (
+                    not self.eof and isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and self._number_tail.match(self.buf, end) is not None
+                )
+                if not incomplete:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Дочитываем так, чтобы доступный объем удвоился: разбор остается линейным
+            need = (len(self.buf) - self.pos) * 2
+            while len(self.buf) - self.pos < need and self._fill():
+                pass
+
+    def _seek_array(self):
+        """Переходит к началу нужного массива; возвращает False, если поля key нет"""
+        if self.key is None:
+            self._expect("[")
+            return True
+        self._expect("{")
+        while True:
+            char = self._peek()
+            if char == "}" or char == "":
+                return False
+            if char == ",":
+                self.pos += 1
+                continue
+            field = self._decode_value()
+            self._expect(":")
+            if field == self.key and self._peek() == "[":
+                self.pos += 1
+                return True
+            self._decode_value()
+
+    def __iter__(self):
+        if not self._seek_array():
+            return
+        while True:
+            char = self._peek()
+            if char == "]":
+                self.pos += 1
+                return
+            if char == "":
+                raise ValueError("Неожиданный конец JSON-массива")
+            if char == ",":
+                self.pos += 1
+                continue
+            yield self._decode_value()
+
+
+class OlapColumns:
+    """Колоночное хранилище нормализованных строк OLAP-отчета, строится один раз после загрузки.
+
+    Строковые измерения (группа, категория, название дня) хранятся кодами np.int32 со справочником
+    значений, упорядоченным по алфавиту, номера недели и дня - np.int16, показатели - np.float64
+    (пустое значение - NaN). Сортировка и группировка для экспорта выполняются над массивами.
+    """
+
+    def __init__(self, group_codes, group_values, category_codes, category_values,
+                 week, day_num, day_name_codes, day_name_values, measures):
+        self.group_codes = group_codes
+        self.group_values = group_values
+        self.category_codes = category_codes
+        self.category_values = category_values
+        self.week = week
+        self.day_num = day_num
+        self.day_name_codes = day_name_codes
+        self.day_name_values = day_name_values
+        self.measures = measures  # {поле показателя: np.float64}
+
+    def __len__(self):
+        return len(self.week)
+
+    @staticmethod
+    def _encode(encoder, codes, value):
+        """Добавляет код строкового значения, пополняя справочник"""
+        code = encoder.get(value)
+        if code is None:
+            code = encoder[value] = len(encoder)
+        codes.append(code)
+
+    @staticmethod
+    def _finalize(encoder, codes):
+        """Перенумеровывает коды так, чтобы их порядок совпадал с алфавитным порядком значений"""
+        values = sorted(encoder)
+        remap = np.empty(len(values), dtype=np.int32)
+        for new_code, value in enumerate(values):
+            remap[encoder[value]] = new_code
+        raw = np.frombuffer(codes, dtype=np.int32) if len(codes) else np.empty(0, dtype=np.int32)
+        return remap[raw] if len(values) else raw, values
+
+    @staticmethod
+    def _to_float(value):
+        if value is None or value == "":
+            return np.nan
+        try:
+            return float(value)
+        except (ValueError, TypeError):
+            return np.nan
+
+    @classmethod
+    def from_records(cls, records):
+        """Строит колонки из итерируемого набора строк-словарей"""
+        load_numpy()
+        encoders = {'group': {}, 'category': {}, 'day_name': {}}
+        codes = {name: array('i') for name in encoders}
+        week = array('h')
+        day_num = array('h')
+        measures = {field: array('d') for field in OLAP_MEASURE_FIELDS}
+        for record in records:
+            if not isinstance(record, dict):
+                continue
+            cls._encode(encoders['group'], codes['group'], str(record.get('RestorauntGroup') or ''))
+            cls._encode(encoders['category'], codes['category'], str(record.get('DishCategory') or '').strip())
+            week.append(int(record.get('WeekInMonthOpen', 1) or 1))
+            # День недели в формате "1. Понедельник"
+            day_parts = str(record.get('DayOfWeekOpen', '1. Понедельник') or '').split('. ')
+            day_num.append(int(day_parts[0]) if day_parts and day_parts[0] else 1)
+            cls._encode(encoders['day_name'], codes['day_name'], day_parts[1] if len(day_parts) > 1 else "Понедельник")
+            for field, column in measures.items():
+                # Отсутствующий показатель считается нулем, пустой (null) остается пустым
+                column.append(cls._to_float(record[field]) if field in record else 0.0)
+        group_codes, group_values = cls._finalize(encoders['group'], codes['group'])
+        category_codes, category_values = cls._finalize(encoders['category'], codes['category'])
+        day_name_codes, day_name_values = cls._finalize(encoders['day_name'], codes['day_name'])
+        return cls(
+            group_codes, group_values, category_codes, category_values,
+            np.array(week, dtype=np.int16), np.array(day_num, dtype=np.int16),
+            day_name_codes, day_name_values,
+            {field: np.array(column, dtype=np.float64) for field, column in measures.items()}
+        )
+
+    def plan_sort_order(self):
+        """Порядок строк отчета "Планы": группа, неделя, день недели"""
+        return np.lexsort((self.day_num, self.week, self.group_codes))
+
+    def iter_plan_groups(self):
+        """Перебирает группы в порядке сортировки.
+
+        Выдает (название группы, [(номер недели, индексы строк недели), ...]).
+        """
+        order = self.plan_sort_order()
+        if not len(order):
+            return
+        group_breaks = np.flatnonzero(np.diff(self.group_codes[order])) + 1
+        for group_rows in np.split(order, group_breaks):
+            week_breaks = np.flatnonzero(np.diff(self.week[group_rows])) + 1
+            weeks = [(int(self.week[rows[0]]), rows) for rows in np.split(group_rows, week_breaks)]
+            yield self.group_values[self.group_codes[group_rows[0]]], weeks
+
+    def day_label(self, index):
+        """Подпись дня недели строки в формате «1. Понедельник»"""
+        return f"{self.day_num[index]}. {self.day_name_values[self.day_name_codes[index]]}"
+
+    def measure(self, field, index):
+        """Значение показателя строки для записи в Excel (NaN -> пустая ячейка)"""
+        value = self.measures[field][index]
+        if np.isnan(value):
+            return None
+        return int(value) if value.is_integer() else float(value)
+
+
+class ParallelFetcher:
+    """Загружает данные из нескольких баз параллельно с ограничением числа потоков"""
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, cancel_event=None):
+        self.max_workers = max(1, int(max_workers))
+        self.cancel_event = cancel_event
+
+    def run(self, tasks, on_result=None, on_start=None):
+        """Выполняет задачи {имя базы: функция} и возвращает {имя базы: BaseResult}.
+
+        on_start вызывается в рабочем потоке перед началом загрузки базы,
+        on_result - в вызывающем потоке по мере завершения каждой базы.
+        При отмене ожидающие базы не запускаются, а уже полученные результаты сохраняются.
+        """
+        results = {}
+        if not tasks:
+            return results
+        workers = min(self.max_workers, len(tasks))
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="iiko-fetch")
+        cancelled = False
+        try:
+            futures = {
+                executor.submit(self._run_task, base_name, func, on_start): base_name
+                for base_name, func in tasks.items()
+            }
+            pending = set(futures)
+            timeout = 0.2 if self.cancel_event is not None else None
+            while pending:
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results[result.base_name] = result
+                    if on_result:
+                        on_result(result)
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    cancelled = True
+                    for future in pending:
+                        future.cancel()
+                        base_name = futures[future]
+                        results[base_name] = BaseResult(base_name, False, None, "Отменено", 0.0)
+                    break
+        finally:
+            # При отмене не ждем прерывания запросов, которые еще выполняются
+            executor.shutdown(wait=not cancelled, cancel_futures=True)
+        return results
+
+    def _run_task(self, base_name, func, on_start=None):
+        """Выполняет задачу одной базы, перехватывая любые ошибки"""
+        started = time.perf_counter()
+        try:
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                raise JobCancelled()
+            if on_start:
+                on_start(base_name)
+            data = func()
+            return BaseResult(base_name, True, data, None, time.perf_counter() - started)
+        except JobCancelled:
+            return BaseResult(base_name, False, None, "Отменено", time.perf_counter() - started)
+        except Exception as e:
+            return BaseResult(base_name, False, None, str(e), time.perf_counter() - started)
+
+
+class HostLimiter:
+    """Ограничивает число одновременных загрузок с одного сервера iiko (хоста из адреса базы)"""
+
+    def __init__(self, per_host=PREFETCH_PER_HOST):
+        self.per_host = max(1, int(per_host))
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, base_url):
+        host = urlsplit(base_url).netloc
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host)
+                self._semaphores[host] = semaphore
+            return semaphore
+
+    def run(self, base_url, func, cancel_event=None):
+        """Выполняет func(), когда у сервера базы есть свободное место; ожидание прерывается отменой"""
+        semaphore = self._semaphore(base_url)
+        while not semaphore.acquire(timeout=0.2):
+            if cancel_event is not None and cancel_event.is_set():
+                raise JobCancelled()
+        try:
+            return func()
+        finally:
+            semaphore.release()
+
+
+class LogRingBuffer(logging.Handler):
+    """Обработчик logging: последние сообщения в кольцевом буфере фиксированного размера.
+
+    Окно лога забирает новые сообщения пакетом по таймеру (read_since), поэтому фоновые
+    потоки не обращаются к Tk, а частые сообщения не замедляют интерфейс.
+    """
+
+    def __init__(self, capacity=LOG_BUFFER_SIZE):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+        self.sequence = 0
+
+    def emit(self, record):
+        # Вызывается под блокировкой обработчика
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.sequence += 1
+        self.records.append((self.sequence, line))
+
+    def read_since(self, sequence):
+        """Возвращает (номер последнего сообщения, число вытесненных из буфера, новые строки)"""
+        self.acquire()
+        try:
+            lines = []
+            for number, line in reversed(self.records):
+                if number <= sequence:
+                    break
+                lines.append(line)
+            lines.reverse()
+            dropped = self.sequence - sequence - len(lines)
+            return self.sequence, dropped, lines
+        finally:
+            self.release()
+
+
+def message_level(message):
+    """Уровень сообщения по его значку: ❌ - ошибка, ⚠ - предупреждение, иначе - информация"""
+    if message.startswith("❌"):
+        return logging.ERROR
+    if message.startswith("⚠"):
+        return logging.WARNING
+    return logging.INFO
+
+
+class MetricsStage:
+    """Замер одного этапа одной базы (используется как контекстный менеджер RunMetrics.stage).
+
+    rows задает код этапа; bytes - байты ответов базы, полученные за время этапа,
+    server_seconds - суммарное ожидание ответа сервера (до заголовков) по запросам этапа,
+    peak_memory - пик памяти Python сверх уровня на старте этапа (только при замере памяти).
+    """
+
+    def __init__(self, metrics, base_name, name, client=None):
+        self.metrics = metrics
+        self.base_name = base_name
+        self.name = name
+        self.client = client
+        self.seconds = 0.0
+        self.bytes = 0
+        self.rows = None
+        self.server_seconds = None
+        self.peak_memory = None
+        self.ok = True
+
+    def __enter__(self):
+        self._bytes_start = self.metrics.base_bytes(self.base_name)
+        self._server_start = self.client.request_seconds if self.client is not None else None
+        self._memory_start = self.metrics._memory_enter()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._started
+        self.ok = exc_type is None
+        self.bytes = self.metrics.base_bytes(self.base_name) - self._bytes_start
+        if self._server_start is not None:
+            self.server_seconds = self.client.request_seconds - self._server_start
+        self.peak_memory = self.metrics._memory_exit(self._memory_start)
+        self.metrics._add(self)
+        return False
+
+    def as_dict(self):
+        return {
+            'base': self.base_name,
+            'stage': self.name,
+            'seconds': round(self.seconds, 4),
+            'bytes': self.bytes,
+            'rows': self.rows,
+            'server_seconds': None if self.server_seconds is None else round(self.server_seconds, 4),
+            'peak_memory': self.peak_memory,
+            'ok': self.ok,
+        }
+
+
+class RunMetrics:
+    """Метрики этапов одного запуска (загрузка или экспорт): время, байты, строки и память по базам.
+
+    Замер памяти через tracemalloc замедляет выделение памяти, поэтому включается отдельно.
+    Пик памяти общий для процесса: при параллельной загрузке в него входят соседние базы.
+    """
+
+    def __init__(self, run_name, trace_memory=False):
+        self.run_name = run_name
+        self.started_at = datetime.now()
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.total_seconds = None
+        self._bytes = defaultdict(int)
+        self._active = 0
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._own_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self._own_tracing:
+            tracemalloc.start()
+
+    def stage(self, base_name, name, client=None):
+        """Контекстный менеджер замера этапа; client - IikoClient для учета ожидания сервера"""
+        return MetricsStage(self, base_name, name, client)
+
+    def add_bytes(self, base_name, count):
+        with self._lock:
+            self._bytes[base_name] += count
+
+    def base_bytes(self, base_name):
+        with self._lock:
+            return self._bytes[base_name]
+
+    def _add(self, stage):
+        with self._lock:
+            self.stages.append(stage)
+
+    def _memory_enter(self):
+        if not self.trace_memory or not tracemalloc.is_tracing():
+            return None
+        with self._lock:
+            # Пик сбрасывается только когда других замеров нет, чтобы не потерять их максимум
+            if self._active == 0:
+                tracemalloc.reset_peak()
+            self._active += 1
+            return tracemalloc.get_traced_memory()[0]
+
+    def _memory_exit(self, memory_start):
+        if memory_start is None:
+            return None
+        with self._lock:
+            self._active -= 1
+            return max(0, tracemalloc.get_traced_memory()[1] - memory_start)
+
+    def finish(self):
+        """Завершает запуск: фиксирует общее время и останавливает tracemalloc, если он был запущен здесь"""
+        self.total_seconds = time.perf_counter() - self._started
+        if self._own_tracing:
+            tracemalloc.stop()
+            self._own_tracing = False
+
+    def summary_lines(self):
+        """Таблица этапов для лога: строка на этап каждой базы в порядке завершения"""
+        header = f"{'База':<28} {'Этап':<12} {'Время, с':>9} {'Сервер, с':>9} {'КБ':>10} {'Строк':>9} {'Память, МБ':>10}"
+        lines = [f"Метрики '{self.run_name}' ({self.total_seconds or 0:.1f} с):", header]
+        with self._lock:
+            stages = list(self.stages)
+        for stage in stages:
+            server = "" if stage.server_seconds is None else f"{stage.server_seconds:.2f}"
+            rows = "" if stage.rows is None else str(stage.rows)
+            memory = "" if stage.peak_memory is None else f"{stage.peak_memory / 1024 / 1024:.1f}"
+            mark = "" if stage.ok else " ❌"
+            lines.append(
+                f"{stage.base_name[:28]:<28} {stage.name:<12} {stage.seconds:>9.2f} {server:>9} "
+                f"{stage.bytes / 1024:>10.1f} {rows:>9} {memory:>10}{mark}"
+            )
+        return lines
+
+    def as_dict(self):
+        with self._lock:
+            stages = [stage.as_dict() for stage in self.stages]
+        return {
+            'run': self.run_name,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'total_seconds': None if self.total_seconds is None else round(self.total_seconds, 4),
+            'trace_memory': self.trace_memory,
+            'stages': stages,
+        }
+
+    def save(self, path=None, keep=METRICS_KEEP):
+        """Записывает метрики в JSON (по умолчанию - новый файл в METRICS_DIR) и возвращает путь"""
+        if path is None:
+            safe_name = re.sub(r'[^\w.-]+', '_', self.run_name).strip('_') or "run"
+            path = os.path.join(METRICS_DIR, f"{self.started_at.strftime('%Y-%m-%d_%H-%M-%S')}_{safe_name}.json")
+            self._prune(keep - 1)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.as_dict(), f, ensure_ascii=False, indent=1)
+        return path
+
+    @staticmethod
+    def _prune(keep):
+        """Удаляет старые файлы метрик, оставляя keep последних"""
+        try:
+            names = sorted(name for name in os.listdir(METRICS_DIR) if name.endswith(".json"))
+        except FileNotFoundError:
+            return
+        for name in names[:max(0, len(names) - keep)]:
+            try:
+                os.remove(os.path.join(METRICS_DIR, name))
+            except OSError:
+                pass
+
+
+class BackgroundJobRunner:
+    """Выполняет задания вне главного потока Tk и передает события в UI через потокобезопасную очередь"""
+
+    def __init__(self, root, on_event, poll_interval_ms=100):
+        self.root = root
+        self.on_event = on_event
+        self.poll_interval_ms = poll_interval_ms
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.job_name = None
+        self._thread = None
+        self.root.after(self.poll_interval_ms, self._poll)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, job_name, target, on_done=None, total=0):
+        """Запускает target() в фоновом потоке.
+
+        on_done(status, result) вызывается в потоке UI; status - "done", "cancelled" или "error".
+        Возвращает False, если другое задание еще выполняется.
+        """
+        if self.is_running():
+            return False
+        self.cancel_event.clear()
+        self.job_name = job_name
+        self.emit("job_started", job=job_name, total=total)
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(job_name, target, on_done),
+            name=f"job-{job_name}",
+            daemon=True
+        )
+        self._thread.start()
+        return True
+
+    def cancel(self):
+        """Запрашивает отмену текущего задания"""
+        if self.is_running():
+            self.cancel_event.set()
+
+    def wait(self, timeout=None):
+        """Ждет завершения текущего задания; возвращает False, если оно не завершилось за timeout секунд"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return not self.is_running()
+
+    def check_cancelled(self):
+        """Прерывает задание, если пользователь нажал кнопку отмены"""
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def emit(self, kind, **data):
+        """Ставит событие в очередь UI (можно вызывать из любого потока)"""
+        self.events.put((kind, data))
+
+    def _run(self, job_name, target, on_done):
+        try:
+            result = target()
+            status = "cancelled" if self.cancel_event.is_set() else "done"
+        except JobCancelled:
+            result, status = None, "cancelled"
+        except Exception:
+            result, status = traceback.format_exc(), "error"
+        self.emit("job_finished", job=job_name, status=status, result=result, on_done=on_done)
+
+    def _poll(self):
+        """Передает накопившиеся события обработчику UI"""
+        try:
+            while True:
+                try:
+                    kind, data = self.events.get_nowait()
+                except queue.Empty:
+                    break
+                on_done = data.pop("on_done", None)
+                try:
+                    self.on_event(kind, data)
+                    if on_done:
+                        on_done(data["status"], data["result"])
+                except Exception:
+                    logger.exception(f"Ошибка обработки события задания {kind}")
+        finally:
+            self.root.after(self.poll_interval_ms, self._poll)
+
+
+class BatchJobContext:
+    """Задание пакетного режима: тот же интерфейс, что у BackgroundJobRunner, но без окна.
+
+    Отчет строится в текущем потоке; события прогресса считаются для итогового сообщения.
+    """
+
+    def __init__(self):
+        self.cancel_event = threading.Event()
+        self.counters = defaultdict(int)
+
+    def check_cancelled(self):
+        """Прерывает задание после Ctrl+C"""
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def emit(self, kind, **data):
+        if kind in ("bytes", "rows"):
+            self.counters[kind] += data.get("count", 0)
+
+
+class ExcelReportWriter:
+    """Потоковая запись отчетов в Excel (режим write-only openpyxl).
+
+    Строки листа пишутся один раз и сразу в окончательном виде: оформление задается общими
+    именованными стилями книги, поэтому память не растет с размером отчета.
+    """
+
+    # Через сколько строк вызывается on_progress
+    PROGRESS_EVERY = 500
+
+    # Показатели строк дней листа "Планы" и их столбцы
+    PLAN_MEASURES = (
+        ('D', 'DishDiscountSumInt'),
+        ('E', 'GuestNum'),
+        ('F', 'DishAmountInt'),
+        ('G', 'UniqOrderId'),
+    )
+
+    def __init__(self, totals_mode="sum"):
+        load_excel_modules()
+        self.totals_mode = totals_mode
+        self.wb = Workbook(write_only=True)
+        for name, params in self.named_styles().items():
+            self.wb.add_named_style(NamedStyle(name=name, **params))
+
+    @staticmethod
+    def named_styles():
+        """Именованные стили книги: имя -> параметры NamedStyle"""
+        # Тонкая рамка ячеек таблиц отчетов
+        thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+        return {
+            'iiko_title': dict(font=Font(bold=True, size=14)),
+            'iiko_title_center': dict(font=Font(bold=True, size=14), alignment=Alignment(horizontal='center')),
+            'iiko_bold': dict(font=Font(bold=True)),
+            'iiko_cell': dict(border=thin_border),
+            'iiko_cell_bold': dict(font=Font(bold=True), border=thin_border),
+            'iiko_cell_number': dict(border=thin_border, number_format='#,##0.00'),
+            'iiko_cell_header': dict(font=Font(bold=True), alignment=Alignment(horizontal='center'), border=thin_border),
+        }
+
+    @property
+    def sheet_count(self):
+        return len(self.wb.sheetnames)
+
+    def save(self, filename):
+        self.wb.save(filename)
+
+    def order_sheets(self, titles):
+        """Переставляет листы в порядке titles (имена баз); остальные листы остаются в конце.
+
+        Нужна конвейерной сборке: листы создаются в порядке завершения загрузки баз.
+        """
+        index = 0
+        for title in titles:
+            title = title[:31]
+            if title not in self.wb.sheetnames:
+                continue
+            # Лист передается по имени: move_sheet не принимает объекты листов write-only
+            self.wb.move_sheet(title, index - self.wb.sheetnames.index(title))
+            index += 1
+
+    def _create_sheet(self, title, widths):
+        """Создает лист и задает ширину столбцов (до записи первой строки)"""
+        ws = self.wb.create_sheet(title=title[:31])
+        for letter, width in widths.items():
+            ws.column_dimensions[letter].width = width
+        return ws
+
+    def _cell(self, ws, value, style):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style
+        return cell
+
+    def _title_rows(self, ws, title, last_column, style='iiko_title'):
+        """Объединенный заголовок листа в первой строке"""
+        ws.append([self._cell(ws, title, style)])
+        ws.merged_cells.add(f'A1:{last_column}1')
+
+    def add_plans_sheet(self, base_name, data, start_date, end_date, on_row=None, on_progress=None):
+        """Лист отчета "Планы": группы, недели и дни с итогами по неделям и группам.
+
+        data - OlapColumns базы. on_row(group, week, day_label) вызывается для каждой строки дня,
+        on_progress(count) - каждые PROGRESS_EVERY строк и в конце листа. Возвращает число строк дней.
+        """
+        ws = self._create_sheet(base_name, {get_column_letter(col): 15 for col in range(1, 8)})
+        self._title_rows(ws, "Планы", 'G')
+        ws.append([f"Название ресторана: {base_name}"])
+        ws.append([f"Период: с {start_date.strftime('%d.%m.%Y')} по {end_date.strftime('%d.%m.%Y')}"])
+        ws.append([])
+        headers = ["Группа", "Неделя", "День недели", "Итого", "Гости", "Блюда", "Чеки"]
+        ws.append([self._cell(ws, header, 'iiko_bold') for header in headers])
+
+        # Сортировка по группе, неделе и дню и разбиение на группы и недели выполняются над колонками OlapColumns
+        row_num = 6
+        processed = 0
+        for group, weeks in data.iter_plan_groups():
+            group_start_row = row_num
+            # В итог группы входят строка с названием группы (показатели пусты) и строки дней
+            day_rows = [row_num]
+            group_sums = [0] * len(self.PLAN_MEASURES)
+            ws.append([group])
+            row_num += 1
+            for week_num, rows in weeks:
+                week_start_row = row_num
+                week_sums = [0] * len(self.PLAN_MEASURES)
+                for index in rows:
+                    day_label = data.day_label(index)
+                    if on_row:
+                        on_row(group, week_num, day_label)
+                    values = [data.measure(field, index) for _, field in self.PLAN_MEASURES]
+                    ws.append(["", week_num, day_label] + values)
+                    for i, value in enumerate(values):
+                        # Пустые показатели, как и в SUM, не учитываются
+                        if value is not None:
+                            week_sums[i] += value
+                    day_rows.append(row_num)
+                    row_num += 1
+                    processed += 1
+                    if on_progress and processed % self.PROGRESS_EVERY == 0:
+                        on_progress(self.PROGRESS_EVERY)
+                # Итог по неделе
+                ws.append(self._week_total_row(ws, week_start_row, row_num - 1, week_num, week_sums))
+                group_sums = [total + value for total, value in zip(group_sums, week_sums)]
+                row_num += 1
+            # Итог по всей группе
+            ws.append(self._group_total_row(ws, group_start_row, row_num - 1, day_rows, group, group_sums))
+            row_num += 1
+        if on_progress:
+            on_progress(processed % self.PROGRESS_EVERY)
+        return processed
+
+    def _week_total_row(self, ws, start_row, end_row, week_num, sums):
+        """Строка итогов по неделе (без дня недели)"""
+        if self.totals_mode == "values":
+            totals = sums
+        elif self.totals_mode == "subtotal":
+            totals = [f"=SUBTOTAL(9,{letter}{start_row}:{letter}{end_row})" for letter, _ in self.PLAN_MEASURES]
+        else:
+            totals = [f"=SUM({letter}{start_row}:{letter}{end_row})" for letter, _ in self.PLAN_MEASURES]
+        return ["", self._cell(ws, f"{week_num} всего", 'iiko_bold'), ""] + [
+            self._cell(ws, total, 'iiko_bold') for total in totals
+        ]
+
+    def _group_total_row(self, ws, start_row, end_row, day_rows, group_name, sums):
+        """Строка итогов по всей группе.
+
+        Итоги недель не учитываются повторно: формула SUM перечисляет только строки дней,
+        SUBTOTAL по всему блоку группы сам пропускает вложенные SUBTOTAL недель.
+        """
+        if self.totals_mode == "values":
+            totals = sums
+        elif self.totals_mode == "subtotal":
+            totals = [f"=SUBTOTAL(9,{letter}{start_row}:{letter}{end_row})" for letter, _ in self.PLAN_MEASURES]
+        else:
+            totals = [
+                "=SUM({})".format(",".join(f"{letter}{row}" for row in day_rows))
+                for letter, _ in self.PLAN_MEASURES
+            ]
+        return [self._cell(ws, f"{group_name} всего", 'iiko_bold'), "", ""] + [
+            self._cell(ws, total, 'iiko_bold') for total in totals
+        ]
+
+    def add_revenue_sheet(self, base_name, data, start_date, end_date, groups_count=4):
+        """Лист отчета "Выручка динамика": категории блюд по строкам, группы по столбцам.
+
+        Берется не больше groups_count групп; возвращает список выведенных групп.
+        """
+        groups = data['groups'][:groups_count]
+        # A и B заняты подписью строки, после групп идет колонка "Итого"
+        columns = ['C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P'][:len(groups)]
+        columns.append(chr(ord('C') + len(groups)) if len(groups) < 13 else 'P')
+        ws = self._create_sheet(base_name, {letter: 15 for letter in ['A', 'B'] + columns})
+        bold_values = {"Итого", "Группа", "Категория блюда", *groups}
+        row_num = 4
+
+        def table_row(label, values):
+            # Подпись строки занимает объединенные A:B; у всех ячеек таблицы есть рамка
+            nonlocal row_num
+            cells = []
+            for value in [label, None] + values:
+                if isinstance(value, str) and value in bold_values:
+                    style = 'iiko_cell_bold'
+                elif isinstance(value, (int, float)):
+                    style = 'iiko_cell_number'
+                else:
+                    style = 'iiko_cell'
+                cells.append(self._cell(ws, value, style))
+            ws.append(cells)
+            row_num += 1
+            ws.merged_cells.add(f'A{row_num}:B{row_num}')
+
+        self._title_rows(ws, f"Выручка для динамики - {base_name}", 'G', 'iiko_title_center')
+        ws.append([f"Название ресторана: {base_name}"])
+        ws.append([f"Период: с {start_date.strftime('%d.%m.%Y')} по {end_date.strftime('%d.%m.%Y')}"])
+        ws.append([])
+
+        table_row("Группа", groups + ["Итого"])
+        # Месяц начала периода во всех колонках
+        current_month = f"{start_date.month:02d} ({MONTH_NAMES.get(start_date.month, '')})"
+        table_row("Категория блюда", [current_month] * len(columns))
+        # Пустая строка с нулями
+        table_row(None, [0.00] * len(columns))
+
+        for category in data['categories']:
+            values = [data['data'][group].get(category, 0.0) for group in groups]
+            table_row(category, values + [sum(values, 0.0)])
+
+        group_totals = [sum(data['data'][group].values()) for group in groups]
+        grand_total = sum(sum(group.values()) for group in data['data'].values())
+        table_row("Итого", group_totals + [grand_total])
+        return groups
+
+    def add_writeoff_sheet(self, base_name, docs, reporter, on_progress=None):
+        """Лист актов списания; reporter (WriteoffReporter) дает названия складов, счетов, товаров"""
+        ws = self._create_sheet(base_name, {get_column_letter(col): 20 for col in range(1, 11)})
+        self._title_rows(ws, f"Акты списания: {base_name}", 'J', 'iiko_title_center')
+        ws.append([])
+        headers = [
+            "Дата документа", "Тип", "№", "Товары",
+            "Сумма, р.", "Проведен", "Склад",
+            "Концепция", "Комментарий", "Счет списания"
+        ]
+        ws.append([self._cell(ws, header, 'iiko_cell_header') for header in headers])
+
+        processed = 0
+        for doc in docs:
+            if not isinstance(doc, dict):
+                continue
+            try:
+                # Обработка даты
+                date_str = datetime.strptime(doc['dateIncoming'], '%Y-%m-%dT%H:%M:%S.%f').strftime('%d.%m.%Y %H:%M')
+            except ValueError:
+                try:
+                    date_str = datetime.strptime(doc['dateIncoming'], '%Y-%m-%dT%H:%M').strftime('%d.%m.%Y %H:%M')
+                except ValueError:
+                    date_str = doc['dateIncoming']
+
+            # Товары и сумма
+            items_text = []
+            total_sum = 0
+            for item in doc.get('items', []):
+                product_name = reporter.get_product_name(item.get('productId', ''))
+                amount = item.get('amount', 0)
+                cost = item.get('cost', 0) or 0
+                total_sum += cost
+                items_text.append(f"{product_name} x{amount}")
+
+            values = [
+                date_str, "P", doc.get('documentNumber', ''), "\n".join(items_text), round(total_sum, 2),
+                reporter.get_status_name(doc.get('status', '')),
+                reporter.get_store_name(doc.get('storeId')),
+                reporter.get_conception_name(doc.get('conceptionId')),
+                doc.get('comment', ''),
+                reporter.get_account_name(doc.get('accountId'))
+            ]
+            ws.append([self._cell(ws, value, 'iiko_cell') for value in values])
+            processed += 1
+            if on_progress and processed % self.PROGRESS_EVERY == 0:
+                on_progress(self.PROGRESS_EVERY)
+        if on_progress:
+            on_progress(processed % self.PROGRESS_EVERY)
+        return processed
+
+
+class IikoReportRunner:
+    """Загрузка отчетов и запись Excel-файлов без окна: общая часть GUI и пакетного режима.
+
+    jobs - BackgroundJobRunner окна или BatchJobContext командной строки
+    (cancel_event, check_cancelled() и emit() событий прогресса).
+    """
+
+    def __init__(self, jobs, config_path=None):
+        self.jobs = jobs
+        # Список доступных баз загружается из внешнего файла
+        self.available_bases = self.load_bases_config(config_path)
+        self.report_data = {}   # Данные для отчета "Планы"
+        self.revenue_data = {}  # Данные для отчета "Выручка динамика"
+        # Ограничения нагрузки на серверы (задаются планировщиком предзагрузки)
+        self.host_limiter = None   # HostLimiter: одновременные загрузки с одного сервера
+        self.start_jitter = 0      # Случайная задержка старта каждой базы, секунды
+        # Метрики этапов текущего запуска
+        self.trace_memory = False
+        self.metrics = RunMetrics("")
+
+    def load_bases_config(self, config_path=None):
+        """Загружает конфигурацию баз из JSON-файла"""
+        config_path = config_path or BASES_CONFIG_PATH
+        try:
+            with open(config_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            self.log_message(f"❌ Файл конфигурации не найден: {config_path}")
+            self.show_error("Ошибка", f"Файл конфигурации не найден: {config_path}")
+            return {}
+        except json.JSONDecodeError as e:
+            self.log_message(f"❌ Ошибка в формате JSON: {e}")
+            self.show_error("Ошибка", f"Ошибка в формате JSON: {e}")
+            return {}
+
+    def show_error(self, title, message):
+        """Показывает ошибку пользователю; без окна достаточно записи в лог, сделанной перед вызовом"""
+
+    def open_report(self, filename):
+        """Открывает сохраненный отчет; в пакетном режиме файл не открывается"""
+
+    def _report_filenames(self, title, start_date, end_date, output_path=None):
+        """Варианты пути Excel-файла: заданный путь или папки Документы, Рабочий стол и временная"""
+        if output_path:
+            return [output_path]
+        start_date_str = start_date.strftime('%d.%m.%Y')
+        end_date_str = end_date.strftime('%d.%m.%Y')
+        current_date = datetime.now().strftime('%Y-%m-%d_%H-%M')
+        # Пробуем несколько путей для сохранения
+        save_paths = [
+            os.path.join(os.path.expanduser("~"), "Documents"),
+            os.path.join(os.path.expanduser("~"), "Desktop"),
+            tempfile.gettempdir()
+        ]
+        return [
+            os.path.join(save_dir, f"{title} {start_date_str}-{end_date_str} ({current_date}).xlsx")
+            for save_dir in save_paths
+        ]
+
+    @staticmethod
+    def successful_data(selected_bases, results):
+        """Данные успешно загруженных баз в порядке выбора (при отмене - только завершенные базы)"""
+        data = {}
+        for base_name in selected_bases:
+            result = results.get(base_name)
+            if result and result.ok:
+                data[base_name] = result.data
+        return data
+
+    def start_metrics(self, run_name):
+        """Начинает сбор метрик этапов нового запуска"""
+        self.metrics = RunMetrics(run_name, trace_memory=self.trace_memory)
+        return self.metrics
+
+    def finish_metrics(self, path=None):
+        """Выводит в лог сводку этапов запуска и сохраняет метрики в JSON; возвращает путь файла"""
+        metrics = self.metrics
+        metrics.finish()
+        if not metrics.stages:
+            return None
+        for line in metrics.summary_lines():
+            self.log_message(line)
+        try:
+            path = metrics.save(path)
+        except OSError as e:
+            self.log_message(f"⚠ Не удалось сохранить метрики: {str(e)}")
+            return None
+        self.log_message(f"Метрики сохранены: {path}")
+        return path
+
+    def measured(self, run_name, func):
+        """Выполняет func() как запуск с метриками этапов (сводка выводится и при ошибке)"""
+        self.start_metrics(run_name)
+        try:
+            return func()
+        finally:
+            self.finish_metrics()
+
+    def plans_data(self, selected_bases, results):
+        """Колоночные данные "Планы" успешно загруженных баз для экспорта"""
+        return {base_name: data[1] for base_name, data in self.successful_data(selected_bases, results).items()}
+
+    def fetch_plans(self, selected_bases, login, password, start_date, end_date, max_workers, chunk_mode=None,
+                    bypass_cache=False, recheck_days=None, from_warehouse=False, server_aggregation=False,
+                    on_loaded=None):
+        """Загружает данные "Планы" выбранных баз параллельно; возвращает {база: FetchResult}.
+
+        on_loaded(result) вызывается в потоке задания по мере завершения каждой базы (см. sheet_stage).
+        """
+        def on_result(result):
+            if result.ok:
+                data, normalized_data = result.data
+                self.log_message(f"Получены данные из {result.base_name}")
+                # Структура данных выводится только в отладочном режиме: str() большого ответа дорог
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Структура данных: {str(type(data))}, keys: {str(data.keys()) if isinstance(data, dict) else 'not dict'}")
+                    logger.debug(f"Структура данных {result.base_name}: {reprlib.repr(data)}")
+                self.log_message(f"✅ Данные из {result.base_name} успешно обработаны (записей: {len(normalized_data)})")
+            else:
+                self.log_message(f"❌ {result.error}")
+            if on_loaded is not None:
+                on_loaded(result)
+
+        if from_warehouse:
+            self.log_message("Данные берутся из локального хранилища")
+            fetch = lambda name: self._load_plan_data_from_warehouse(name, start_date, end_date, server_aggregation)
+        else:
+            for base_name in selected_bases:
+                self.log_message(f"Получение данных из базы: {base_name}...")
+            fetch = lambda name: self._fetch_plan_data(
+                name, login, password, start_date, end_date, chunk_mode, bypass_cache, recheck_days,
+                server_aggregation
+            )
+        return self.run_parallel_fetch(selected_bases, fetch, on_result, max_workers)
+
+    def fetch_revenue(self, selected_bases, login, password, start_date, end_date, max_workers, chunk_mode=None,
+                      bypass_cache=False, recheck_days=None, from_warehouse=False, server_aggregation=False,
+                      on_loaded=None):
+        """Загружает данные "Выручка динамика" выбранных баз параллельно; возвращает {база: FetchResult}.
+
+        on_loaded - см. fetch_plans.
+        """
+        def on_result(result):
+            if result.ok:
+                self.log_message(f"✅ Данные 'Выручка динамика' из {result.base_name} успешно обработаны")
+            else:
+                self.log_message(f"❌ {result.error}")
+            if on_loaded is not None:
+                on_loaded(result)
+
+        if from_warehouse:
+            self.log_message("Данные 'Выручка динамика' берутся из локального хранилища")
+            fetch = lambda name: self._load_revenue_data_from_warehouse(
+                name, login, password, start_date, end_date, server_aggregation
+            )
+        else:
+            for base_name in selected_bases:
+                self.log_message(f"Получение данных 'Выручка динамика' из базы: {base_name}...")
+            fetch = lambda name: self._fetch_revenue_data(
+                name, login, password, start_date, end_date, chunk_mode, bypass_cache, recheck_days,
+                server_aggregation
+            )
+        return self.run_parallel_fetch(selected_bases, fetch, on_result, max_workers)
+
+    def log_message(self, message, level=None):
+        """Записывает сообщение в лог (из любого потока); по умолчанию уровень определяется по значку"""
+        logger.log(message_level(message) if level is None else level, message)
+
+    def log_fetch_summary(self, results, selected_bases):
+        """Выводит в лог итог параллельной загрузки по каждой базе"""
+        ok_count = sum(1 for result in results.values() if result.ok)
+        self.log_message(f"Итог загрузки: успешно {ok_count} из {len(selected_bases)}")
+        for base_name in selected_bases:
+            result = results.get(base_name)
+            if result is None:
+                continue
+            status = "✅" if result.ok else f"❌ {result.error}"
+            self.log_message(f"  {base_name}: {status} ({result.elapsed:.1f} с)")
+
+    def _progress_callback(self, base_name):
+        """Возвращает функцию, сообщающую UI и метрикам о полученных байтах базы"""
+        metrics = self.metrics
+
+        def on_bytes(count):
+            metrics.add_bytes(base_name, count)
+            self.jobs.emit("bytes", base=base_name, count=count)
+        return on_bytes
+
+    def _log_plan_row(self, group, week, day_label):
+        """Отладочное сообщение о строке дня (передается в экспорт только при уровне DEBUG)"""
+        logger.debug(f"Обработка записи: Группа={group}, Неделя={week}, День={day_label.split('. ', 1)[-1]}")
+
+    def _export_progress_callback(self, base_name, check_cancel=True):
+        """Колбэк записи листа в Excel: проверка отмены (если check_cancel) и счетчик строк базы"""
+        def on_progress(count):
+            if check_cancel:
+                self.jobs.check_cancelled()
+            self.jobs.emit("rows", base=base_name, count=count)
+        return on_progress
+
+    def run_parallel_fetch(self, selected_bases, fetch_func, on_result, max_workers):
+        """Загружает выбранные базы параллельно (вызывается из фонового задания).
+
+        fetch_func(base_name) выполняется в рабочих потоках, on_result(result) - в потоке задания.
+        """
+        def on_start(base_name):
+            self.jobs.emit("base_started", base=base_name)
+
+        def on_finished(result):
+            self.jobs.emit("base_finished", base=result.base_name, ok=result.ok)
+            on_result(result)
+
+        tasks = {base_name: (lambda name=base_name: self._limited(name, fetch_func)) for base_name in selected_bases}
+        fetcher = ParallelFetcher(max_workers, cancel_event=self.jobs.cancel_event)
+        return fetcher.run(tasks, on_finished, on_start)
+
+    def _limited(self, base_name, fetch_func):
+        """Выполняет fetch_func(base_name) со случайной задержкой старта и лимитом сервера базы"""
+        if self.start_jitter and self.jobs.cancel_event.wait(random.uniform(0, self.start_jitter)):
+            raise JobCancelled()
+        if self.host_limiter is None:
+            return fetch_func(base_name)
+        return self.host_limiter.run(
+            self.available_bases[base_name]["url"], lambda: fetch_func(base_name), self.jobs.cancel_event
+        )
+
+    def _fetch_plan_data(self, base_name, login, password, start_date, end_date, chunk_mode=None,
+                         bypass_cache=False, recheck_days=None, server_aggregation=False):
+        """Загружает и нормализует данные отчета "Планы" для одной базы (выполняется в потоке)"""
+        base_info = self.available_bases[base_name]
+        reporter = IikoOlapReporter(
+            base_info["url"], login, password, base_info["preset_id"],
+            cancel_event=self.jobs.cancel_event,
+            on_bytes=self._progress_callback(base_name),
+            cache=OLAP_CACHE,
+            bypass_cache=bypass_cache,
+            incremental=INCREMENTAL_STATE if recheck_days is not None else None,
+            recheck_days=recheck_days or 0,
+            warehouse=WAREHOUSE,
+            base_name=base_name,
+            server_aggregation=server_aggregation
+        )
+        with self.metrics.stage(base_name, "auth"):
+            if not reporter.auth():
+                raise ReportFetchError(f"Ошибка авторизации в базе {base_name}")
+        # Загрузка включает разбор JSON: ответ разбирается потоково по мере получения
+        with self.metrics.stage(base_name, "fetch", reporter.client) as stage:
+            data = reporter.get_olap_report(start_date, end_date, chunk_mode)
+            if isinstance(data, dict) and isinstance(data.get('data'), list):
+                stage.rows = len(data['data'])
+        self.log_cache_stats(base_name, reporter)
+        if not data:
+            raise ReportFetchError(f"Не удалось получить данные из {base_name}")
+        with self.metrics.stage(base_name, "normalize") as stage:
+            normalized_data = self.normalize_report_data(data)
+            stage.rows = len(normalized_data)
+        if not normalized_data:
+            raise ReportFetchError(f"Не удалось нормализовать данные из {base_name}")
+        # Сырые строки сохраняются в архив снимков фоновым потоком
+        SNAPSHOTS.save_async(
+            "plans", base_name, base_info["url"], reporter.source_id, start_date, end_date, normalized_data
+        )
+        with self.metrics.stage(base_name, "columns") as stage:
+            columns = self.build_plan_columns(base_name, normalized_data, start_date)
+            stage.rows = len(columns)
+        self.jobs.emit("rows", base=base_name, count=len(columns))
+        return data, columns
+
+    def build_plan_columns(self, base_name, records, start_date):
+        """Дополняет строки особых баз и строит колоночное представление отчета «Планы».
+
+        Строки дополняются в копиях: исходный список в это время может записываться в архив снимков.
+        """
+        filled = []
+        for record in records:
+            if isinstance(record, dict):
+                record = dict(record)
+                self._fill_plan_record(base_name, record, start_date)
+            filled.append(record)
+        return OlapColumns.from_records(filled)
+
+    def _fill_plan_record(self, base_name, record, start_date):
+        """Заполняет неделю и день недели для баз, пресет которых их не возвращает"""
+        # Обработка для базы "Казань 1, 2, 3 СХ Железногорск Брянск"
+        if base_name == "Казань 1, 2, 3 СХ Железногорск Брянск":
+            # Для базы "Казань 1, 2, 3 СХ Железногорск Брянск" вычисляем недели и дни
+            if 'WeekInMonthOpen' not in record or not record['WeekInMonthOpen']:
+                record['WeekInMonthOpen'] = self._get_week_number(record['OpenDate.Typed'], start_date)
+            if 'DayOfWeekOpen' not in record or not record['DayOfWeekOpen']:
+                date = datetime.strptime(record['OpenDate.Typed'], '%Y-%m-%dT%H:%M:%S')
+                day_num = date.weekday() + 1  # Нумерация дней недели с 1 (понедельник)
+                day_name = self._get_day_name(day_num)
+                record['DayOfWeekOpen'] = f"{day_num}. {day_name}"
+
+        # Обработка для базы "СХ Орел" - проверяем наличие нужных полей
+        if base_name == "СХ Орел":
+            # Для базы "СХ Орел" проверяем и корректируем поля
+            if 'WeekInMonthOpen' not in record or not record['WeekInMonthOpen']:
+                record['WeekInMonthOpen'] = '1'  # Установим значение по умолчанию
+            if 'DayOfWeekOpen' not in record or not record['DayOfWeekOpen']:
+                record['DayOfWeekOpen'] = '1. Понедельник'  # Установим значение по умолчанию
+
+    def _fetch_revenue_data(self, base_name, login, password, start_date, end_date, chunk_mode=None,
+                            bypass_cache=False, recheck_days=None, server_aggregation=False):
+        """Загружает и обрабатывает данные отчета "Выручка динамика" для одной базы (выполняется в потоке)"""
+        base_info = self.available_bases[base_name]
+        reporter = IikoRevenueReporter(
+            base_info["url"], login, password, base_info["revenue_preset_id"],
+            cancel_event=self.jobs.cancel_event,
+            on_bytes=self._progress_callback(base_name),
+            cache=OLAP_CACHE,
+            bypass_cache=bypass_cache,
+            incremental=INCREMENTAL_STATE if recheck_days is not None else None,
+            recheck_days=recheck_days or 0,
+            warehouse=WAREHOUSE,
+            base_name=base_name,
+            server_aggregation=server_aggregation
+        )
+        with self.metrics.stage(base_name, "auth"):
+            if not reporter.auth():
+                raise ReportFetchError(f"Ошибка авторизации в базе {base_name}")
+        with self.metrics.stage(base_name, "fetch", reporter.client):
+            rows = reporter.iter_olap_rows(start_date, end_date, chunk_mode)
+        self.log_cache_stats(base_name, reporter)
+        if rows is None:
+            raise ReportFetchError(f"Не удалось получить данные 'Выручка динамика' из {base_name}")
+        # Потоковые строки (окна с сервера и из кэша) читаются во время свертки: загрузка попадает в этот этап
+        with self.metrics.stage(base_name, "aggregate", reporter.client) as stage:
+            processed_data = reporter.process_report_data({'data': rows})
+            stage.rows = processed_data.get('rows') if processed_data else None
+        if not processed_data or not processed_data.get('has_data'):
+            raise ReportFetchError(f"Не удалось обработать данные 'Выручка динамика' из {base_name}")
+        self.jobs.emit("rows", base=base_name, count=processed_data['rows'])
+        return processed_data
+
+    def _load_plan_data_from_warehouse(self, base_name, start_date, end_date, server_aggregation=False):
+        """Данные отчета "Планы" базы из локального хранилища (без обращения к серверу).
+
+        Берутся только строки того же источника: пресета или, с server_aggregation, отчета OLAP v2.
+        """
+        source_id = IikoOlapReporter.source_for(self.available_bases[base_name]["preset_id"], server_aggregation)
+        with self.metrics.stage(base_name, "warehouse") as stage:
+            rows = WAREHOUSE.load_rows("plans", base_name, start_date, end_date, source_id)
+            stage.rows = len(rows) if rows is not None else None
+        if rows is None:
+            raise ReportFetchError(f"В хранилище нет данных 'Планы' базы {base_name} за выбранный период")
+        with self.metrics.stage(base_name, "columns") as stage:
+            columns = self.build_plan_columns(base_name, rows, start_date)
+            stage.rows = len(columns)
+        self.jobs.emit("rows", base=base_name, count=len(columns))
+        return rows, columns
+
+    def _load_revenue_data_from_warehouse(self, base_name, login, password, start_date, end_date,
+                                          server_aggregation=False):
+        """Данные отчета "Выручка динамика" базы из локального хранилища (без обращения к серверу)"""
+        base_info = self.available_bases[base_name]
+        source_id = IikoRevenueReporter.source_for(base_info["revenue_preset_id"], server_aggregation)
+        with self.metrics.stage(base_name, "warehouse") as stage:
+            rows = WAREHOUSE.load_rows("revenue", base_name, start_date, end_date, source_id)
+            stage.rows = len(rows) if rows is not None else None
+        if rows is None:
+            raise ReportFetchError(f"В хранилище нет данных 'Выручка динамика' базы {base_name} за выбранный период")
+        reporter = IikoRevenueReporter(base_info["url"], login, password, base_info["revenue_preset_id"])
+        with self.metrics.stage(base_name, "aggregate") as stage:
+            processed_data = reporter.process_report_data({'data': rows})
+            stage.rows = processed_data.get('rows') if processed_data else None
+        if not processed_data or not processed_data.get('has_data'):
+            raise ReportFetchError(f"Не удалось обработать данные 'Выручка динамика' из хранилища для {base_name}")
+        self.jobs.emit("rows", base=base_name, count=processed_data['rows'])
+        return processed_data
+
+    def _load_writeoff_data_from_warehouse(self, base_name, start_date, end_date):
+        """Акты списания и справочники базы из локального хранилища (без обращения к серверу)"""
+        with self.metrics.stage(base_name, "warehouse") as stage:
+            docs = WAREHOUSE.load_writeoff_docs(base_name, start_date, end_date)
+            stage.rows = len(docs)
+        if not docs:
+            raise ReportFetchError(f"В хранилище нет актов списания базы {base_name} за выбранный период")
+        reporter = WriteoffReporter.from_warehouse(WAREHOUSE, base_name, self.available_bases[base_name]["url"])
+        return reporter, docs
+
+    def log_chunk_mode(self, chunk_mode, start_date, end_date, cached=True):
+        """Сообщает в лог, на сколько окон будет разбит период (с кэшем "Авто" - см. cache_windows)"""
+        if chunk_mode == "auto" and cached:
+            windows = cache_windows(start_date, end_date)
+            if len(windows) > 1:
+                self.log_message(f"Период разбит на окна (auto): {len(windows)}")
+            return
+        mode = resolve_chunk_mode(chunk_mode, start_date, end_date)
+        if mode:
+            windows = split_date_range(start_date, end_date, mode)
+            self.log_message(f"Период разбит на окна ({mode}): {len(windows)}")
+
+    def log_cache_stats(self, base_name, reporter):
+        """Сообщает, сколько окон периода взято из кэша, а сколько загружено с сервера"""
+        if reporter.cache is not None:
+            self.log_message(
+                f"{base_name}: окон из кэша {reporter.cache_hits}, загружено с сервера {reporter.cache_misses}"
+            )
+
+    def normalize_report_data(self, data):
+        """Нормализует данные отчета для корректного создания DataFrame"""
+        if isinstance(data, dict):
+            # Проверяем наличие ключей с данными
+            for key in ['records', 'data', 'report']:
+                if key in data and isinstance(data[key], list):
+                    return data[key]
+            # Если не нашли массив, проверяем наличие других возможных ключей
+            if 'result' in data and isinstance(data['result'], list):
+                return data['result']
+            # Если ничего не найдено, возвращаем весь словарь как список из одного элемента
+            return [data]
+        elif isinstance(data, list):
+            return data
+        else:
+            return []
+
+    def _export_plans(self, start_date, end_date, totals_mode="sum", output_path=None):
+        """Формирует и сохраняет Excel-файл отчета "Планы" (выполняется в фоновом потоке).
+
+        Возвращает путь сохраненного файла или None.
+        """
+        try:
+            for filename in self._report_filenames("OLAP-Планы", start_date, end_date, output_path):
+                try:
+                    self.log_message(f"Попытка сохранения в: {filename}")
+                    # Проверяем доступность директории
+                    save_dir = os.path.dirname(filename)
+                    if save_dir and not os.path.exists(save_dir):
+                        os.makedirs(save_dir)
+                    writer = ExcelReportWriter(totals_mode)
+                    for base_name, data in self.report_data.items():
+                        if not data:
+                            self.log_message(f"Нет данных для {base_name}")
+                            continue
+                        try:
+                            # Этап включает сортировку строк по группе, неделе и дню
+                            with self.metrics.stage(base_name, "sheet") as stage:
+                                stage.rows = writer.add_plans_sheet(
+                                    base_name, data, start_date, end_date,
+                                    on_row=self._log_plan_row if logger.isEnabledFor(logging.DEBUG) else None,
+                                    on_progress=self._export_progress_callback(base_name)
+                                )
+                        except Exception as e:
+                            self.log_message(f"Ошибка в {base_name}: {str(e)}")
+                            continue
+                        finally:
+                            self.jobs.emit("base_finished", base=base_name, ok=True)
+                    # Сохраняем файл
+                    with self.metrics.stage(METRICS_WORKBOOK, "save"):
+                        writer.save(filename)
+                    self.log_message(f"✅ Отчет успешно сохранен в: {filename}")
+                    self.open_report(filename)
+                    return filename  # Успешно сохранили
+                except PermissionError as e:
+                    self.log_message(f"Ошибка доступа: {str(e)}")
+                    continue
+                except Exception as e:
+                    self.log_message(f"Ошибка: {str(e)}")
+                    continue
+            # Если все попытки неудачны
+            self.log_message("❌ Не удалось сохранить отчет ни в одну из папок")
+            self.show_error("Ошибка", "Не удалось сохранить отчет. Проверьте права доступа.")
+        except Exception as e:
+            self.log_message(f"Критическая ошибка: {str(e)}")
+            self.show_error("Ошибка", f"Ошибка: {str(e)}")
+        return None
+
+    def _export_revenue(self, start_date, end_date, output_path=None):
+        """Формирует и сохраняет Excel-файл отчета "Выручка динамика" (выполняется в фоновом потоке).
+
+        Возвращает путь сохраненного файла или None.
+        """
+        try:
+            for filename in self._report_filenames("OLAP-Выручка для динамики", start_date, end_date, output_path):
+                try:
+                    self.log_message(f"Попытка сохранения в: {filename}")
+                    
+                    save_dir = os.path.dirname(filename)
+                    if save_dir and not os.path.exists(save_dir):
+                        os.makedirs(save_dir)
+                    
+                    writer = ExcelReportWriter()
+                    for base_name, data in self.revenue_data.items():
+                        self.jobs.check_cancelled()
+                        try:
+                            # Количество групп для текущей базы (по умолчанию 4)
+                            with self.metrics.stage(base_name, "sheet") as stage:
+                                groups = writer.add_revenue_sheet(
+                                    base_name, data, start_date, end_date,
+                                    REVENUE_GROUPS_BY_BASE.get(base_name, 4)
+                                )
+                                stage.rows = len(data['categories'])
+                            self.log_message(f"✅ Лист для базы {base_name} создан (групп: {len(groups)})")
+                            self.jobs.emit("rows", base=base_name, count=len(data['categories']))
+                        except Exception as e:
+                            self.log_message(f"❌ Ошибка при создании листа для базы {base_name}: {str(e)}")
+                            continue
+                        finally:
+                            self.jobs.emit("base_finished", base=base_name, ok=True)
+                    
+                    # Сохраняем файл
+                    with self.metrics.stage(METRICS_WORKBOOK, "save"):
+                        writer.save(filename)
+                    self.log_message(f"✅ Отчет 'Выручка динамика' успешно сохранен в: {filename}")
+                    self.open_report(filename)
+                    return filename  # Успешно сохранили
+                    
+                except PermissionError as e:
+                    self.log_message(f"Ошибка доступа: {str(e)}")
+                    continue
+                except Exception as e:
+                    self.log_message(f"Ошибка: {str(e)}")
+                    continue
+            
+            # Если все попытки неудачны
+            self.log_message("❌ Не удалось сохранить отчет ни в одну из папок")
+            self.show_error("Ошибка", "Не удалось сохранить отчет. Проверьте права доступа.")
+            
+        except Exception as e:
+            self.log_message(f"Критическая ошибка: {str(e)}")
+            self.show_error("Ошибка", f"Ошибка: {str(e)}")
+        return None
+
+    def sheet_stage(self, writer, render):
+        """Этап конвейера: лист базы строится сразу после ее загрузки, пока остальные базы загружаются.
+
+        Возвращает колбэк on_loaded(result) для fetch_plans/fetch_revenue; render(base_name, data)
+        выполняется в потоке задания, пишет лист в writer и возвращает число строк листа
+        (прогресс render сообщает через _export_progress_callback(base_name, check_cancel=False)).
+        Отмена проверяется только между листами: начатый лист дописывается, новые базы после отмены
+        не принимаются, и готовые листы сохраняются, как при обычной отмене загрузки.
+        """
+        def on_loaded(result):
+            if not result.ok:
+                return
+            if self.jobs.cancel_event.is_set():
+                self.log_message(f"⚠ Лист базы {result.base_name} не создан: задание отменено")
+                return
+            try:
+                with self.metrics.stage(result.base_name, "sheet") as stage:
+                    stage.rows = render(result.base_name, result.data)
+            except Exception as e:
+                self.log_message(f"❌ Ошибка при создании листа для базы {result.base_name}: {str(e)}")
+        return on_loaded
+
+    def _save_workbook(self, writer, filenames):
+        """Сохраняет книгу в первый доступный путь из filenames; возвращает путь или None"""
+        for filename in filenames:
+            try:
+                self.log_message(f"Попытка сохранения в: {filename}")
+                save_dir = os.path.dirname(filename)
+                if save_dir and not os.path.exists(save_dir):
+                    os.makedirs(save_dir)
+                with self.metrics.stage(METRICS_WORKBOOK, "save"):
+                    writer.save(filename)
+                return filename
+            except PermissionError as e:
+                self.log_message(f"Ошибка доступа: {str(e)}")
+            except Exception as e:
+                self.log_message(f"Ошибка: {str(e)}")
+        self.log_message("❌ Не удалось сохранить отчет ни в одну из папок")
+        self.show_error("Ошибка", "Не удалось сохранить отчет. Проверьте права доступа.")
+        return None
+
+    def _finish_pipelined_report(self, writer, selected_bases, title, start_date, end_date, output_path=None):
+        """Упорядочивает листы конвейерной книги по выбору баз и сохраняет ее; возвращает путь или None"""
+        if not writer.sheet_count:
+            self.log_message("❌ Не удалось получить данные ни из одной базы")
+            return None
+        writer.order_sheets(selected_bases)
+        filename = self._save_workbook(writer, self._report_filenames(title, start_date, end_date, output_path))
+        if filename:
+            self.log_message(f"✅ Отчет успешно сохранен в: {filename}")
+            self.open_report(filename)
+        return filename
+
+    def build_plans_report(self, selected_bases, login, password, start_date, end_date, max_workers,
+                           chunk_mode=None, bypass_cache=False, recheck_days=None, from_warehouse=False,
+                           server_aggregation=False, totals_mode="sum", output_path=None):
+        """Конвейерный отчет "Планы": загрузка баз и запись листов в Excel одновременно.
+
+        Возвращает ({база: FetchResult}, путь сохраненного файла или None).
+        """
+        writer = ExcelReportWriter(totals_mode)
+        render = lambda base_name, data: writer.add_plans_sheet(
+            base_name, data[1], start_date, end_date,
+            on_row=self._log_plan_row if logger.isEnabledFor(logging.DEBUG) else None,
+            on_progress=self._export_progress_callback(base_name, check_cancel=False)
+        )
+        results = self.fetch_plans(
+            selected_bases, login, password, start_date, end_date, max_workers, chunk_mode, bypass_cache,
+            recheck_days, from_warehouse, server_aggregation, on_loaded=self.sheet_stage(writer, render)
+        )
+        self.log_fetch_summary(results, selected_bases)
+        self.report_data = self.plans_data(selected_bases, results)
+        return results, self._finish_pipelined_report(
+            writer, selected_bases, "OLAP-Планы", start_date, end_date, output_path
+        )
+
+    def build_revenue_report(self, selected_bases, login, password, start_date, end_date, max_workers,
+                             chunk_mode=None, bypass_cache=False, recheck_days=None, from_warehouse=False,
+                             server_aggregation=False, output_path=None):
+        """Конвейерный отчет "Выручка динамика" (см. build_plans_report)"""
+        writer = ExcelReportWriter()
+
+        def render(base_name, data):
+            groups = writer.add_revenue_sheet(
+                base_name, data, start_date, end_date, REVENUE_GROUPS_BY_BASE.get(base_name, 4)
+            )
+            self.log_message(f"✅ Лист для базы {base_name} создан (групп: {len(groups)})")
+            return len(data['categories'])
+
+        results = self.fetch_revenue(
+            selected_bases, login, password, start_date, end_date, max_workers, chunk_mode, bypass_cache,
+            recheck_days, from_warehouse, server_aggregation, on_loaded=self.sheet_stage(writer, render)
+        )
+        self.log_fetch_summary(results, selected_bases)
+        self.revenue_data = self.successful_data(selected_bases, results)
+        return results, self._finish_pipelined_report(
+            writer, selected_bases, "OLAP-Выручка для динамики", start_date, end_date, output_path
+        )
+
+    def _get_day_name(self, day_num):
+        """Возвращает название дня недели по номеру"""
+        days = {
+            1: "Понедельник",
+            2: "Вторник",
+            3: "Среда",
+            4: "Четверг",
+            5: "Пятница",
+            6: "Суббота",
+            7: "Воскресенье"
+        }
+        return days.get(day_num, "")
+
+    def _get_week_number(self, date_str, start_date):
+        """Вычисляет номер недели в месяце"""
+        date = datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S')
+        # Номер недели в месяце
+        week_in_month = (date.day - 1) // 7 + 1
+        return week_in_month
+
+    def _fetch_writeoff_data(self, base_name, login, password, start_date, end_date, products_on_demand=True,
+                             chunk_mode=None):
+        """Загружает справочники и акты списания для одной базы (выполняется в потоке).
+
+        products_on_demand - названия товаров ищутся только для товаров актов (иначе загружается
+        весь справочник товаров), chunk_mode - разбивка периода на окна (см. fetch_writeoff_docs).
+        """
+        base_info = self.available_bases[base_name]
+        reporter = WriteoffReporter(
+            base_info["url"], login, password,
+            cancel_event=self.jobs.cancel_event,
+            on_bytes=self._progress_callback(base_name),
+            warehouse=WAREHOUSE,
+            base_name=base_name,
+            directory_cache=DIRECTORY_CACHE,
+            products_on_demand=products_on_demand
+        )
+        with self.metrics.stage(base_name, "auth"):
+            if not reporter.auth():
+                raise ReportFetchError(f"Ошибка авторизации в базе {base_name}")
+        # Справочники: свежие из кэша, остальные загружаются с сервера параллельно
+        with self.metrics.stage(base_name, "directories", reporter.client):
+            reporter.load_directories()
+        if reporter.directories_cached:
+            logger.debug(
+                f"{base_name}: справочников из кэша {reporter.directories_cached} из {len(reporter.DIRECTORIES)}"
+            )
+        # Получение актов списания
+        with self.metrics.stage(base_name, "documents", reporter.client) as stage:
+            docs = reporter.fetch_writeoff_docs(start_date, end_date, chunk_mode)
+            stage.rows = len(docs) if docs else 0
+        if not docs:
+            raise ReportFetchError(f"Не удалось получить данные из {base_name}")
+        if products_on_demand:
+            with self.metrics.stage(base_name, "products", reporter.client) as stage:
+                stage.rows = reporter.resolve_product_names(docs)
+            total, known, fetched = reporter.products_stats
+            logger.debug(f"{base_name}: товаров в актах {total}, из хранилища {known}, загружено с сервера {fetched}")
+        return reporter, docs
+
+    def clear_directory_cache(self, selected_bases):
+        """Удаляет справочники выбранных баз из кэша и названия товаров из хранилища, чтобы при
+        следующем отчете они загрузились с сервера заново; возвращает число удаленных записей"""
+        removed = 0
+        for base_name in selected_bases:
+            removed += DIRECTORY_CACHE.invalidate(self.available_bases[base_name]["url"])
+            try:
+                removed += WAREHOUSE.delete_names(base_name, "products")
+            except (sqlite3.Error, OSError) as e:
+                logger.error(f"❌ {base_name}: не удалось удалить названия товаров из хранилища: {str(e)}")
+        return removed
+
+    def _build_writeoff_report(self, selected_bases, login, password, start_date, end_date, max_workers,
+                               from_warehouse=False, output_path=None, products_on_demand=True, chunk_mode=None):
+        """Загружает акты списания и сохраняет Excel-файл (выполняется в фоновом потоке).
+
+        Лист базы строится сразу после загрузки ее актов, пока остальные базы еще загружаются;
+        перед сохранением листы упорядочиваются по выбору баз.
+        При отмене в файл попадают базы, загрузка которых уже завершилась.
+        from_warehouse - взять акты и справочники из локального хранилища вместо сервера,
+        output_path - путь файла (по умолчанию файл создается в текущей папке),
+        products_on_demand и chunk_mode - см. _fetch_writeoff_data.
+        Возвращает ({база: FetchResult}, путь сохраненного файла или None).
+        """
+        start_date_str = start_date.strftime('%d.%m.%Y')
+        end_date_str = end_date.strftime('%d.%m.%Y')
+        current_date = datetime.now().strftime('%Y-%m-%d_%H-%M')
+
+        writer = ExcelReportWriter()
+
+        def render(base_name, data):
+            reporter, docs = data
+            rows = writer.add_writeoff_sheet(
+                base_name, docs, reporter, on_progress=self._export_progress_callback(base_name, check_cancel=False)
+            )
+            self.log_message(f"✅ Данные из {base_name} успешно загружены")
+            return rows
+
+        on_loaded = self.sheet_stage(writer, render)
+
+        def on_result(result):
+            if result.ok:
+                self.log_message(f"Получены акты списания из {result.base_name}")
+            else:
+                self.log_message(f"❌ {result.error}")
+            on_loaded(result)
+
+        if from_warehouse:
+            fetch = lambda name: self._load_writeoff_data_from_warehouse(name, start_date, end_date)
+        else:
+            fetch = lambda name: self._fetch_writeoff_data(
+                name, login, password, start_date, end_date, products_on_demand, chunk_mode
+            )
+        results = self.run_parallel_fetch(selected_bases, fetch, on_result, max_workers)
+        self.log_fetch_summary(results, selected_bases)
+
+        if not writer.sheet_count:
+            self.log_message("❌ Не удалось получить акты списания ни из одной базы")
+            return results, None
+        # Листы идут в порядке выбора баз, независимо от порядка завершения загрузки
+        writer.order_sheets(selected_bases)
+
+        # Сохранение файла
+        filename = self._save_workbook(
+            writer, [output_path or f"Акты списания {start_date_str}-{end_date_str} ({current_date}).xlsx"]
+        )
+        if filename:
+            self.log_message(f"✅ Отчет по актам списания сохранен в: {filename}")
+            self.open_report(filename)
+        return results, filename
+
+
+class IikoOlapReporterGUI(IikoReportRunner):
     def __init__(self, root):
         self.root = root
         self.root.title("IIKO Reporter")
         self.root.geometry("1200x800")
+        # Лог: сообщения копятся в кольцевом буфере и выводятся в окно пакетами по таймеру.
+        # Буфер подключается до загрузки конфигурации баз, чтобы ее ошибки попали в окно
+        self.log_buffer = LogRingBuffer()
+        self.log_buffer.setFormatter(logging.Formatter("%(asctime)s %(message)s", "%H:%M:%S"))
+        logger.addHandler(self.log_buffer)
+        logger.setLevel(logging.INFO)
 
-        # Список доступных баз
-        # Загрузка баз из внешнего файла
-        self.available_bases = self.load_bases_config()
+        # Фоновые задания; список доступных баз загружается из внешнего файла
+        super().__init__(BackgroundJobRunner(self.root, self.handle_job_event))
 
         self.selected_bases = []  
-        self.report_data = {}   # Данные для отчета "Выручка динамика"
-        self.revenue_data = {}  # Данные для отчета "Выручка динамика"
+        # Счетчики прогресса
+        self.progress_state = {"total": 0, "finished": 0, "bytes": 0, "rows": 0, "active": set()}
+        self._button_states = {}
+        self._auth_ok = False  # Есть ли база с успешной авторизацией
+        self._log_sequence = 0
+        self._log_file_handler = None
         self.create_widgets()
+        self.root.after(LOG_FLUSH_INTERVAL_MS, self.flush_log)
+        # При закрытии окна завершаем сессии iiko, чтобы не занимать лицензии
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
-    def load_bases_config(self):
-        """Загружает конфигурацию баз из JSON-файла"""
-        config_path = os.path.join(os.path.dirname(__file__), "bases_config.json")
-        try:
-            with open(config_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            messagebox.showerror("Ошибка", f"Файл конфигурации не найден: {config_path}")
-            return {}
-        except json.JSONDecodeError as e:
-            messagebox.showerror("Ошибка", f"Ошибка в формате JSON: {e}")
-            return {}
+    def show_error(self, title, message):
+        """Показывает ошибку в диалоге (из любого потока)"""
+        self.run_in_ui(messagebox.showerror, title, message)
+
+    def open_report(self, filename):
+        """Открывает сохраненный отчет в Excel (только в Windows)"""
+        if os.name == 'nt':
+            os.startfile(filename)
 
     def create_widgets(self):
         # Main container frame
@@ -75,7 +2195,19 @@ class IikoOlapReporterGUI:
         # Кнопка авторизации внутри блока параметров подключения
         self.auth_button = ttk.Button(connection_frame, text="Авторизация", command=self.auth)
         self.auth_button.grid(row=0, column=2, rowspan=2, padx=10, sticky=tk.NS)
-        
+
+        # Количество баз, загружаемых одновременно
+        ttk.Label(connection_frame, text="Потоков:").grid(row=2, column=0, sticky=tk.W)
+        self.max_workers_var = tk.IntVar(value=DEFAULT_MAX_WORKERS)
+        self.max_workers_spinbox = ttk.Spinbox(
+            connection_frame,
+            from_=1,
+            to=16,
+            width=5,
+            textvariable=self.max_workers_var
+        )
+        self.max_workers_spinbox.grid(row=2, column=1, sticky=tk.W, padx=5, pady=(5, 0))
+
         # Frame для выбора баз
         bases_frame = ttk.LabelFrame(left_panel, text="Выбор баз", padding=10)
         bases_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -116,11 +2248,13 @@ class IikoOlapReporterGUI:
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
         
+        self.base_checkbuttons = {}
         for base_name in self.available_bases:
             var = tk.BooleanVar()
             chk = ttk.Checkbutton(scrollable_frame, text=base_name, variable=var)
             chk.pack(anchor=tk.W, padx=5, pady=2)
             self.base_vars[base_name] = var
+            self.base_checkbuttons[base_name] = chk
         
         # Frame для выбора периода (правая панель)
         period_frame = ttk.LabelFrame(right_panel, text="Выбор периода", padding=10)
@@ -138,20 +2272,96 @@ class IikoOlapReporterGUI:
             textvariable=self.period_var,
             state="readonly"
         )
-        self.period_combobox['values'] = [
-            "Сегодня",
-            "Вчера",
-            "Текущая неделя",
-            "Прошлая неделя",
-            "Текущий месяц",
-            "Прошлый месяц",
-            "Текущий год",
-            "Прошлый год",
-            "Другой..."
-        ]
+        self.period_combobox['values'] = list(PERIODS)
         self.period_combobox.current(4)  # По умолчанию "Текущий месяц"
         self.period_combobox.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
         self.period_combobox.bind("<<ComboboxSelected>>", self.update_period)
+
+        # Разбивка длинного периода на окна, загружаемые параллельно
+        chunk_select_frame = ttk.Frame(period_frame)
+        chunk_select_frame.pack(fill=tk.X, pady=5)
+
+        ttk.Label(chunk_select_frame, text="Разбивка:").pack(side=tk.LEFT, padx=5)
+
+        self.chunk_var = tk.StringVar()
+        self.chunk_combobox = ttk.Combobox(
+            chunk_select_frame,
+            textvariable=self.chunk_var,
+            state="readonly",
+            values=list(CHUNK_MODES)
+        )
+        self.chunk_combobox.current(0)  # По умолчанию "Авто"
+        self.chunk_combobox.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
+
+        # Свертка на сервере: вместо пресета запрашивается отчет OLAP v2 только с нужными полями
+        self.server_aggregation_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            period_frame,
+            text="Сворачивать данные на сервере (OLAP v2)",
+            variable=self.server_aggregation_var
+        ).pack(anchor=tk.W, padx=5)
+
+        # Дисковый кэш ответов: при включенном флаге все дни загружаются заново
+        self.bypass_cache_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            period_frame,
+            text="Не использовать кэш (загрузить заново)",
+            variable=self.bypass_cache_var
+        ).pack(anchor=tk.W, padx=5)
+
+        # Локальное хранилище: отчеты строятся по ранее загруженным строкам, без обращения к серверу
+        self.warehouse_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            period_frame,
+            text="Из локального хранилища (без сервера)",
+            variable=self.warehouse_var,
+            command=self.toggle_warehouse_mode
+        ).pack(anchor=tk.W, padx=5)
+
+        # Инкрементальное обновление: загружаются только дни с последней загрузки и запас на правки
+        incremental_frame = ttk.Frame(period_frame)
+        incremental_frame.pack(fill=tk.X, pady=(5, 0))
+
+        self.incremental_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            incremental_frame,
+            text="Инкрементальное обновление",
+            variable=self.incremental_var
+        ).pack(side=tk.LEFT, padx=5)
+
+        ttk.Label(incremental_frame, text="Перепроверка, дн.:").pack(side=tk.LEFT, padx=5)
+        self.recheck_days_var = tk.IntVar(value=DEFAULT_RECHECK_DAYS)
+        ttk.Spinbox(
+            incremental_frame,
+            from_=0,
+            to=31,
+            width=5,
+            textvariable=self.recheck_days_var
+        ).pack(side=tk.LEFT, padx=5)
+
+        # Способ записи итогов по неделям и группам в Excel-отчете "Планы"
+        totals_frame = ttk.Frame(period_frame)
+        totals_frame.pack(fill=tk.X, pady=5)
+
+        ttk.Label(totals_frame, text="Итоги в Excel:").pack(side=tk.LEFT, padx=5)
+
+        self.totals_var = tk.StringVar()
+        self.totals_combobox = ttk.Combobox(
+            totals_frame,
+            textvariable=self.totals_var,
+            state="readonly",
+            values=list(TOTALS_MODES)
+        )
+        self.totals_combobox.current(0)  # По умолчанию формулы SUM, как раньше
+        self.totals_combobox.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
+
+        # Конвейер: кнопки получения отчетов сразу сохраняют Excel, листы строятся по мере загрузки баз
+        self.pipeline_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            period_frame,
+            text="Сразу сохранять в Excel (листы по мере загрузки баз)",
+            variable=self.pipeline_var
+        ).pack(anchor=tk.W, padx=5)
         
         # Календарь для выбора диапазона дат
         self.calendar_frame = ttk.Frame(period_frame)
@@ -232,12 +2442,79 @@ class IikoOlapReporterGUI:
             command=self.get_writeoff_report, 
             state=tk.DISABLED
         )
-        self.writeoff_button.grid(row=2, column=0, columnspan=2, padx=5, pady=2, sticky="ew")
+        self.writeoff_button.grid(row=2, column=0, padx=5, pady=2, sticky="ew")
+
+        # Справочники актов берутся из кэша; кнопка сбрасывает кэш выбранных баз
+        self.directories_button = ttk.Button(
+            grid_frame,
+            text="Обновить справочники актов",
+            command=self.invalidate_directories
+        )
+        self.directories_button.grid(row=2, column=1, padx=5, pady=2, sticky="ew")
+
+        # Четвертая строка: данные "Планы" из архива снимков (без подключения к серверу)
+        self.snapshot_button = ttk.Button(
+            grid_frame,
+            text="Планы из архива снимков",
+            command=self.load_report_from_snapshots
+        )
+        self.snapshot_button.grid(row=3, column=0, columnspan=2, padx=5, pady=2, sticky="ew")
+
+        # Прогресс выполнения фонового задания и кнопка отмены
+        progress_frame = ttk.Frame(button_frame)
+        progress_frame.pack(fill=tk.X, pady=(5, 0))
+        progress_frame.columnconfigure(0, weight=1)
+
+        self.progress_bar = ttk.Progressbar(progress_frame, mode="determinate")
+        self.progress_bar.grid(row=0, column=0, padx=5, pady=2, sticky="ew")
+
+        self.cancel_button = ttk.Button(
+            progress_frame,
+            text="Отмена",
+            command=self.cancel_job,
+            state=tk.DISABLED
+        )
+        self.cancel_button.grid(row=0, column=1, padx=5, pady=2)
+
+        self.progress_label = ttk.Label(progress_frame, text="")
+        self.progress_label.grid(row=1, column=0, columnspan=2, padx=5, sticky="w")
         
         # Лог событий (внизу окна)
         log_frame = ttk.LabelFrame(self.root, text="Лог", padding=10)
         log_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
         
+        # Уровень лога и запись в файл
+        log_options_frame = ttk.Frame(log_frame)
+        log_options_frame.pack(fill=tk.X, pady=(0, 5))
+
+        ttk.Label(log_options_frame, text="Уровень:").pack(side=tk.LEFT, padx=5)
+        self.log_level_var = tk.StringVar()
+        self.log_level_combobox = ttk.Combobox(
+            log_options_frame,
+            textvariable=self.log_level_var,
+            state="readonly",
+            values=list(LOG_LEVELS)
+        )
+        self.log_level_combobox.current(0)  # По умолчанию "Обычный"
+        self.log_level_combobox.pack(side=tk.LEFT, padx=5)
+        self.log_level_combobox.bind("<<ComboboxSelected>>", self.set_log_level)
+
+        self.log_file_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            log_options_frame,
+            text="Записывать лог в файл",
+            variable=self.log_file_var,
+            command=self.toggle_log_file
+        ).pack(side=tk.LEFT, padx=5)
+
+        # Пик памяти в сводке метрик этапов (tracemalloc замедляет обработку)
+        self.trace_memory_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            log_options_frame,
+            text="Замерять память этапов (медленнее)",
+            variable=self.trace_memory_var
+        ).pack(side=tk.LEFT, padx=5)
+
         self.log_text = tk.Text(log_frame, height=10, state=tk.DISABLED)
         self.log_text.pack(fill=tk.BOTH, expand=True)
         
@@ -248,993 +2525,2331 @@ class IikoOlapReporterGUI:
         # Инициализация дат
         self.update_period()
 
-    def toggle_select_all(self):
-        """Выбирает или снимает выбор со всех баз"""
-        select_all = self.select_all_var.get()
-        for var in self.base_vars.values():
-            var.set(select_all)
+    def on_close(self):
+        """Отменяет текущее задание, выполняет выход из всех баз, дописывает архив снимков и закрывает окно"""
+        self.jobs.cancel()
+        # Выход из баз только после остановки задания: иначе оно продолжит запросы с отозванным токеном
+        if not self.jobs.wait(JOB_STOP_TIMEOUT_SECONDS):
+            self.log_message(f"⚠ Задание не остановилось за {JOB_STOP_TIMEOUT_SECONDS} с, выход из баз без ожидания")
+        CLIENT_POOL.logout_all()
+        # Дописываем снимки, ожидающие записи
+        SNAPSHOTS.flush(timeout=10)
+        self.root.destroy()
+
+    def toggle_select_all(self):
+        """Выбирает или снимает выбор со всех баз"""
+        select_all = self.select_all_var.get()
+        for var in self.base_vars.values():
+            var.set(select_all)
+
+    def get_selected_bases(self):
+        """Возвращает список выбранных баз"""
+        return [base_name for base_name, var in self.base_vars.items() if var.get()]
+
+    def update_period(self, event=None):
+        """Обновляет даты в календаре в зависимости от выбранного периода"""
+        dates = period_dates(self.period_combobox.get())
+        if dates is None:  # "Другой..."
+            return
+        start_date, end_date = dates
+        self.cal_start.selection_set(start_date)
+        self.cal_end.selection_set(end_date)
+
+    def flush_log(self):
+        """Выводит в окно лога накопившиеся сообщения одной вставкой (вызывается по таймеру)"""
+        try:
+            self._log_sequence, dropped, lines = self.log_buffer.read_since(self._log_sequence)
+            if lines:
+                if dropped:
+                    lines.insert(0, f"⚠ Пропущено сообщений: {dropped}")
+                self.log_text.config(state=tk.NORMAL)
+                self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+                # В окне остаются только последние LOG_UI_MAX_LINES строк
+                excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - LOG_UI_MAX_LINES
+                if excess > 0:
+                    self.log_text.delete("1.0", f"{excess + 1}.0")
+                self.log_text.see(tk.END)
+                self.log_text.config(state=tk.DISABLED)
+        finally:
+            self.root.after(LOG_FLUSH_INTERVAL_MS, self.flush_log)
+
+    def set_log_level(self, event=None):
+        """Применяет выбранный уровень лога"""
+        logger.setLevel(LOG_LEVELS.get(self.log_level_var.get(), logging.INFO))
+
+    def toggle_log_file(self):
+        """Включает или выключает запись лога в файл LOG_FILE"""
+        if self.log_file_var.get() and self._log_file_handler is None:
+            try:
+                os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+                handler = RotatingFileHandler(
+                    LOG_FILE, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8"
+                )
+            except OSError as e:
+                self.log_file_var.set(False)
+                self.log_message(f"❌ Не удалось открыть файл лога {LOG_FILE}: {str(e)}")
+                return
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+            logger.addHandler(handler)
+            self._log_file_handler = handler
+            self.log_message(f"Лог записывается в файл: {LOG_FILE}")
+        elif not self.log_file_var.get() and self._log_file_handler is not None:
+            logger.removeHandler(self._log_file_handler)
+            self._log_file_handler.close()
+            self._log_file_handler = None
+
+    def run_in_ui(self, func, *args):
+        """Выполняет func в потоке UI (например, показ messagebox из фонового задания)"""
+        if threading.current_thread() is threading.main_thread():
+            func(*args)
+        else:
+            self.jobs.emit("call", func=func, args=args)
+
+    def start_job(self, job_name, target, on_done=None, total=0):
+        """Запускает фоновое задание, блокируя кнопки до его завершения"""
+        if self.jobs.is_running():
+            messagebox.showwarning("Ошибка", "Дождитесь завершения текущего задания или отмените его")
+            return False
+        self.set_busy(True)
+        self.trace_memory = self.trace_memory_var.get()
+        return self.jobs.start(job_name, lambda: self.measured(job_name, target), on_done, total)
+
+    def cancel_job(self):
+        """Обработчик кнопки отмены задания"""
+        if self.jobs.is_running():
+            self.log_message("Отмена задания...")
+            self.cancel_button.config(state=tk.DISABLED)
+            self.jobs.cancel()
+
+    def set_busy(self, busy):
+        """Блокирует кнопки действий на время фонового задания и восстанавливает их после"""
+        buttons = [
+            self.auth_button, self.report_button, self.export_button,
+            self.revenue_button, self.export_revenue_button, self.writeoff_button,
+            self.directories_button, self.snapshot_button
+        ]
+        if busy:
+            self._button_states = {button: str(button.cget("state")) for button in buttons}
+            for button in buttons:
+                button.config(state=tk.DISABLED)
+            self.cancel_button.config(state=tk.NORMAL)
+        else:
+            for button, state in self._button_states.items():
+                button.config(state=state)
+            self._button_states = {}
+            self.cancel_button.config(state=tk.DISABLED)
+
+    def handle_job_event(self, kind, data):
+        """Обрабатывает события фонового задания в потоке UI"""
+        state = self.progress_state
+        if kind == "call":
+            data["func"](*data["args"])
+            return
+        if kind == "job_started":
+            state.update(total=data["total"], finished=0, bytes=0, rows=0, active=set())
+            self.progress_bar.config(maximum=max(data["total"], 1), value=0)
+        elif kind == "base_started":
+            state["active"].add(data["base"])
+        elif kind == "base_finished":
+            state["active"].discard(data["base"])
+            state["finished"] += 1
+            self.progress_bar.config(value=state["finished"])
+        elif kind == "bytes":
+            state["bytes"] += data["count"]
+        elif kind == "rows":
+            state["rows"] += data["count"]
+        elif kind == "job_finished":
+            state["active"] = set()
+            self.set_busy(False)
+            if data["status"] == "cancelled":
+                self.log_message(f"⚠ Задание '{data['job']}' отменено")
+            elif data["status"] == "error":
+                self.log_message(f"❌ Ошибка: {data['result']}")
+        self.update_progress_label()
+
+    def update_progress_label(self):
+        """Обновляет строку состояния фонового задания"""
+        state = self.progress_state
+        text = (
+            f"Готово: {state['finished']}/{state['total']} | "
+            f"Получено: {state['bytes'] / (1024 * 1024):.1f} МБ | "
+            f"Строк: {state['rows']}"
+        )
+        if state["active"]:
+            text += f" | В работе: {', '.join(sorted(state['active']))}"
+        self.progress_label.config(text=text)
+
+    def auth(self):
+        """Параллельно авторизуется во всех базах конфигурации и прогревает соединения.
+
+        Полученные токены остаются в общем пуле подключений и используются последующими отчетами.
+        """
+        if not self.available_bases:
+            messagebox.showwarning("Ошибка", "Нет баз в конфигурации")
+            return
+        base_names = list(self.available_bases)
+        login = self.login_entry.get()
+        password = self.password_entry.get()
+        max_workers = self.get_max_workers()
+        self.log_message(f"Попытка авторизации в базах: {len(base_names)}...")
+
+        def authenticate(base_name):
+            client = CLIENT_POOL.get(self.available_bases[base_name]["url"], login, password)
+            was_cached = client.has_valid_token()
+            if not client.auth():
+                raise ReportFetchError("неверный логин или пароль")
+            return was_cached
+
+        def on_result(result):
+            if result.ok:
+                source = "токен из кэша" if result.data else f"{result.elapsed * 1000:.0f} мс"
+                self.log_message(f"✅ {result.base_name}: авторизация успешна ({source})")
+            else:
+                self.log_message(f"❌ {result.base_name}: ошибка авторизации: {result.error}")
+
+        def on_done(status, results):
+            if not results or status == "error":
+                return
+            for base_name, checkbutton in self.base_checkbuttons.items():
+                result = results.get(base_name)
+                if result is None:
+                    text = base_name
+                elif result.ok:
+                    text = f"{base_name}  ✅ {result.elapsed * 1000:.0f} мс"
+                else:
+                    text = f"{base_name}  ❌"
+                checkbutton.config(text=text)
+            ok_count = sum(1 for result in results.values() if result.ok)
+            self._auth_ok = ok_count > 0
+            if ok_count:
+                self.report_button.config(state=tk.NORMAL)
+                self.revenue_button.config(state=tk.NORMAL)
+                self.writeoff_button.config(state=tk.NORMAL)
+                self.log_message(f"✅ Авторизация успешна: {ok_count} из {len(base_names)} баз")
+            else:
+                self.log_message("❌ Не удалось авторизоваться ни в одной базе")
+
+        self.start_job(
+            "Авторизация",
+            lambda: self.run_parallel_fetch(base_names, authenticate, on_result, max_workers),
+            on_done,
+            total=len(base_names)
+        )
+
+    def get_max_workers(self):
+        """Возвращает допустимое число одновременно загружаемых баз"""
+        try:
+            return max(1, int(self.max_workers_var.get()))
+        except (tk.TclError, ValueError):
+            return DEFAULT_MAX_WORKERS
+
+    def toggle_warehouse_mode(self):
+        """В режиме хранилища кнопки отчетов доступны без авторизации"""
+        state = tk.NORMAL if self.warehouse_var.get() or self._auth_ok else tk.DISABLED
+        for button in (self.report_button, self.revenue_button, self.writeoff_button):
+            # Во время задания кнопки заблокированы: меняется состояние, которое будет восстановлено
+            if button in self._button_states:
+                self._button_states[button] = state
+            else:
+                button.config(state=state)
+
+    def get_report(self):
+        selected_bases = self.get_selected_bases()
+        if not selected_bases:
+            messagebox.showwarning("Ошибка", "Выберите хотя бы одну базу")
+            return
+        start_date, end_date = self.get_selected_dates()
+        login = self.login_entry.get()
+        password = self.password_entry.get()
+        max_workers = self.get_max_workers()
+        chunk_mode = self.get_chunk_mode()
+        bypass_cache = self.bypass_cache_var.get()
+        recheck_days = self.get_recheck_days()
+        from_warehouse = self.warehouse_var.get()
+        server_aggregation = self.server_aggregation_var.get()
+        self.log_message(f"Загрузка отчета за период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}")
+        self.log_chunk_mode(chunk_mode, start_date, end_date)
+        self.report_data = {}
+        self.export_button.config(state=tk.DISABLED)
+        pipeline = self.pipeline_var.get()
+        totals_mode = self.get_totals_mode()
+
+        def job():
+            if pipeline:
+                return self.build_plans_report(
+                    selected_bases, login, password, start_date, end_date, max_workers,
+                    chunk_mode, bypass_cache, recheck_days, from_warehouse, server_aggregation, totals_mode
+                )[0]
+            return self.fetch_plans(
+                selected_bases, login, password, start_date, end_date, max_workers,
+                chunk_mode, bypass_cache, recheck_days, from_warehouse, server_aggregation
+            )
+
+        def on_done(status, results):
+            if not results or status == "error":
+                return
+            self.report_data = self.plans_data(selected_bases, results)
+            if not pipeline:
+                self.log_fetch_summary(results, selected_bases)
+            if self.report_data:
+                self.export_button.config(state=tk.NORMAL)
+                if status == "cancelled":
+                    self.log_message(f"⚠ Загрузка прервана, сохранены данные {len(self.report_data)} баз")
+                else:
+                    self.log_message("✅ Все данные успешно загружены")
+            else:
+                self.log_message("❌ Не удалось получить данные ни из одной базы")
+
+        self.start_job("Планы", job, on_done, total=len(selected_bases))
+
+    def load_report_from_snapshots(self):
+        """Восстанавливает данные отчета "Планы" выбранных баз из архива снимков, без обращения к серверу"""
+        selected_bases = self.get_selected_bases()
+        if not selected_bases:
+            messagebox.showwarning("Ошибка", "Выберите хотя бы одну базу")
+            return
+        start_date, end_date = self.get_selected_dates()
+        server_aggregation = self.server_aggregation_var.get()
+        self.log_message(f"Загрузка 'Планы' из архива за период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}")
+        self.report_data = {}
+        self.export_button.config(state=tk.DISABLED)
+
+        def job():
+            loaded = {}
+            for base_name in selected_bases:
+                self.jobs.check_cancelled()
+                self.jobs.emit("base_started", base=base_name)
+                try:
+                    # Снимки пресета и отчета OLAP v2 не подменяют друг друга
+                    source_id = IikoOlapReporter.source_for(
+                        self.available_bases[base_name]["preset_id"], server_aggregation
+                    )
+                    meta = SNAPSHOTS.find_latest("plans", base_name, start_date, end_date, source_id)
+                    if meta is None:
+                        self.log_message(f"⚠ {base_name}: нет снимка за выбранный период")
+                        continue
+                    rows = list(SNAPSHOTS.iter_rows(meta['path']))
+                    loaded[base_name] = self.build_plan_columns(base_name, rows, start_date)
+                    self.jobs.emit("rows", base=base_name, count=len(rows))
+                    self.log_message(f"✅ {base_name}: снимок от {meta['created_at'][:19].replace('T', ' ')} (записей: {len(rows)})")
+                except (OSError, EOFError, ValueError) as e:
+                    self.log_message(f"❌ {base_name}: не удалось прочитать снимок: {str(e)}")
+                finally:
+                    self.jobs.emit("base_finished", base=base_name, ok=base_name in loaded)
+            return loaded
+
+        def on_done(status, loaded):
+            if status == "error" or not loaded:
+                self.log_message("❌ В архиве нет данных ни для одной базы")
+                return
+            self.report_data = loaded
+            self.export_button.config(state=tk.NORMAL)
+
+        self.start_job("Планы из архива", job, on_done, total=len(selected_bases))
+
+    def get_revenue_report(self):
+        selected_bases = self.get_selected_bases()
+        if not selected_bases:
+            messagebox.showwarning("Ошибка", "Выберите хотя бы одну базу")
+            return
+        start_date, end_date = self.get_selected_dates()
+        login = self.login_entry.get()
+        password = self.password_entry.get()
+        max_workers = self.get_max_workers()
+        chunk_mode = self.get_chunk_mode()
+        bypass_cache = self.bypass_cache_var.get()
+        recheck_days = self.get_recheck_days()
+        from_warehouse = self.warehouse_var.get()
+        server_aggregation = self.server_aggregation_var.get()
+        self.log_message(f"Загрузка отчета 'Выручка динамика' за период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}")
+        self.log_chunk_mode(chunk_mode, start_date, end_date)
+        self.revenue_data = {}
+        self.export_revenue_button.config(state=tk.DISABLED)
+        pipeline = self.pipeline_var.get()
+
+        def job():
+            if pipeline:
+                return self.build_revenue_report(
+                    selected_bases, login, password, start_date, end_date, max_workers,
+                    chunk_mode, bypass_cache, recheck_days, from_warehouse, server_aggregation
+                )[0]
+            return self.fetch_revenue(
+                selected_bases, login, password, start_date, end_date, max_workers,
+                chunk_mode, bypass_cache, recheck_days, from_warehouse, server_aggregation
+            )
+
+        def on_done(status, results):
+            if not results or status == "error":
+                return
+            self.revenue_data = self.successful_data(selected_bases, results)
+            if not pipeline:
+                self.log_fetch_summary(results, selected_bases)
+            if self.revenue_data:
+                self.export_revenue_button.config(state=tk.NORMAL)
+                if status == "cancelled":
+                    self.log_message(f"⚠ Загрузка прервана, сохранены данные 'Выручка динамика' {len(self.revenue_data)} баз")
+                else:
+                    self.log_message("✅ Все данные 'Выручка динамика' успешно загружены")
+            else:
+                self.log_message("❌ Не удалось получить данные 'Выручка динамика' ни из одной базы")
+
+        self.start_job("Выручка динамика", job, on_done, total=len(selected_bases))
+
+    def get_chunk_mode(self):
+        """Возвращает выбранный режим разбивки периода"""
+        return CHUNK_MODES.get(self.chunk_var.get(), "auto")
+
+    def get_totals_mode(self):
+        """Возвращает выбранный способ записи итогов в Excel-отчете "Планы" (по умолчанию формулы SUM)"""
+        return TOTALS_MODES.get(self.totals_var.get(), "sum")
+
+    def get_recheck_days(self):
+        """Возвращает запас дней инкрементального режима или None, если режим выключен"""
+        if not self.incremental_var.get():
+            return None
+        try:
+            return max(0, int(self.recheck_days_var.get()))
+        except (tk.TclError, ValueError):
+            return DEFAULT_RECHECK_DAYS
+
+    def get_selected_dates(self):
+        """Возвращает выбранные даты в формате datetime"""
+        start_date = datetime.strptime(self.cal_start.get_date(), '%d.%m.%Y')
+        end_date = datetime.strptime(self.cal_end.get_date(), '%d.%m.%Y')
+        return start_date, end_date
+
+    def export_to_excel(self):
+        if not self.report_data:
+            messagebox.showwarning("Ошибка", "Нет данных для экспорта")
+            return
+        start_date, end_date = self.get_selected_dates()
+        totals_mode = self.get_totals_mode()
+        self.start_job(
+            "Экспорт Планы",
+            lambda: self._export_plans(start_date, end_date, totals_mode),
+            total=len(self.report_data)
+        )
+
+    def export_revenue_to_excel(self):
+        if not self.revenue_data:
+            messagebox.showwarning("Ошибка", "Нет данных для экспорта")
+            return
+        start_date, end_date = self.get_selected_dates()
+        self.start_job(
+            "Экспорт Выручка динамика",
+            lambda: self._export_revenue(start_date, end_date),
+            total=len(self.revenue_data)
+        )
+
+    def get_writeoff_report(self):
+        selected_bases = self.get_selected_bases()
+        if not selected_bases:
+            messagebox.showwarning("Ошибка", "Выберите хотя бы одну базу")
+            return
+        start_date, end_date = self.get_selected_dates()
+        login = self.login_entry.get()
+        password = self.password_entry.get()
+        max_workers = self.get_max_workers()
+        from_warehouse = self.warehouse_var.get()
+        chunk_mode = self.get_chunk_mode()
+        self.log_message(f"Загрузка актов списания за период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}")
+        if not from_warehouse:
+            self.log_chunk_mode(chunk_mode, start_date, end_date, cached=False)
+        self.start_job(
+            "Акты списания",
+            lambda: self._build_writeoff_report(
+                selected_bases, login, password, start_date, end_date, max_workers, from_warehouse,
+                chunk_mode=chunk_mode
+            ),
+            total=len(selected_bases)
+        )
+
+    def invalidate_directories(self):
+        """Сбрасывает кэш справочников выбранных баз: следующий отчет загрузит их с сервера"""
+        selected_bases = self.get_selected_bases()
+        if not selected_bases:
+            messagebox.showwarning("Ошибка", "Выберите хотя бы одну базу")
+            return
+        removed = self.clear_directory_cache(selected_bases)
+        self.log_message(f"✅ Кэш справочников сброшен (баз: {len(selected_bases)}, записей: {removed})")
+
+
+class IikoClient:
+    """Подключение к одной базе iiko: общий пул соединений хоста и кэшированный токен.
+
+    Повторная авторизация выполняется только когда токена нет, он устарел или отклонен сервером.
+    """
+
+    def __init__(self, base_url, login, password, session):
+        self.base_url = base_url.rstrip('/')
+        self.login = login
+        self.password = password
+        self.session = session
+        self.token = None
+        self.token_time = 0.0  # Время последнего успешного обращения с текущим токеном
+        self.request_seconds = 0.0  # Суммарное ожидание ответа сервера (до заголовков) для метрик этапов
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def has_valid_token(self):
+        return bool(self.token) and time.monotonic() - self.token_time < TOKEN_TTL_SECONDS
+
+    def auth(self, force=False):
+        """Авторизация в системе; при наличии действующего токена запрос не выполняется"""
+        with self._lock:
+            if not force and self.has_valid_token():
+                return True
+            password_hash = hashlib.sha1(self.password.encode()).hexdigest()
+            data = {
+                'login': self.login,
+                'pass': password_hash
+            }
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+            response = self.session.post(f"{self.base_url}/auth", data=data, headers=headers, timeout=REQUEST_TIMEOUT)
+            if response.status_code == 200:
+                self.token = response.text.strip()
+                self.token_time = time.monotonic()
+                return True
+            self.token = None
+            return False
+
+    def _invalidate(self, token):
+        """Сбрасывает токен, если его еще не заменил другой поток"""
+        with self._lock:
+            if self.token == token:
+                self.token = None
+
+    def stream_json(self, path, params=None, key=None, cancel_event=None, on_bytes=None, json_body=None):
+        """GET-запрос к API с ключом авторизации; возвращает итератор элементов массива ответа.
+
+        key - поле объекта ответа, содержащее массив (None - массив на верхнем уровне);
+        json_body - тело JSON, с ним выполняется POST-запрос (отчеты OLAP v2).
+        Если сервер отклонил ключ, выполняет повторную авторизацию и повторяет запрос один раз.
+        """
+        for attempt in range(2):
+            if not self.auth():
+                return None
+            token = self.token
+            request_params = dict(params or {})
+            request_params['key'] = token
+            started = time.perf_counter()
+            try:
+                items = open_json_stream(
+                    self.session, f"{self.base_url}{path}", request_params, key, cancel_event, on_bytes, json_body
+                )
+            except TokenRejectedError:
+                self._invalidate(token)
+                continue
+            finally:
+                with self._stats_lock:
+                    self.request_seconds += time.perf_counter() - started
+            with self._lock:
+                self.token_time = time.monotonic()
+            return items
+        return None
+
+    def logout(self):
+        """Освобождает лицензию iiko, занятую токеном"""
+        with self._lock:
+            token, self.token = self.token, None
+        if not token:
+            return
+        try:
+            self.session.get(f"{self.base_url}/logout", params={'key': token}, timeout=(5, 10))
+        except Exception as e:
+            # При воспроизведении кассеты модуль requests не загружается - перехватываем любые ошибки
+            logger.warning(f"⚠ Ошибка выхода из {self.base_url}: {str(e)}")
+
+
+class HttpCassette:
+    """Кассета HTTP-обменов с серверами iiko: запись ответов и их воспроизведение без сети.
+
+    Файл - gzip JSON Lines, каждый обмен дописывается отдельным gzip-блоком, поэтому кассета
+    остается читаемой, даже если запись прервана. Обмен хранит метод, адрес, параметры запроса,
+    статус, время до заголовков ответа, тело и моменты получения его порций. Ключ авторизации,
+    логин и хэш пароля в кассету не попадают, токен в ответе /auth заменяется на CASSETTE_TOKEN.
+
+    mode="record" - запросы выполняются на сервере и записываются (файл создается заново);
+    mode="replay" - ответы берутся из файла: timing="original" выдерживает записанные задержки,
+    "max" отдает ответы сразу. Одинаковые запросы воспроизводятся в порядке записи, после
+    последнего повторяется последний записанный ответ.
+    """
+
+    def __init__(self, path, mode="replay", timing="max"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Неизвестный режим кассеты: {mode}")
+        if timing not in REPLAY_TIMINGS:
+            raise ValueError(f"Неизвестная скорость воспроизведения: {timing}")
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self.recorded = 0  # Обменов записано (запись) или выдано (воспроизведение)
+        self.missed = 0  # Запросов, которых нет в кассете
+        self._interactions = defaultdict(deque)
+        self._lock = threading.Lock()
+        if mode == "record":
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            with open(path, "wb"):
+                pass
+        else:
+            self._load()
+
+    @staticmethod
+    def request_key(method, url, params=None):
+        """Ключ сопоставления запроса: метод, адрес и параметры без секретов"""
+        safe_params = sorted(
+            (str(name), str(value)) for name, value in (params or {}).items()
+            if name not in CASSETTE_SECRET_PARAMS
+        )
+        return json.dumps([method.upper(), url.rstrip('/'), safe_params], ensure_ascii=False)
+
+    @staticmethod
+    def request_params(params, kwargs):
+        """Параметры запроса для кассеты: параметры адреса, поля формы и тело JSON"""
+        request_params = dict(params or {})
+        if isinstance(kwargs.get('data'), dict):
+            request_params.update(kwargs['data'])
+        if kwargs.get('json') is not None:
+            request_params['json'] = json.dumps(kwargs['json'], ensure_ascii=False, sort_keys=True)
+        return request_params
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                interaction = json.loads(line)
+                if interaction.get('cassette') != CASSETTE_FORMAT_VERSION:
+                    raise ValueError(f"Неподдерживаемая версия кассеты: {interaction.get('cassette')}")
+                # Тела хранятся сжатыми и распаковываются при выдаче ответа
+                interaction['body'] = zlib.compress(interaction['body'].encode("utf-8", "surrogateescape"), 1)
+                self._interactions[interaction['key']].append(interaction)
+
+    def wrap(self, session):
+        """Сессия для пула соединений: записывающая обертка над session или воспроизводящая сессия"""
+        if self.mode == "record":
+            return RecordingSession(session, self)
+        return ReplaySession(self)
+
+    def record(self, method, url, params, status, headers_seconds, body, chunks):
+        """Дописывает обмен в файл кассеты"""
+        if url.rstrip('/').endswith("/auth") and status == 200:
+            body = CASSETTE_TOKEN.encode("utf-8")
+            chunks = []
+        interaction = {
+            'cassette': CASSETTE_FORMAT_VERSION,
+            'key': self.request_key(method, url, params),
+            'status': status,
+            'headers_seconds': round(headers_seconds, 6),
+            'chunks': [[round(offset, 6), length] for offset, length in chunks],
+            # surrogateescape сохраняет и тела, которые не являются корректным UTF-8
+            'body': body.decode("utf-8", "surrogateescape"),
+        }
+        line = json.dumps(interaction, ensure_ascii=False, separators=(',', ':')) + "\n"
+        data = gzip.compress(line.encode("utf-8", "surrogateescape"))
+        with self._lock:
+            with open(self.path, "ab") as f:
+                f.write(data)
+            self.recorded += 1
+
+    def take(self, method, url, params):
+        """Следующий записанный обмен для запроса; None, если такого запроса в кассете нет"""
+        key = self.request_key(method, url, params)
+        with self._lock:
+            interactions = self._interactions.get(key)
+            if not interactions:
+                self.missed += 1
+                return None
+            self.recorded += 1
+            return interactions.popleft() if len(interactions) > 1 else interactions[0]
+
+
+class RecordingSession:
+    """Обертка над сессией requests: выполняет запросы и записывает обмены в кассету"""
+
+    def __init__(self, session, cassette):
+        self.session = session
+        self.cassette = cassette
+
+    def _request(self, method, url, params=None, stream=False, **kwargs):
+        started = time.perf_counter()
+        send = self.session.get if method == "GET" else self.session.post
+        response = send(url, params=params, stream=stream, **kwargs)
+        headers_seconds = time.perf_counter() - started
+        # Тело /auth передается формой, логин и хэш пароля отбрасываются вместе с остальными секретами
+        record_params = HttpCassette.request_params(params, kwargs)
+        if stream:
+            return RecordingResponse(response, self.cassette, method, url, record_params, headers_seconds)
+        self.cassette.record(method, url, record_params, response.status_code, headers_seconds, response.content, [])
+        return response
+
+    def get(self, url, params=None, **kwargs):
+        return self._request("GET", url, params, **kwargs)
+
+    def post(self, url, params=None, **kwargs):
+        return self._request("POST", url, params, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class RecordingResponse:
+    """Потоковый ответ, порции которого копируются в кассету; обмен записывается при закрытии"""
+
+    def __init__(self, response, cassette, method, url, params, headers_seconds):
+        self.response = response
+        self.status_code = response.status_code
+        self._cassette = cassette
+        self._request = (method, url, params)
+        self._headers_seconds = headers_seconds
+        self._started = time.perf_counter()
+        self._body = bytearray()
+        self._chunks = []
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for chunk in self.response.iter_content(chunk_size=chunk_size, decode_unicode=decode_unicode):
+            self._body.extend(chunk)
+            self._chunks.append((time.perf_counter() - self._started, len(chunk)))
+            yield chunk
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            method, url, params = self._request
+            try:
+                self._cassette.record(
+                    method, url, params, self.status_code, self._headers_seconds, bytes(self._body), self._chunks
+                )
+            except OSError as e:
+                logger.error(f"❌ Не удалось записать обмен в кассету {self._cassette.path}: {str(e)}")
+            self._body = bytearray()
+        self.response.close()
+
+
+class ReplaySession:
+    """Сессия, отвечающая на запросы из кассеты без обращения к сети"""
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+
+    def _request(self, method, url, params=None, **kwargs):
+        interaction = self.cassette.take(method, url, HttpCassette.request_params(params, kwargs))
+        if interaction is None:
+            logger.warning(f"⚠ Запроса нет в кассете {self.cassette.path}: {method} {url}")
+            return ReplayResponse({'status': 404, 'headers_seconds': 0, 'chunks': [], 'body': zlib.compress(b"")}, False)
+        realtime = self.cassette.timing == "original"
+        if realtime and interaction['headers_seconds']:
+            time.sleep(interaction['headers_seconds'])
+        return ReplayResponse(interaction, realtime)
+
+    def get(self, url, params=None, **kwargs):
+        return self._request("GET", url, params, **kwargs)
+
+    def post(self, url, params=None, **kwargs):
+        return self._request("POST", url, params, **kwargs)
+
+    def close(self):
+        pass
+
 
-    def get_selected_bases(self):
-        """Возвращает список выбранных баз"""
-        return [base_name for base_name, var in self.base_vars.items() if var.get()]
+class ReplayResponse:
+    """Ответ из кассеты с интерфейсом ответа requests, который используют клиенты"""
 
-    def update_period(self, event=None):
-        """Обновляет даты в календаре в зависимости от выбранного периода"""
-        today = datetime.now()
-        period = self.period_combobox.get()
-        
-        if period == "Сегодня":
-            start_date = today
-            end_date = today
-        elif period == "Вчера":
-            start_date = today - timedelta(days=1)
-            end_date = today - timedelta(days=1)
-        elif period == "Текущая неделя":
-            start_date = today - timedelta(days=today.weekday())
-            end_date = start_date + timedelta(days=6)
-        elif period == "Прошлая неделя":
-            start_date = today - timedelta(days=today.weekday() + 7)
-            end_date = start_date + timedelta(days=6)
-        elif period == "Текущий месяц":
-            start_date = today.replace(day=1)
-            end_date = (today.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
-        elif period == "Прошлый месяц":
-            start_date = (today.replace(day=1) - timedelta(days=1)).replace(day=1)
-            end_date = today.replace(day=1) - timedelta(days=1)
-        elif period == "Текущий год":
-            start_date = today.replace(month=1, day=1)
-            end_date = today.replace(month=12, day=31)
-        elif period == "Прошлый год":
-            start_date = today.replace(year=today.year-1, month=1, day=1)
-            end_date = today.replace(year=today.year-1, month=12, day=31)
-        else:  # "Другой..."
+    def __init__(self, interaction, realtime):
+        self.status_code = interaction['status']
+        self.content = zlib.decompress(interaction['body'])
+        self._chunks = interaction['chunks']
+        self._realtime = realtime
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        """Тело порциями записанного размера; в режиме original - в записанные моменты времени"""
+        if not self._chunks:
+            step = chunk_size or DOWNLOAD_CHUNK_SIZE
+            for start in range(0, len(self.content), step):
+                yield self.content[start:start + step]
             return
-        
-        self.cal_start.selection_set(start_date)
-        self.cal_end.selection_set(end_date)
+        started = time.perf_counter()
+        position = 0
+        for offset, length in self._chunks:
+            if self._realtime:
+                delay = offset - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            yield self.content[position:position + length]
+            position += length
 
-    def log_message(self, message):
-        self.log_text.config(state=tk.NORMAL)
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
-        self.log_text.config(state=tk.DISABLED)
+    def close(self):
+        pass
 
-    def auth(self):
-        self.log_message("Попытка авторизации...")
-        self.report_button.config(state=tk.NORMAL)
-        self.revenue_button.config(state=tk.NORMAL)
-        self.writeoff_button.config(state=tk.NORMAL)
-        self.log_message("✅ Авторизация успешна")
 
-    def get_report(self):
+class IikoClientPool:
+    """Реестр подключений: один IikoClient на адрес базы и учетные данные, одна сессия requests на хост"""
+
+    def __init__(self, pool_size=CONNECTION_POOL_SIZE):
+        self.pool_size = pool_size
+        self.cassette = None  # HttpCassette; задана - запросы записываются в нее или воспроизводятся из нее
+        self._clients = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def use_cassette(self, cassette):
+        """Включает запись или воспроизведение обменов для всех новых подключений (None - выключает)"""
+        self.logout_all()
+        self.cassette = cassette
+
+    def _session_for(self, base_url):
+        """Возвращает keep-alive сессию для хоста базы"""
+        host = urlsplit(base_url).netloc
+        session = self._sessions.get(host)
+        if session is None:
+            if self.cassette is not None and self.cassette.mode == "replay":
+                # Воспроизведение не обращается к сети и не загружает requests
+                session = self.cassette.wrap(None)
+                self._sessions[host] = session
+                return session
+            load_http_modules()
+            session = requests.Session()
+            session.verify = False
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if self.cassette is not None:
+                session = self.cassette.wrap(session)
+            self._sessions[host] = session
+        return session
+
+    def get(self, base_url, login, password):
+        """Возвращает общий клиент для базы, создавая его при первом обращении"""
+        # В пакетном режиме с --from-warehouse логин и пароль могут быть не заданы
+        key = (base_url.rstrip('/'), login, hashlib.sha1((password or "").encode()).hexdigest())
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = IikoClient(base_url, login, password, self._session_for(base_url))
+                self._clients[key] = client
+            return client
+
+    def logout_all(self):
+        """Завершает все сессии iiko (вызывается при закрытии приложения)"""
+        with self._lock:
+            clients = list(self._clients.values())
+            sessions = list(self._sessions.values())
+            self._clients = {}
+            self._sessions = {}
+        active = [client for client in clients if client.token]
+        if active:
+            with ThreadPoolExecutor(max_workers=min(len(active), DEFAULT_MAX_WORKERS)) as executor:
+                list(executor.map(IikoClient.logout, active))
+        for session in sessions:
+            session.close()
+
+
+# Общий пул подключений для всех отчетов приложения
+CLIENT_POOL = IikoClientPool()
+
+
+class OlapResponseCache:
+    """Дисковый кэш строк OLAP-пресетов с ключом (адрес базы, пресет, окно дат).
+
+    Данные закрытого окна (загруженные после его окончания) не устаревают, данные окна,
+    включающего текущий день, живут today_ttl секунд. При превышении max_bytes удаляются
+    давно не использованные записи.
+    """
+
+    # Время загрузки в начале записи: поля окна записываются перед строками
+    _fetched_at = re.compile(r'"fetched_at":\s*([0-9.eE+\-]+)')
+
+    def __init__(self, cache_dir=None, max_bytes=CACHE_MAX_BYTES, today_ttl=CACHE_TODAY_TTL_SECONDS):
+        self.cache_dir = cache_dir or os.path.join(APP_DATA_DIR, "olap_cache")
+        self.max_bytes = max_bytes
+        self.today_ttl = today_ttl
+        self._size = None  # Текущий размер кэша, вычисляется при первой записи
+        self._lock = threading.Lock()
+
+    def _path(self, base_url, preset_id, date_from, date_to):
+        window = f"{date_from.strftime('%Y-%m-%d')}|{date_to.strftime('%Y-%m-%d')}"
+        key = hashlib.sha1(f"{base_url.rstrip('/')}|{preset_id}|{window}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json.gz")
+
+    def _is_fresh(self, entry, date_to):
+        """Проверяет, можно ли использовать запись кэша"""
+        fetched_at = entry.get('fetched_at', 0)
+        window_end = datetime(date_to.year, date_to.month, date_to.day) + timedelta(days=1)
+        if fetched_at >= window_end.timestamp():
+            return True
+        return time.time() - fetched_at < self.today_ttl
+
+    def contains(self, base_url, preset_id, date_from, date_to):
+        """Проверяет, есть ли в кэше свежая запись окна (читается только начало записи)"""
+        path = self._path(base_url, preset_id, date_from, date_to)
         try:
-            selected_bases = self.get_selected_bases()
-            if not selected_bases:
-                messagebox.showwarning("Ошибка", "Выберите хотя бы одну базу")
-                return
-            start_date, end_date = self.get_selected_dates()
-            self.log_message(f"Загрузка отчета за период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}")
-            self.report_data = {}
-            login = self.login_entry.get()
-            password = self.password_entry.get()
-            for base_name in selected_bases:
-                self.log_message(f"Получение данных из базы: {base_name}...")
-                base_info = self.available_bases[base_name]
-                reporter = IikoOlapReporter(base_info["url"], login, password, base_info["preset_id"])
-                if reporter.auth():
-                    data = reporter.get_olap_report(start_date, end_date)
-                    if data:
-                        self.log_message(f"Получены данные из {base_name}")
-                        # Добавляем лог структуры данных для отладки
-                        self.log_message(f"Структура данных: {str(type(data))}, keys: {str(data.keys()) if isinstance(data, dict) else 'not dict'}")
-                        self.log_message(f"Структура данных {base_name}: {str(data)[:500]}")
-                        # Сохранить данные для дальнейшего анализа
-                        with open(f"{base_name}_data.json", "w", encoding="utf-8") as f:
-                            json.dump(data, f, ensure_ascii=False, indent=4)
-                        normalized_data = self.normalize_report_data(data)
-                        if normalized_data:
-                            self.report_data[base_name] = normalized_data
-                            self.log_message(f"✅ Данные из {base_name} успешно обработаны (записей: {len(normalized_data)})")
-                        else:
-                            self.log_message(f"❌ Не удалось нормализовать данные из {base_name}")
-                    else:
-                        self.log_message(f"❌ Не удалось получить данные из {base_name}")
-                else:
-                    self.log_message(f"❌ Ошибка авторизации в базе {base_name}")
-            if self.report_data:
-                self.export_button.config(state=tk.NORMAL)
-                self.log_message("✅ Все данные успешно загружены")
-            else:
-                self.log_message("❌ Не удалось получить данные ни из одной базы")
-        except Exception as e:
-            self.log_message(f"❌ Ошибка: {str(e)}")
-            import traceback
-            self.log_message(traceback.format_exc())
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                match = self._fetched_at.search(f.read(4096))
+        except (OSError, EOFError, ValueError):
+            return False
+        return match is not None and self._is_fresh({'fetched_at': float(match.group(1))}, date_to)
 
-    def get_revenue_report(self):
+    def get(self, base_url, preset_id, date_from, date_to):
+        """Возвращает строки окна из кэша или None, если записи нет или она устарела"""
+        path = self._path(base_url, preset_id, date_from, date_to)
         try:
-            selected_bases = self.get_selected_bases()
-            if not selected_bases:
-                messagebox.showwarning("Ошибка", "Выберите хотя бы одну базу")
-                return
-            start_date, end_date = self.get_selected_dates()
-            self.log_message(f"Загрузка отчета 'Выручка динамика' за период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}")
-            self.revenue_data = {}
-            login = self.login_entry.get()
-            password = self.password_entry.get()
-            for base_name in selected_bases:
-                self.log_message(f"Получение данных 'Выручка динамика' из базы: {base_name}...")
-                base_info = self.available_bases[base_name]
-                reporter = IikoRevenueReporter(base_info["url"], login, password, base_info["revenue_preset_id"])
-                if reporter.auth():
-                    data = reporter.get_olap_report(start_date, end_date)
-                    if data:
-                        self.log_message(f"Получены данные 'Выручка динамика' из {base_name}")
-                        processed_data = reporter.process_report_data(data)
-                        if processed_data and processed_data.get('has_data'):
-                            self.revenue_data[base_name] = processed_data
-                            self.log_message(f"✅ Данные 'Выручка динамика' из {base_name} успешно обработаны")
-                        else:
-                            self.log_message(f"❌ Не удалось обработать данные 'Выручка динамика' из {base_name}")
-                    else:
-                        self.log_message(f"❌ Не удалось получить данные 'Выручка динамика' из {base_name}")
-                else:
-                    self.log_message(f"❌ Ошибка авторизации в базе {base_name}")
-            if self.revenue_data:
-                self.export_revenue_button.config(state=tk.NORMAL)
-                self.log_message("✅ Все данные 'Выручка динамика' успешно загружены")
-            else:
-                self.log_message("❌ Не удалось получить данные 'Выручка динамика' ни из одной базы")
-        except Exception as e:
-            self.log_message(f"❌ Ошибка: {str(e)}")
-            import traceback
-            self.log_message(traceback.format_exc())
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError):
+            # Поврежденная запись - удаляем и загружаем заново
+            self._remove(path)
+            return None
+        if not self._is_fresh(entry, date_to):
+            return None
+        try:
+            os.utime(path)  # Отмечаем использование для вытеснения по давности
+        except OSError:
+            pass
+        return entry.get('data', [])
 
-    def get_selected_dates(self):
-        """Возвращает выбранные даты в формате datetime"""
-        start_date = datetime.strptime(self.cal_start.get_date(), '%d.%m.%Y')
-        end_date = datetime.strptime(self.cal_end.get_date(), '%d.%m.%Y')
-        return start_date, end_date
+    def iter_rows(self, base_url, preset_id, date_from, date_to):
+        """Как get, но строки окна разбираются из записи потоково: итератор строк или None"""
+        if not self.contains(base_url, preset_id, date_from, date_to):
+            return None
+        path = self._path(base_url, preset_id, date_from, date_to)
+        try:
+            f = gzip.open(path, "rb")
+            os.utime(path)
+        except OSError:
+            return None
+        return self._read_rows(f, path)
 
-    def normalize_report_data(self, data):
-        """Нормализует данные отчета для корректного создания DataFrame"""
-        if isinstance(data, dict):
-            # Проверяем наличие ключей с данными
-            for key in ['records', 'data', 'report']:
-                if key in data and isinstance(data[key], list):
-                    return data[key]
-            # Если не нашли массив, проверяем наличие других возможных ключей
-            if 'result' in data and isinstance(data['result'], list):
-                return data['result']
-            # Если ничего не найдено, возвращаем весь словарь как список из одного элемента
-            return [data]
-        elif isinstance(data, list):
-            return data
-        else:
-            return []
+    def _read_rows(self, f, path):
+        try:
+            with f:
+                yield from JsonArrayStream(iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""), 'data')
+        except (OSError, EOFError, ValueError):
+            # Поврежденная запись - удаляем, чтобы следующая загрузка получила окно заново
+            self._remove(path)
+            raise
 
-    def export_to_excel(self):
+    def put(self, base_url, preset_id, date_from, date_to, rows):
+        """Сохраняет строки окна в кэш"""
+        for _ in self.put_stream(base_url, preset_id, date_from, date_to, rows):
+            pass
+
+    def put_stream(self, base_url, preset_id, date_from, date_to, rows):
+        """Передает строки итератора rows дальше и записывает их в кэш по мере чтения.
+
+        Строки не накапливаются в памяти; запись появляется в кэше, только когда итератор
+        прочитан полностью (при ошибке или прерванном чтении временный файл удаляется).
+        """
+        path = self._path(base_url, preset_id, date_from, date_to)
+        header = {
+            'base_url': base_url,
+            'preset_id': preset_id,
+            'date_from': date_from.strftime('%Y-%m-%d'),
+            'date_to': date_to.strftime('%Y-%m-%d'),
+            'fetched_at': time.time()
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        complete = False
         try:
-            if not self.report_data:
-                messagebox.showwarning("Ошибка", "Нет данных для экспорта")
-                return
-            
-            start_date, end_date = self.get_selected_dates()
-            start_date_str = start_date.strftime('%d.%m.%Y')
-            end_date_str = end_date.strftime('%d.%m.%Y')
-            current_date = datetime.now().strftime('%Y-%m-%d_%H-%M')
-            # Пробуем несколько путей для сохранения
-            save_paths = [
-                os.path.join(os.path.expanduser("~"), "Documents"),
-                os.path.join(os.path.expanduser("~"), "Desktop"),
-                tempfile.gettempdir()
-            ]
-            for save_dir in save_paths:
-                try:
-                    filename = os.path.join(save_dir, f"OLAP-Планы {start_date_str}-{end_date_str} ({current_date}).xlsx")
-                    self.log_message(f"Попытка сохранения в: {filename}")
-                    # Проверяем доступность директории
-                    if not os.path.exists(save_dir):
-                        os.makedirs(save_dir)
-                    wb = Workbook()
-                    if 'Sheet' in wb.sheetnames:
-                        del wb['Sheet']
-                    start_date, end_date = self.get_selected_dates()
-                    for base_name, data in self.report_data.items():
-                        if not data:
-                            self.log_message(f"Нет данных для {base_name}")
-                            continue
-                        try:
-                            ws = wb.create_sheet(title=base_name[:31])
-                            # Заголовки
-                            ws['A1'] = "Планы"
-                            ws['A1'].font = Font(bold=True, size=14)
-                            ws.merge_cells('A1:G1')
-                            ws['A2'] = f"Название ресторана: {base_name}"
-                            ws['A3'] = f"Период: с {start_date.strftime('%d.%m.%Y')} по {end_date.strftime('%d.%m.%Y')}"
-                            # Заголовки столбцов
-                            headers = ["Группа", "Неделя", "День недели", "Итого", 
-                                    "Гости", "Блюда", "Чеки"]
-                            for col, header in enumerate(headers, 1):
-                                ws.cell(row=5, column=col, value=header).font = Font(bold=True)
-                                ws.column_dimensions[get_column_letter(col)].width = 15
-                            # Сортируем данные сначала по группе, затем по неделе и дню
-                            sorted_data = sorted(data, key=lambda x: (
-                                x.get('RestorauntGroup', ''),
-                                int(x.get('WeekInMonthOpen', 1) or 1),  # Безопасное преобразование
-                                int(x.get('DayOfWeekOpen', '1. Понедельник').split('.')[0] or 1)  # Безопасное преобразование
-                            ))
-                            # Заполняем данные
-                            row_num = 6
-                            current_group = None
-                            current_week = None
-                            group_start_row = 6
-                            week_start_row = 6
-                            group_data = []  # Для хранения данных группы
-                            
-                            # Обработка каждой записи
-                            for record in sorted_data:
-                                # Обработка для базы "Казань 1, 2, 3 СХ Железногорск Брянск"
-                                if base_name == "Казань 1, 2, 3 СХ Железногорск Брянск":
-                                    # Для базы "Казань 1, 2, 3 СХ Железногорск Брянск" вычисляем недели и дни
-                                    if 'WeekInMonthOpen' not in record or not record['WeekInMonthOpen']:
-                                        record['WeekInMonthOpen'] = self._get_week_number(record['OpenDate.Typed'], start_date)
-                                    if 'DayOfWeekOpen' not in record or not record['DayOfWeekOpen']:
-                                        date = datetime.strptime(record['OpenDate.Typed'], '%Y-%m-%dT%H:%M:%S')
-                                        day_num = date.weekday() + 1  # Нумерация дней недели с 1 (понедельник)
-                                        day_name = self._get_day_name(day_num)
-                                        record['DayOfWeekOpen'] = f"{day_num}. {day_name}"
-                                
-                                # Обработка для базы "СХ Орел" - проверяем наличие нужных полей
-                                if base_name == "СХ Орел":
-                                    # Для базы "СХ Орел" проверяем и корректируем поля
-                                    if 'WeekInMonthOpen' not in record or not record['WeekInMonthOpen']:
-                                        record['WeekInMonthOpen'] = '1'  # Установим значение по умолчанию
-                                    if 'DayOfWeekOpen' not in record or not record['DayOfWeekOpen']:
-                                        record['DayOfWeekOpen'] = '1. Понедельник'  # Установим значение по умолчанию
-                                
-                                group = record.get('RestorauntGroup', '')
-                                week_num = int(record.get('WeekInMonthOpen', 1) or 1)
-                                day_str = record.get('DayOfWeekOpen', '1. Понедельник')
-                                
-                                # Парсим день недели
-                                day_parts = day_str.split('. ')
-                                day_num = int(day_parts[0]) if day_parts and day_parts[0] else 1
-                                day_name = day_parts[1] if len(day_parts) > 1 else "Понедельник"
-                                
-                                self.log_message(f"Обработка записи: Группа={group}, Неделя={week_num}, День={day_name}")
-                                
-                                # Если новая группа
-                                if group != current_group:
-                                    if current_group is not None:
-                                        # Добавляем итог по последней неделе предыдущей группы
-                                        self._add_week_total(ws, week_start_row, row_num-1, current_week)
-                                        row_num += 1
-                                        # Добавляем итог по всей группе
-                                        self._add_group_total(ws, group_start_row, row_num-1, current_group)
-                                        row_num += 1
-                                    current_group = group
-                                    current_week = week_num
-                                    group_start_row = row_num
-                                    week_start_row = row_num
-                                    group_data = []
-                                    # Записываем название группы
-                                    ws.cell(row=row_num, column=1, value=group)
-                                    row_num += 1
-                                    week_start_row = row_num
-                                # Если новая неделя в текущей группе
-                                elif week_num != current_week:
-                                    # Добавляем итог по предыдущей неделе
-                                    self._add_week_total(ws, week_start_row, row_num-1, current_week)
-                                    row_num += 1
-                                    current_week = week_num
-                                    week_start_row = row_num
-                                # Записываем данные дня
-                                ws.cell(row=row_num, column=1, value="")  # Пусто под названием группы
-                                ws.cell(row=row_num, column=2, value=week_num)
-                                ws.cell(row=row_num, column=3, value=f"{day_num}. {day_name}")
-                                ws.cell(row=row_num, column=4, value=record.get('DishDiscountSumInt', 0))
-                                ws.cell(row=row_num, column=5, value=record.get('GuestNum', 0))
-                                ws.cell(row=row_num, column=6, value=record.get('DishAmountInt', 0))
-                                ws.cell(row=row_num, column=7, value=record.get('UniqOrderId', 0))
-                                row_num += 1
-                                
-                            # Добавляем итоги для последней недели и группы
-                            if current_week is not None:
-                                self._add_week_total(ws, week_start_row, row_num-1, current_week)
-                                row_num += 1
-                            if current_group is not None:
-                                self._add_group_total(ws, group_start_row, row_num-1, current_group)
-                        except Exception as e:
-                            self.log_message(f"Ошибка в {base_name}: {str(e)}")
-                            continue
-                    # Сохраняем файл
-                    wb.save(filename)
-                    self.log_message(f"✅ Отчет успешно сохранен в: {filename}")
-                    # Открываем файл
-                    if os.name == 'nt':
-                        os.startfile(filename)
-                    return  # Успешно сохранили
-                except PermissionError as e:
-                    self.log_message(f"Ошибка доступа: {str(e)}")
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                f.write(json.dumps(header, ensure_ascii=False, separators=(',', ':'))[:-1] + ',"data":[')
+                separator = ''
+                for row in rows:
+                    f.write(separator + json.dumps(row, ensure_ascii=False, separators=(',', ':')))
+                    separator = ','
+                    yield row
+                f.write(']}')
+            complete = True
+        finally:
+            if not complete:
+                self._remove(tmp_path)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += os.path.getsize(path) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        """Возвращает список (время использования, размер, путь) всех записей кэша"""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith(".json.gz"):
                     continue
-                except Exception as e:
-                    self.log_message(f"Ошибка: {str(e)}")
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
                     continue
-            # Если все попытки неудачны
-            self.log_message("❌ Не удалось сохранить отчет ни в одну из папок")
-            messagebox.showerror("Ошибка", "Не удалось сохранить отчет. Проверьте права доступа.")
-        except Exception as e:
-            self.log_message(f"Критическая ошибка: {str(e)}")
-            messagebox.showerror("Ошибка", f"Ошибка: {str(e)}")
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
 
-    def export_revenue_to_excel(self):
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """Удаляет давно не использованные записи, пока кэш не уменьшится до 90% предела"""
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(self._entries()):
+            if self._size <= target:
+                break
+            if self._remove(path):
+                self._size -= size
+
+    @staticmethod
+    def _remove(path):
         try:
-            if not self.revenue_data:
-                messagebox.showwarning("Ошибка", "Нет данных для экспорта")
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+class IncrementalState:
+    """Последний успешно загруженный день по каждой паре (адрес базы, пресет).
+
+    Хранится в JSON-файле и используется инкрементальным режимом, чтобы перезагружать только
+    дни начиная с последнего загруженного (с запасом на поздние правки).
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(APP_DATA_DIR, "incremental_state.json")
+        self._lock = threading.Lock()
+        self._state = None
+
+    @staticmethod
+    def _key(base_url, preset_id):
+        return f"{base_url.rstrip('/')}|{preset_id}"
+
+    def _load(self):
+        if self._state is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError):
+                self._state = {}
+        return self._state
+
+    def get_last_day(self, base_url, preset_id):
+        """Возвращает последний загруженный день или None"""
+        with self._lock:
+            value = self._load().get(self._key(base_url, preset_id))
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+    def set_last_day(self, base_url, preset_id, day):
+        """Запоминает последний загруженный день (более ранняя дата не затирает более позднюю)"""
+        with self._lock:
+            state = self._load()
+            key = self._key(base_url, preset_id)
+            day_str = day.strftime('%Y-%m-%d')
+            if state.get(key, "") >= day_str:
                 return
-            
-            start_date, end_date = self.get_selected_dates()
-            start_date_str = start_date.strftime('%d.%m.%Y')
-            end_date_str = end_date.strftime('%d.%m.%Y')
-            current_date = datetime.now().strftime('%Y-%m-%d_%H-%M')
-            
-            # Определяем количество групп для каждой базы
-            base_groups_config = {
-                "Курск Ленина ММ": 4,
-                "Анапа ММ": 1,
-                "Курчатов CХ и Пекарни": 2,
-                "Белгород СХ": 4,
-                "Казань 1, 2, 3 СХ Железногорск Брянск": 5,
-                "СХ Орел": 4,
-                "Старый Оскол СХ": 2,
-                "ИП Лозовская Пекарни": 4,
-                "ИП Касаткин": 13
-            }
-            
-            save_paths = [
-                os.path.join(os.path.expanduser("~"), "Documents"),
-                os.path.join(os.path.expanduser("~"), "Desktop"),
-                tempfile.gettempdir()
-            ]
-            
-            for save_dir in save_paths:
-                try:
-                    filename = os.path.join(save_dir, f"OLAP-Выручка для динамики {start_date_str}-{end_date_str} ({current_date}).xlsx")
-                    self.log_message(f"Попытка сохранения в: {filename}")
-                    
-                    if not os.path.exists(save_dir):
-                        os.makedirs(save_dir)
-                    
-                    wb = Workbook()
-                    if 'Sheet' in wb.sheetnames:
-                        del wb['Sheet']
-                    
-                    start_date, end_date = self.get_selected_dates()
-                    
-                    for base_name, data in self.revenue_data.items():
-                        try:
-                            # Получаем количество групп для текущей базы
-                            groups_count = base_groups_config.get(base_name, 4)  # По умолчанию 4 группы
-                            
-                            # Создаем новый лист с именем базы (обрезаем до 31 символа)
-                            sheet_name = base_name[:31]
-                            ws = wb.create_sheet(title=sheet_name)
-
-                            # Стили
-                            bold_font = Font(bold=True)
-                            center_alignment = Alignment(horizontal='center')
-                            border = Border(left=Side(style='thin'), right=Side(style='thin'), 
-                                        top=Side(style='thin'), bottom=Side(style='thin'))
-
-                            # Заголовок отчета
-                            ws.merge_cells('A1:G1')
-                            ws['A1'] = f"Выручка для динамики - {base_name}"
-                            ws['A1'].font = Font(bold=True, size=14)
-                            ws['A1'].alignment = center_alignment
-
-                            # Информация о ресторане и периоде
-                            ws['A2'] = f"Название ресторана: {base_name}"
-                            ws['A3'] = f"Период: с {start_date.strftime('%d.%m.%Y')} по {end_date.strftime('%d.%m.%Y')}"
-
-                            # Основная таблица
-                            current_row = 5
-                            
-                            # Первая строка с группами
-                            ws.merge_cells('A5:B5')
-                            ws['A5'] = "Группа"
-                            ws['A5'].font = bold_font
-                            
-                            # Получаем группы из данных (не больше указанного количества)
-                            all_groups = data['groups']
-                            groups = all_groups[:groups_count]
-                            
-                            # Определяем колонки для групп (A,B уже заняты)
-                            columns = ['C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P'][:len(groups)]
-                            # Добавляем колонку "Итого"
-                            total_col = chr(ord('C') + len(groups)) if len(groups) < 13 else 'P'
-                            columns.append(total_col)
-                            
-                            # Записываем названия групп
-                            for i, group in enumerate(groups):
-                                ws[f'{columns[i]}{current_row}'] = group
-                                ws[f'{columns[i]}{current_row}'].font = bold_font
-                            
-                            # Колонка "Итого"
-                            ws[f'{columns[-1]}{current_row}'] = "Итого"
-                            ws[f'{columns[-1]}{current_row}'].font = bold_font
-                            
-                            current_row += 1
-
-                            # Строка с категорией блюда
-                            ws.merge_cells(f'A{current_row}:B{current_row}')
-                            ws[f'A{current_row}'] = "Категория блюда"
-                            ws[f'A{current_row}'].font = bold_font
-                            
-                            # Месяц (используем текущий месяц)
-                            current_month = f"{start_date.month:02d} ({self._get_month_name(start_date.month)})"
-                            for col in columns:
-                                ws[f'{col}{current_row}'] = current_month
-                            
-                            current_row += 1
-
-                            # Пустая строка с нулями
-                            ws.merge_cells(f'A{current_row}:B{current_row}')
-                            for col in columns:
-                                ws[f'{col}{current_row}'] = 0.00
-                            current_row += 1
-
-                            # Заполняем данные по категориям
-                            for category in data['categories']:
-                                ws.merge_cells(f'A{current_row}:B{current_row}')
-                                ws[f'A{current_row}'] = category
-                                
-                                category_total = 0.0
-                                for i, group in enumerate(groups):
-                                    value = data['data'][group].get(category, 0.0)
-                                    ws[f'{columns[i]}{current_row}'] = value
-                                    category_total += value
-                                
-                                ws[f'{columns[-1]}{current_row}'] = category_total
-                                current_row += 1
-
-                            # Итоговая строка
-                            ws.merge_cells(f'A{current_row}:B{current_row}')
-                            ws[f'A{current_row}'] = "Итого"
-                            ws[f'A{current_row}'].font = bold_font
-                            
-                            for i, group in enumerate(groups):
-                                group_total = sum(data['data'][group].values())
-                                ws[f'{columns[i]}{current_row}'] = group_total
-                            
-                            grand_total = sum(sum(group.values()) for group in data['data'].values())
-                            ws[f'{columns[-1]}{current_row}'] = grand_total
-
-                            # Форматирование
-                            for row in ws.iter_rows(min_row=5, max_row=current_row, min_col=1, max_col=len(columns)+2):
-                                for cell in row:
-                                    cell.border = border
-                                    if isinstance(cell.value, (int, float)):
-                                        cell.number_format = '#,##0.00'
-                                    if cell.value in ["Итого", *groups, "Группа", "Категория блюда"]:
-                                        cell.font = bold_font
-
-                            # Настройка ширины столбцов
-                            for col in ['A', 'B'] + columns:
-                                ws.column_dimensions[col].width = 15
+            state[key] = day_str
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
 
-                            self.log_message(f"✅ Лист для базы {base_name} создан (групп: {len(groups)})")
-                            
-                        except Exception as e:
-                            self.log_message(f"❌ Ошибка при создании листа для базы {base_name}: {str(e)}")
-                            continue
-                    
-                    # Сохраняем файл
-                    wb.save(filename)
-                    self.log_message(f"✅ Отчет 'Выручка динамика' успешно сохранен в: {filename}")
-                    # Открываем файл
-                    if os.name == 'nt':
-                        os.startfile(filename)
-                    return  # Успешно сохранили
-                    
-                except PermissionError as e:
-                    self.log_message(f"Ошибка доступа: {str(e)}")
-                    continue
-                except Exception as e:
-                    self.log_message(f"Ошибка: {str(e)}")
-                    continue
-            
-            # Если все попытки неудачны
-            self.log_message("❌ Не удалось сохранить отчет ни в одну из папок")
-            messagebox.showerror("Ошибка", "Не удалось сохранить отчет. Проверьте права доступа.")
-            
-        except Exception as e:
-            self.log_message(f"Критическая ошибка: {str(e)}")
-            messagebox.showerror("Ошибка", f"Ошибка: {str(e)}")
-    
 
-    def _get_day_name(self, day_num):
-        """Возвращает название дня недели по номеру"""
-        days = {
-            1: "Понедельник",
-            2: "Вторник",
-            3: "Среда",
-            4: "Четверг",
-            5: "Пятница",
-            6: "Суббота",
-            7: "Воскресенье"
+class DirectoryCache:
+    """Дисковый кэш справочников актов списания с ключом (адрес базы, справочник).
+
+    Справочник хранится словарем id -> название в gzip JSON и считается актуальным ttl секунд
+    после загрузки. invalidate() удаляет записи базы (или всех баз), и при следующем отчете
+    справочники загружаются с сервера заново.
+    """
+
+    def __init__(self, cache_dir=None, ttl=DIRECTORY_CACHE_TTL_SECONDS):
+        self.cache_dir = cache_dir or os.path.join(APP_DATA_DIR, "directories")
+        self.ttl = ttl
+
+    @staticmethod
+    def _base_key(base_url):
+        return hashlib.sha1(base_url.rstrip('/').encode()).hexdigest()
+
+    def _path(self, base_url, kind):
+        return os.path.join(self.cache_dir, self._base_key(base_url), f"{kind}.json.gz")
+
+    def get(self, base_url, kind):
+        """Возвращает справочник {id: название} или None, если записи нет или она устарела"""
+        path = self._path(base_url, kind)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError):
+            OlapResponseCache._remove(path)
+            return None
+        if time.time() - entry.get('fetched_at', 0) >= self.ttl:
+            return None
+        return entry.get('names', {})
+
+    def put(self, base_url, kind, names):
+        """Сохраняет загруженный справочник"""
+        path = self._path(base_url, kind)
+        entry = {
+            'base_url': base_url,
+            'kind': kind,
+            'fetched_at': time.time(),
+            'names': names
         }
-        return days.get(day_num, "")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def invalidate(self, base_url=None):
+        """Удаляет справочники базы (base_url=None - всех баз); возвращает число удаленных записей"""
+        if base_url is None:
+            directories = [os.path.join(self.cache_dir, name) for name in self._list(self.cache_dir)]
+        else:
+            directories = [os.path.join(self.cache_dir, self._base_key(base_url))]
+        removed = 0
+        for directory in directories:
+            for name in self._list(directory):
+                if name.endswith(".json.gz") and OlapResponseCache._remove(os.path.join(directory, name)):
+                    removed += 1
+        return removed
+
+    @staticmethod
+    def _list(directory):
+        try:
+            return os.listdir(directory)
+        except OSError:
+            return []
+
+
+class SnapshotStore:
+    """Архив сырых ответов: сжатые снимки в формате gzip JSON Lines.
+
+    Первая строка файла - метаданные (отчет, база, пресет, период, время создания, число строк),
+    далее по одной строке отчета в компактном JSON. Запись выполняет фоновый поток, поэтому
+    сохранение не задерживает загрузку; для каждой пары (отчет, база) хранятся последние keep снимков.
+    """
+
+    def __init__(self, root_dir=None, keep=SNAPSHOT_KEEP):
+        self.root_dir = root_dir or os.path.join(APP_DATA_DIR, "snapshots")
+        self.keep = keep
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _dir(self, report, base_name):
+        safe_name = re.sub(r'[^\w\- ]', '_', base_name).strip() or "base"
+        return os.path.join(self.root_dir, report, safe_name)
+
+    def save_async(self, report, base_name, base_url, preset_id, date_from, date_to, rows):
+        """Ставит снимок в очередь фоновой записи; rows после вызова не должны изменяться"""
+        meta = {
+            'snapshot': SNAPSHOT_FORMAT_VERSION,
+            'report': report,
+            'base_name': base_name,
+            'base_url': base_url,
+            'preset_id': preset_id,
+            'date_from': date_from.strftime('%Y-%m-%d'),
+            'date_to': date_to.strftime('%Y-%m-%d'),
+            'created_at': datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            'rows': len(rows)
+        }
+        self._queue.put((meta, rows))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._writer, name="snapshot-writer", daemon=True)
+                self._thread.start()
+
+    def flush(self, timeout=None):
+        """Ждет завершения записи снимков из очереди (не дольше timeout секунд)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _writer(self):
+        while True:
+            meta, rows = self._queue.get()
+            try:
+                path = self.write(meta, rows)
+                logger.debug(f"Снимок {meta['base_name']} сохранен: {path}")
+            except Exception as e:
+                logger.error(f"❌ Не удалось сохранить снимок {meta['base_name']}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def write(self, meta, rows):
+        """Записывает снимок на диск и удаляет самые старые сверх keep; возвращает путь файла"""
+        directory = self._dir(meta['report'], meta['base_name'])
+        os.makedirs(directory, exist_ok=True)
+        source = re.sub(r'[^\w\-]', '_', str(meta.get('preset_id') or ''))
+        created_at = datetime.fromisoformat(meta['created_at'])
+        while True:
+            stamp = created_at.strftime('%Y%m%dT%H%M%S%f')
+            path = os.path.join(directory, f"{stamp}_{meta['date_from']}_{meta['date_to']}_{source}.jsonl.gz")
+            if not os.path.exists(path):
+                break
+            # Снимок с тем же временем уже есть: сдвигаем время, сохраняя порядок имен по времени
+            created_at += timedelta(microseconds=1)
+        meta = dict(meta, created_at=created_at.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(meta, ensure_ascii=False, separators=(',', ':')) + "\n")
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + "\n")
+        os.replace(tmp_path, path)
+        self._prune(directory)
+        return path
+
+    def _prune(self, directory):
+        snapshots = sorted(name for name in os.listdir(directory) if name.endswith(".jsonl.gz"))
+        for name in snapshots[:-self.keep] if self.keep else []:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    @staticmethod
+    def read_meta(path):
+        """Читает метаданные снимка (первую строку файла)"""
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            meta = json.loads(f.readline())
+        meta['path'] = path
+        return meta
+
+    @staticmethod
+    def iter_rows(path):
+        """Построчно читает строки отчета из снимка"""
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            f.readline()  # Метаданные
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def list_snapshots(self, report, base_name):
+        """Метаданные сохраненных снимков пары (отчет, база), новые первыми"""
+        directory = self._dir(report, base_name)
+        try:
+            names = sorted((name for name in os.listdir(directory) if name.endswith(".jsonl.gz")), reverse=True)
+        except OSError:
+            return []
+        snapshots = []
+        for name in names:
+            try:
+                meta = self.read_meta(os.path.join(directory, name))
+            except (OSError, EOFError, ValueError):
+                continue
+            if meta.get('base_name') == base_name:
+                snapshots.append(meta)
+        return snapshots
+
+    def find_latest(self, report, base_name, date_from=None, date_to=None, source_id=None):
+        """Последний снимок базы; если указан период - только снимок именно этого периода,
+        если указан source_id - только снимок этого источника (пресет или отчет OLAP v2)"""
+        for meta in self.list_snapshots(report, base_name):
+            if date_from is not None and meta['date_from'] != date_from.strftime('%Y-%m-%d'):
+                continue
+            if date_to is not None and meta['date_to'] != date_to.strftime('%Y-%m-%d'):
+                continue
+            if source_id is not None and meta.get('preset_id') != source_id:
+                continue
+            return meta
+        return None
+
+
+class ReportWarehouse:
+    """Локальное хранилище SQLite загруженных строк отчетов.
+
+    Отчеты-источники записывают сюда строки после каждой загрузки; таблица loads хранит, за какие
+    периоды и когда загружались данные базы. Строки "Планы" и "Выручка динамика" хранятся с периодом
+    загрузки (строки пресетов агрегированы и дат не содержат) и источником (пресет или отчет OLAP v2,
+    см. IikoOlapReporter.source_id): строки разных источников не заменяют и не подменяют друг друга.
+    Акты списания хранятся по документам с датой, поэтому их можно выбирать за любой период,
+    покрытый загрузками.
+    """
+
+    # Столбцы таблиц строк OLAP-отчетов: столбец -> поле строки пресета
+    ROW_FIELDS = {
+        'plans': (
+            ('row_group', 'RestorauntGroup'),
+            ('week', 'WeekInMonthOpen'),
+            ('day_of_week', 'DayOfWeekOpen'),
+            ('open_date', 'OpenDate.Typed'),
+            ('dish_sum', 'DishDiscountSumInt'),
+            ('guests', 'GuestNum'),
+            ('dishes', 'DishAmountInt'),
+            ('orders', 'UniqOrderId'),
+        ),
+        'revenue': (
+            ('row_group', 'RestorauntGroup'),
+            ('category', 'DishCategory'),
+            ('dish_group', 'DishGroup'),
+            ('month', 'Mounth'),
+            ('amount', 'DishDiscountSumInt'),
+        ),
+    }
+    ROW_TABLES = {'plans': 'plan_rows', 'revenue': 'revenue_rows'}
+    # Числовые столбцы (показатели); остальные столбцы строк текстовые
+    NUMERIC_COLUMNS = {'dish_sum', 'guests', 'dishes', 'orders', 'amount'}
+
+    # Столбцы актов списания: столбец -> поле документа
+    DOC_FIELDS = (
+        ('doc_id', 'id'),
+        ('date_incoming', 'dateIncoming'),
+        ('document_number', 'documentNumber'),
+        ('status', 'status'),
+        ('store_id', 'storeId'),
+        ('account_id', 'accountId'),
+        ('conception_id', 'conceptionId'),
+        ('comment', 'comment'),
+    )
+    ITEM_FIELDS = (
+        ('product_id', 'productId'),
+        ('amount', 'amount'),
+        ('cost', 'cost'),
+    )
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS loads (
+            report TEXT NOT NULL,
+            base_name TEXT NOT NULL,
+            base_url TEXT,
+            preset_id TEXT NOT NULL DEFAULT '',
+            period_from TEXT NOT NULL,
+            period_to TEXT NOT NULL,
+            loaded_at TEXT NOT NULL,
+            rows INTEGER NOT NULL,
+            PRIMARY KEY (report, base_name, preset_id, period_from, period_to)
+        );
+        CREATE TABLE IF NOT EXISTS plan_rows (
+            base_name TEXT NOT NULL,
+            period_from TEXT NOT NULL,
+            period_to TEXT NOT NULL,
+            source_id TEXT NOT NULL DEFAULT '',
+            row_group TEXT,
+            week TEXT,
+            day_of_week TEXT,
+            open_date TEXT,
+            dish_sum NUMERIC,
+            guests NUMERIC,
+            dishes NUMERIC,
+            orders NUMERIC
+        );
+        CREATE INDEX IF NOT EXISTS plan_rows_base_period ON plan_rows (base_name, period_from, period_to);
+        CREATE INDEX IF NOT EXISTS plan_rows_group ON plan_rows (row_group);
+        CREATE TABLE IF NOT EXISTS revenue_rows (
+            base_name TEXT NOT NULL,
+            period_from TEXT NOT NULL,
+            period_to TEXT NOT NULL,
+            source_id TEXT NOT NULL DEFAULT '',
+            row_group TEXT,
+            category TEXT,
+            dish_group TEXT,
+            month TEXT,
+            amount NUMERIC
+        );
+        CREATE INDEX IF NOT EXISTS revenue_rows_base_period ON revenue_rows (base_name, period_from, period_to);
+        CREATE INDEX IF NOT EXISTS revenue_rows_group_category ON revenue_rows (row_group, category);
+        CREATE TABLE IF NOT EXISTS writeoff_docs (
+            base_name TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            date_incoming TEXT,
+            document_number TEXT,
+            status TEXT,
+            store_id TEXT,
+            account_id TEXT,
+            conception_id TEXT,
+            comment TEXT,
+            PRIMARY KEY (base_name, doc_id)
+        );
+        CREATE INDEX IF NOT EXISTS writeoff_docs_base_date ON writeoff_docs (base_name, date_incoming);
+        CREATE TABLE IF NOT EXISTS writeoff_items (
+            base_name TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            product_id TEXT,
+            amount NUMERIC,
+            cost NUMERIC
+        );
+        CREATE INDEX IF NOT EXISTS writeoff_items_doc ON writeoff_items (base_name, doc_id);
+        CREATE INDEX IF NOT EXISTS writeoff_items_product ON writeoff_items (product_id);
+        CREATE TABLE IF NOT EXISTS writeoff_names (
+            base_name TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            entity_id TEXT NOT NULL,
+            name TEXT,
+            PRIMARY KEY (base_name, kind, entity_id)
+        );
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(APP_DATA_DIR, "warehouse.sqlite3")
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        """Соединение текущего потока (sqlite3 не разрешает общий объект соединения между потоками)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._write_lock:
+                if not self._initialized:
+                    conn.executescript(self.SCHEMA)
+                    conn.execute(f"PRAGMA user_version = {WAREHOUSE_SCHEMA_VERSION}")
+                    self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _text(value):
+        """Значение измерения для текстового столбца: строки как есть, прочее (кроме None) - через str"""
+        if value is None or isinstance(value, str):
+            return value
+        return str(value)
+
+    @staticmethod
+    def _day(value):
+        return value.strftime('%Y-%m-%d')
+
+    def row_values(self, report, row):
+        """Кортеж значений строки пресета для таблицы отчета report"""
+        return tuple(
+            row.get(field) if column in self.NUMERIC_COLUMNS else self._text(row.get(field))
+            for column, field in self.ROW_FIELDS[report]
+        )
+
+    def _record_load(self, conn, report, base_name, base_url, preset_id, date_from, date_to, rows):
+        conn.execute(
+            "INSERT OR REPLACE INTO loads VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (report, base_name, base_url, preset_id or '', self._day(date_from), self._day(date_to),
+             datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), rows)
+        )
+
+    def save_rows(self, report, base_name, base_url, preset_id, date_from, date_to, rows):
+        """Заменяет строки отчета базы за период для источника preset_id; rows - строки пресета (словари)"""
+        self.save_values(
+            report, base_name, base_url, preset_id, date_from, date_to,
+            [self.row_values(report, row) for row in rows if isinstance(row, dict)]
+        )
+
+    def save_values(self, report, base_name, base_url, preset_id, date_from, date_to, values):
+        """Заменяет строки отчета базы за период для источника preset_id готовыми кортежами row_values"""
+        table = self.ROW_TABLES[report]
+        columns = [column for column, _ in self.ROW_FIELDS[report]]
+        period = (base_name, self._day(date_from), self._day(date_to), preset_id or '')
+        conn = self._connect()
+        with self._write_lock, conn:
+            conn.execute(
+                f"DELETE FROM {table} WHERE base_name = ? AND period_from = ? AND period_to = ? AND source_id = ?",
+                period
+            )
+            conn.executemany(
+                f"INSERT INTO {table} (base_name, period_from, period_to, source_id, {', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * (len(columns) + 4))})",
+                (period + value for value in values)
+            )
+            self._record_load(conn, report, base_name, base_url, preset_id, date_from, date_to, len(values))
+
+    def load_rows(self, report, base_name, date_from, date_to, source_id):
+        """Строки отчета базы за период из источника source_id в виде строк пресета или None,
+        если период из этого источника не загружался"""
+        table = self.ROW_TABLES[report]
+        fields = self.ROW_FIELDS[report]
+        conn = self._connect()
+        period = (base_name, self._day(date_from), self._day(date_to), source_id or '')
+        loaded = conn.execute(
+            "SELECT 1 FROM loads WHERE report = ? AND base_name = ? AND period_from = ? AND period_to = ? "
+            "AND preset_id = ?",
+            (report,) + period
+        ).fetchone()
+        if loaded is None:
+            return None
+        cursor = conn.execute(
+            f"SELECT {', '.join(column for column, _ in fields)} FROM {table} "
+            f"WHERE base_name = ? AND period_from = ? AND period_to = ? AND source_id = ? ORDER BY rowid",
+            period
+        )
+        keys = [field for _, field in fields]
+        return [dict(zip(keys, values)) for values in cursor]
+
+    def save_writeoff_docs(self, base_name, base_url, date_from, date_to, docs):
+        """Сохраняет акты списания (документы и позиции); документы с теми же id заменяются"""
+        doc_rows = []
+        item_rows = []
+        for position, doc in enumerate(docs):
+            if not isinstance(doc, dict):
+                continue
+            doc_id = self._text(doc.get('id')) or f"{doc.get('dateIncoming')}|{doc.get('documentNumber')}"
+            doc_rows.append(
+                (base_name, doc_id, position) + tuple(self._text(doc.get(field)) for _, field in self.DOC_FIELDS[1:])
+            )
+            for item_position, item in enumerate(doc.get('items') or []):
+                if isinstance(item, dict):
+                    item_rows.append((base_name, doc_id, item_position, self._text(item.get('productId')),
+                                      item.get('amount'), item.get('cost')))
+        conn = self._connect()
+        with self._write_lock, conn:
+            # Документы периода, удаленные на сервере, не должны оставаться в хранилище
+            conn.execute(
+                "DELETE FROM writeoff_items WHERE base_name = ? AND doc_id IN ("
+                "SELECT doc_id FROM writeoff_docs WHERE base_name = ? AND substr(date_incoming, 1, 10) BETWEEN ? AND ?)",
+                (base_name, base_name, self._day(date_from), self._day(date_to))
+            )
+            conn.execute(
+                "DELETE FROM writeoff_docs WHERE base_name = ? AND substr(date_incoming, 1, 10) BETWEEN ? AND ?",
+                (base_name, self._day(date_from), self._day(date_to))
+            )
+            conn.executemany(
+                "DELETE FROM writeoff_items WHERE base_name = ? AND doc_id = ?",
+                ((row[0], row[1]) for row in doc_rows)
+            )
+            conn.executemany("INSERT OR REPLACE INTO writeoff_docs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", doc_rows)
+            conn.executemany("INSERT INTO writeoff_items VALUES (?, ?, ?, ?, ?, ?)", item_rows)
+            self._record_load(conn, 'writeoff', base_name, base_url, None, date_from, date_to, len(doc_rows))
+
+    def load_writeoff_docs(self, base_name, date_from, date_to):
+        """Акты списания базы за период в виде документов API или None, если период не покрыт загрузками"""
+        conn = self._connect()
+        day_from, day_to = self._day(date_from), self._day(date_to)
+        covered = conn.execute(
+            "SELECT 1 FROM loads WHERE report = 'writeoff' AND base_name = ? AND period_from <= ? AND period_to >= ?",
+            (base_name, day_from, day_to)
+        ).fetchone()
+        if covered is None:
+            return None
+        items = defaultdict(list)
+        for doc_id, product_id, amount, cost in conn.execute(
+            "SELECT i.doc_id, i.product_id, i.amount, i.cost FROM writeoff_items i "
+            "JOIN writeoff_docs d ON d.base_name = i.base_name AND d.doc_id = i.doc_id "
+            "WHERE d.base_name = ? AND substr(d.date_incoming, 1, 10) BETWEEN ? AND ? "
+            "ORDER BY i.doc_id, i.position",
+            (base_name, day_from, day_to)
+        ):
+            items[doc_id].append({'productId': product_id, 'amount': amount, 'cost': cost})
+        columns = [column for column, _ in self.DOC_FIELDS]
+        docs = []
+        for values in conn.execute(
+            f"SELECT {', '.join(columns)} FROM writeoff_docs "
+            "WHERE base_name = ? AND substr(date_incoming, 1, 10) BETWEEN ? AND ? ORDER BY date_incoming, position",
+            (base_name, day_from, day_to)
+        ):
+            doc = {field: value for (_, field), value in zip(self.DOC_FIELDS, values)}
+            doc['items'] = items.get(doc['id'], [])
+            docs.append(doc)
+        return docs
+
+    def save_names(self, base_name, kind, names):
+        """Сохраняет справочник (склады, счета, концепции, товары) базы: id -> название"""
+        conn = self._connect()
+        with self._write_lock, conn:
+            conn.execute("DELETE FROM writeoff_names WHERE base_name = ? AND kind = ?", (base_name, kind))
+            conn.executemany(
+                "INSERT INTO writeoff_names VALUES (?, ?, ?, ?)",
+                ((base_name, kind, str(entity_id), name) for entity_id, name in names.items())
+            )
 
-    def _get_month_name(self, month_num):
-        """Возвращает название месяца по номеру"""
-        months = {
-            1: "Январь",
-            2: "Февраль",
-            3: "Март",
-            4: "Апрель",
-            5: "Май",
-            6: "Июнь",
-            7: "Июль",
-            8: "Август",
-            9: "Сентябрь",
-            10: "Октябрь",
-            11: "Ноябрь",
-            12: "Декабрь"
-        }
-        return months.get(month_num, "")
+    def load_names(self, base_name, kind):
+        """Справочник базы id -> название (пустой, если не загружался)"""
+        return dict(self._connect().execute(
+            "SELECT entity_id, name FROM writeoff_names WHERE base_name = ? AND kind = ?", (base_name, kind)
+        ))
 
-    def _get_week_number(self, date_str, start_date):
-        """Вычисляет номер недели в месяце"""
-        date = datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S')
-        # Номер недели в месяце
-        week_in_month = (date.day - 1) // 7 + 1
-        return week_in_month
+    def add_names(self, base_name, kind, names):
+        """Добавляет (или обновляет) названия в справочнике базы, не удаляя остальные записи"""
+        conn = self._connect()
+        with self._write_lock, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO writeoff_names VALUES (?, ?, ?, ?)",
+                ((base_name, kind, str(entity_id), name) for entity_id, name in names.items())
+            )
 
-    def _add_group_total(self, ws, start_row, end_row, group_name):
-        """Добавляет строку с итогами по всей группе"""
-        total_row = end_row + 1
-        # Собираем все строки группы (исключая итоговые строки недель)
-        group_rows = []
-        for row in range(start_row, end_row + 1):
-            # Проверяем, что это не итоговая строка недели
-            if not ws.cell(row=row, column=2).value or "всего" not in str(ws.cell(row=row, column=2).value):
-                group_rows.append(row)
-        # Формулы для суммирования только по дням (без итогов недель)
-        for col, letter in zip(range(4, 8), ['D', 'E', 'F', 'G']):
-            # Собираем диапазон только для строк с данными дней
-            range_str = ",".join([f"{letter}{row}" for row in group_rows])
-            formula = f"=SUM({range_str})"
-            ws.cell(row=total_row, column=col, value=formula).font = Font(bold=True)
-        # Записываем итог по группе
-        ws.cell(row=total_row, column=1, value=f"{group_name} всего").font = Font(bold=True)
-        ws.cell(row=total_row, column=2, value="")
-        ws.cell(row=total_row, column=3, value="")
-
-    def _add_week_total(self, ws, start_row, end_row, week_num):
-        """Добавляет строку с итогами по неделе (без дня недели)"""
-        total_row = end_row + 1
-        # Формулы для суммирования
-        for col, letter in zip(range(4, 8), ['D', 'E', 'F', 'G']):
-            formula = f"=SUM({letter}{start_row}:{letter}{end_row})"
-            ws.cell(row=total_row, column=col, value=formula).font = Font(bold=True)
-        # Записываем итог без дня недели
-        ws.cell(row=total_row, column=1, value="")  # Пусто под названием группы
-        ws.cell(row=total_row, column=2, value=f"{week_num} всего").font = Font(bold=True)
-        ws.cell(row=total_row, column=3, value="")  # Пусто для дня недели
+    def lookup_names(self, base_name, kind, ids):
+        """Названия только перечисленных id справочника базы: {id: название} найденных записей"""
+        ids = list(ids)
+        conn = self._connect()
+        names = {}
+        for start in range(0, len(ids), SQL_BATCH_SIZE):
+            batch = ids[start:start + SQL_BATCH_SIZE]
+            names.update(conn.execute(
+                "SELECT entity_id, name FROM writeoff_names WHERE base_name = ? AND kind = ? "
+                f"AND entity_id IN ({', '.join('?' * len(batch))})",
+                [base_name, kind] + batch
+            ))
+        return names
 
-    def get_writeoff_report(self):
-        try:
-            selected_bases = self.get_selected_bases()
-            if not selected_bases:
-                messagebox.showwarning("Ошибка", "Выберите хотя бы одну базу")
-                return
-            
-            start_date, end_date = self.get_selected_dates()
-            start_date_str = start_date.strftime('%d.%m.%Y')
-            end_date_str = end_date.strftime('%d.%m.%Y')
-            current_date = datetime.now().strftime('%Y-%m-%d_%H-%M')
-                
-            start_date, end_date = self.get_selected_dates()
-            self.log_message(f"Загрузка актов списания за период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}")
-            
-            login = self.login_entry.get()
-            password = self.password_entry.get()
-            
-            wb = Workbook()
-            if 'Sheet' in wb.sheetnames:
-                del wb['Sheet']
-                
-            for base_name in selected_bases:
-                base_info = self.available_bases[base_name]
-                reporter = WriteoffReporter(base_info["url"], login, password)
-                if reporter.auth():
-                    # Загрузка справочников
-                    reporter.load_stores_cache()
-                    reporter.load_accounts_cache()
-                    reporter.load_conceptions_cache()
-                    reporter.load_products_cache()
-                    
-                    # Получение актов списания
-                    docs = reporter.fetch_writeoff_docs(start_date, end_date)
-                    if docs:
-                        # Создание листа Excel
-                        ws = wb.create_sheet(title=base_name[:31])
-                        self.populate_writeoff_sheet(ws, docs, reporter, base_name)
-                        self.log_message(f"✅ Данные из {base_name} успешно загружены")
-                    else:
-                        self.log_message(f"❌ Не удалось получить данные из {base_name}")
-                else:
-                    self.log_message(f"❌ Ошибка авторизации в базе {base_name}")
-            
-            # Сохранение файла
-            filename = f"Акты списания {start_date_str}-{end_date_str} ({current_date}).xlsx"
-            wb.save(filename)
-            self.log_message(f"✅ Отчет по актам списания сохранен в: {filename}")
-            if os.name == 'nt':
-                os.startfile(filename)
-                
-        except Exception as e:
-            self.log_message(f"❌ Ошибка: {str(e)}")
-            import traceback
-            self.log_message(traceback.format_exc())
-
-    def populate_writeoff_sheet(self, ws, docs, reporter, base_name):
-        """Заполняет лист Excel данными об актах списания"""
-        bold_font = Font(bold=True)
-        center_alignment = Alignment(horizontal='center')
-        border = Border(
-            left=Side(style='thin'), 
-            right=Side(style='thin'), 
-            top=Side(style='thin'), 
-            bottom=Side(style='thin')
+    def delete_names(self, base_name, kind):
+        """Удаляет справочник базы; возвращает число удаленных записей"""
+        conn = self._connect()
+        with self._write_lock, conn:
+            return conn.execute(
+                "DELETE FROM writeoff_names WHERE base_name = ? AND kind = ?", (base_name, kind)
+            ).rowcount
+
+    # Условие на строки последней загрузки периода базы: строки пресета и OLAP v2 не суммируются вместе
+    _LATEST_SOURCE = (
+        "{table}.source_id = (SELECT l.preset_id FROM loads l WHERE l.report = '{report}' "
+        "AND l.base_name = {table}.base_name AND l.period_from = {table}.period_from "
+        "AND l.period_to = {table}.period_to ORDER BY l.loaded_at DESC LIMIT 1)"
+    )
+
+    def revenue_rollup(self, date_from, date_to, base_names=None):
+        """Сводная выручка нескольких баз за период: {(группа, категория): сумма}"""
+        query = (
+            "SELECT row_group, COALESCE(NULLIF(category, ''), dish_group), SUM(amount) FROM revenue_rows "
+            f"WHERE period_from = ? AND period_to = ? AND {self._LATEST_SOURCE.format(report='revenue', table='revenue_rows')}"
         )
-        
-        # Заголовок
-        ws.merge_cells('A1:J1')
-        ws['A1'] = f"Акты списания: {base_name}"
-        ws['A1'].font = Font(bold=True, size=14)
-        ws['A1'].alignment = center_alignment
+        params = [self._day(date_from), self._day(date_to)]
+        if base_names:
+            query += f" AND base_name IN ({', '.join('?' * len(base_names))})"
+            params.extend(base_names)
+        query += " GROUP BY 1, 2"
+        return {(group, category): total for group, category, total in self._connect().execute(query, params)}
 
-        # Заголовки столбцов
-        headers = [
-            "Дата документа", "Тип", "№", "Товары", 
-            "Сумма, р.", "Проведен", "Склад", 
-            "Концепция", "Комментарий", "Счет списания"
-        ]
-        
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=3, column=col, value=header)
-            cell.font = bold_font
-            cell.alignment = center_alignment
-            cell.border = border
-            ws.column_dimensions[get_column_letter(col)].width = 20
-        
-        # Данные
-        row_num = 4
-        for doc in docs:
-            if not isinstance(doc, dict):
-                continue
-                
-            try:
-                # Обработка даты
-                date_str = datetime.strptime(
-                    doc['dateIncoming'], 
-                    '%Y-%m-%dT%H:%M:%S.%f'
-                ).strftime('%d.%m.%Y %H:%M')
-            except ValueError:
-                try:
-                    date_str = datetime.strptime(
-                        doc['dateIncoming'], 
-                        '%Y-%m-%dT%H:%M'
-                    ).strftime('%d.%m.%Y %H:%M')
-                except ValueError:
-                    date_str = doc['dateIncoming']
-            
-            # Получение данных документа
-            doc_num = doc.get('documentNumber', '')
-            status = reporter.get_status_name(doc.get('status', ''))
-            comment = doc.get('comment', '')
-            
-            # Товары и сумма
-            items_text = []
-            total_sum = 0
-            for item in doc.get('items', []):
-                product_name = reporter.get_product_name(item.get('productId', ''))
-                amount = item.get('amount', 0)
-                cost = item.get('cost', 0) or 0
-                total_sum += cost
-                items_text.append(f"{product_name} x{amount}")
-            
-            # Получение названий
-            warehouse = reporter.get_store_name(doc.get('storeId'))
-            writeoff_account = reporter.get_account_name(doc.get('accountId'))
-            concept = reporter.get_conception_name(doc.get('conceptionId'))
-            
-            # Запись в Excel
-            ws.cell(row=row_num, column=1, value=date_str).border = border
-            ws.cell(row=row_num, column=2, value="P").border = border
-            ws.cell(row=row_num, column=3, value=doc_num).border = border
-            ws.cell(row=row_num, column=4, value="\n".join(items_text)).border = border
-            ws.cell(row=row_num, column=5, value=round(total_sum, 2)).border = border
-            ws.cell(row=row_num, column=6, value=status).border = border
-            ws.cell(row=row_num, column=7, value=warehouse).border = border
-            ws.cell(row=row_num, column=8, value=concept).border = border
-            ws.cell(row=row_num, column=9, value=comment).border = border
-            ws.cell(row=row_num, column=10, value=writeoff_account).border = border
-            
-            row_num += 1
+    def plan_totals(self, date_from, date_to, base_names=None):
+        """Итоги "Планы" за период {(база, группа): (выручка, гости, блюда, чеки)} - например, для сравнения периодов"""
+        query = (
+            "SELECT base_name, row_group, SUM(dish_sum), SUM(guests), SUM(dishes), SUM(orders) FROM plan_rows "
+            f"WHERE period_from = ? AND period_to = ? AND {self._LATEST_SOURCE.format(report='plans', table='plan_rows')}"
+        )
+        params = [self._day(date_from), self._day(date_to)]
+        if base_names:
+            query += f" AND base_name IN ({', '.join('?' * len(base_names))})"
+            params.extend(base_names)
+        query += " GROUP BY 1, 2"
+        return {(base, group): tuple(totals) for base, group, *totals in self._connect().execute(query, params)}
+
+    def list_loads(self, report=None, base_names=None):
+        """Загрузки в хранилище (новые первыми): report, base_name, period_from, period_to, loaded_at, rows"""
+        query = "SELECT report, base_name, period_from, period_to, loaded_at, rows FROM loads WHERE 1 = 1"
+        params = []
+        if report:
+            query += " AND report = ?"
+            params.append(report)
+        if base_names:
+            query += f" AND base_name IN ({', '.join('?' * len(base_names))})"
+            params.extend(base_names)
+        return self._connect().execute(query + " ORDER BY loaded_at DESC", params).fetchall()
+
+
+# Общий дисковый кэш OLAP-ответов, состояние инкрементальной загрузки, архив снимков и хранилище строк
+OLAP_CACHE = OlapResponseCache()
+DIRECTORY_CACHE = DirectoryCache()
+INCREMENTAL_STATE = IncrementalState()
+SNAPSHOTS = SnapshotStore()
+WAREHOUSE = ReportWarehouse()
 
 
 class IikoOlapReporter:
-    def __init__(self, base_url, login, password, preset_id):
+    # Отчет, под которым строки пресета записываются в хранилище ReportWarehouse
+    WAREHOUSE_REPORT = "plans"
+    # Поля группировки и показатели отчета OLAP v2 в режиме свертки на сервере:
+    # одна строка на группу, неделю и день недели - ровно то, что выводит лист "Планы"
+    OLAP_V2_GROUP_FIELDS = ('RestorauntGroup', 'WeekInMonthOpen', 'DayOfWeekOpen')
+    OLAP_V2_AGGREGATE_FIELDS = OLAP_MEASURE_FIELDS
+
+    def __init__(self, base_url, login, password, preset_id, cancel_event=None, on_bytes=None, client=None,
+                 cache=None, bypass_cache=False, incremental=None, recheck_days=DEFAULT_RECHECK_DAYS,
+                 warehouse=None, base_name=None, server_aggregation=False):
         self.base_url = base_url
+        self.base_name = base_name or base_url  # Имя базы в хранилище
         self.login = login
         self.password = password
         self.preset_id = preset_id  # ID пресета отчета
-        self.token = None
-        self.session = requests.Session()
-        self.session.verify = False
+        self.client = client or CLIENT_POOL.get(base_url, login, password)
+        self.cancel_event = cancel_event  # Флаг отмены фонового задания
+        self.on_bytes = on_bytes  # Уведомление о полученных байтах
+        self.cache = cache  # OlapResponseCache; None - загрузка без кэша
+        self.bypass_cache = bypass_cache  # Не читать кэш, но обновить его свежими данными
+        self.incremental = incremental  # IncrementalState; задан - инкрементальный режим (нужен кэш)
+        self.recheck_days = recheck_days  # Запас дней для перепроверки поздних правок
+        self.cache_hits = 0  # Окон, взятых из кэша при последней загрузке
+        self.cache_misses = 0  # Окон, загруженных с сервера при последней загрузке
+        self.warehouse = warehouse  # ReportWarehouse; задан - строки каждой загрузки сохраняются в нем
+        # Вместо пресета запрашивается отчет OLAP v2 со сверткой на сервере (OLAP_V2_GROUP_FIELDS)
+        self.server_aggregation = server_aggregation
+
+    @property
+    def source_id(self):
+        """Источник строк для кэша, инкрементального режима, хранилища и снимков: пресет или отчет OLAP v2"""
+        return self.source_for(self.preset_id, self.server_aggregation)
+
+    @classmethod
+    def source_for(cls, preset_id, server_aggregation=False):
+        """source_id без создания репортера (например, для чтения из хранилища)"""
+        if not server_aggregation:
+            return preset_id
+        fields = ",".join(cls.OLAP_V2_GROUP_FIELDS) + "|" + ",".join(cls.OLAP_V2_AGGREGATE_FIELDS)
+        return f"olap-v2:{hashlib.sha1(fields.encode()).hexdigest()[:12]}"
+
+    @property
+    def token(self):
+        return self.client.token
+
+    @property
+    def session(self):
+        return self.client.session
 
     def auth(self):
-        """Авторизация в системе"""
-        auth_url = f"{self.base_url}/auth"
-        password_hash = hashlib.sha1(self.password.encode()).hexdigest()
-        data = {
-            'login': self.login,
-            'pass': password_hash
-        }
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-        response = self.session.post(auth_url, data=data, headers=headers)
-        if response.status_code == 200:
-            self.token = response.text.strip()
-            return True
-        return False
+        """Авторизация в системе (используется кэшированный токен общего клиента)"""
+        return self.client.auth()
+
+    def get_olap_report(self, date_from, date_to, chunk_mode=None, chunk_workers=DEFAULT_CHUNK_WORKERS):
+        """Получение OLAP-отчета.
+
+        При заданном chunk_mode ("day", "week", "month" или "auto") период разбивается на окна,
+        которые загружаются параллельно (не более chunk_workers одновременно) и объединяются
+        в ответ того же вида {'data': [...]}.
+        Если задан кэш, окна режима "auto" выбирает cache_windows, и с сервера загружаются только окна,
+        которых нет в кэше. В инкрементальном режиме окна тоже выбирает cache_windows, а дни начиная
+        с (последний загруженный день - recheck_days) загружаются заново, даже если они есть в кэше.
+        Полученные строки записываются в хранилище, если оно задано.
+        """
+        payload = self._load_olap_report(date_from, date_to, chunk_mode, chunk_workers)
+        if payload is not None:
+            self._store_rows(date_from, date_to, payload.get('data', []))
+        return payload
+
+    def _store_rows(self, date_from, date_to, rows):
+        """Записывает строки периода в хранилище; ошибка хранилища не прерывает отчет"""
+        if self.warehouse is None:
+            return
+        try:
+            self.warehouse.save_rows(
+                self.WAREHOUSE_REPORT, self.base_name, self.base_url, self.source_id, date_from, date_to, rows
+            )
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"❌ {self.base_name}: не удалось записать строки в хранилище: {str(e)}")
+
+    def _tee_to_warehouse(self, rows, date_from, date_to):
+        """Передает строки потока дальше и сохраняет их в хранилище, когда поток прочитан полностью"""
+        values = []
+        for row in rows:
+            if isinstance(row, dict):
+                values.append(self.warehouse.row_values(self.WAREHOUSE_REPORT, row))
+            yield row
+        try:
+            self.warehouse.save_values(
+                self.WAREHOUSE_REPORT, self.base_name, self.base_url, self.source_id, date_from, date_to, values
+            )
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"❌ {self.base_name}: не удалось записать строки в хранилище: {str(e)}")
 
-    def get_olap_report(self, date_from, date_to):
-        """Получение OLAP-отчета"""
-        if not self.token and not self.auth():
+    def _load_olap_report(self, date_from, date_to, chunk_mode, chunk_workers):
+        """Загружает отчет (из кэша и/или с сервера) без записи в хранилище"""
+        if self.cache is not None:
+            return self._get_cached_report(date_from, date_to, chunk_mode, chunk_workers)
+        windows = split_date_range(date_from, date_to, resolve_chunk_mode(chunk_mode, date_from, date_to))
+        if len(windows) == 1:
+            return self._fetch_window(date_from, date_to)
+        with ThreadPoolExecutor(max_workers=max(1, chunk_workers), thread_name_prefix="iiko-chunk") as executor:
+            payloads = list(executor.map(lambda window: self._fetch_window(*window), windows))
+        if any(payload is None for payload in payloads):
             return None
-        date_from_str = date_from.strftime('%Y-%m-%dT00:00:00')
-        date_to_str = (date_to + timedelta(days=1)).strftime('%Y-%m-%dT00:00:00')
-        url = f"{self.base_url}/v2/reports/olap/byPresetId/{self.preset_id}"
-        params = {
-            'key': self.token,
-            'dateFrom': date_from_str,
-            'dateTo': date_to_str
-        }
-        response = self.session.get(url, params=params)
-        if response.status_code == 200:
-            return response.json()
-        return None
+        return {'data': merge_olap_rows(payload.get('data', []) for payload in payloads)}
 
+    def _plan_cache_windows(self, date_from, date_to, chunk_mode):
+        """Разбивает период на окна кэша: [(окно, True - окно есть в кэше)]"""
+        refresh_from = None
+        if self.incremental is not None:
+            last_day = self.incremental.get_last_day(self.base_url, self.source_id)
+            if last_day is not None:
+                refresh_from = last_day - timedelta(days=self.recheck_days)
+        if chunk_mode == "auto" or self.incremental is not None:
+            windows = cache_windows(date_from, date_to, refresh_from)
+        else:
+            windows = split_date_range(date_from, date_to, chunk_mode)
+        plan = []
+        for window in windows:
+            if self.bypass_cache or (refresh_from is not None and window[1] >= refresh_from):
+                plan.append((window, False))
+            elif self.cache.contains(self.base_url, self.source_id, *window):
+                plan.append((window, True))
+            else:
+                # Неделя или месяц могли быть загружены раньше по дням
+                days = split_date_range(*window, "day") if window[0] != window[1] else []
+                if days and all(self.cache.contains(self.base_url, self.source_id, *day) for day in days):
+                    plan.extend((day, True) for day in days)
+                else:
+                    plan.append((window, False))
+        self.cache_hits = sum(1 for _, cached in plan if cached)
+        self.cache_misses = len(plan) - self.cache_hits
+        return plan
 
-class IikoRevenueReporter:
-    def __init__(self, base_url, login, password, preset_id):
-        self.base_url = base_url
-        self.login = login
-        self.password = password
-        self.preset_id = preset_id
-        self.token = None
-        self.session = requests.Session()
-        self.session.verify = False
+    def _read_cached_window(self, window):
+        """Строки окна из кэша; если запись успела устареть или вытесниться, окно загружается заново"""
+        rows = self.cache.get(self.base_url, self.source_id, *window)
+        if rows is None:
+            return self._fetch_cached_window(window)
+        return rows
 
-    def auth(self):
-        """Авторизация в системе"""
-        auth_url = f"{self.base_url}/auth"
-        password_hash = hashlib.sha1(self.password.encode()).hexdigest()
-        data = {
-            'login': self.login,
-            'pass': password_hash
-        }
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-        response = self.session.post(auth_url, data=data, headers=headers)
-        if response.status_code == 200:
-            self.token = response.text.strip()
-            return True
-        return False
+    def _fetch_cached_window(self, window):
+        """Загружает окно с сервера, записывая строки в кэш по мере разбора ответа"""
+        rows = self._open_window_stream(*window)
+        if rows is None:
+            return None
+        return list(self.cache.put_stream(self.base_url, self.source_id, *window, rows))
+
+    def _prefetch_window(self, window):
+        """Загружает окно с сервера сразу в кэш; возвращает число строк или None при ошибке"""
+        rows = self._open_window_stream(*window)
+        if rows is None:
+            return None
+        return sum(1 for _ in self.cache.put_stream(self.base_url, self.source_id, *window, rows))
 
-    def get_olap_report(self, date_from, date_to):
-        """Получение OLAP-отчета"""
-        if not self.token and not self.auth():
+    def _get_cached_report(self, date_from, date_to, chunk_mode, chunk_workers):
+        """Собирает отчет из окон кэша, загружая недостающие окна параллельно"""
+        today = datetime.now()
+        # Будущие дни не содержат продаж, поэтому период обрезается текущим днем
+        date_to = min(date_to, datetime(today.year, today.month, today.day))
+        if date_to < date_from:
+            return {'data': []}
+        plan = self._plan_cache_windows(date_from, date_to, chunk_mode)
+        window_rows = [self._read_cached_window(window) for window, cached in plan if cached]
+        missing_windows = [window for window, cached in plan if not cached]
+        if missing_windows:
+            with ThreadPoolExecutor(max_workers=max(1, chunk_workers), thread_name_prefix="iiko-chunk") as executor:
+                window_rows.extend(executor.map(self._fetch_cached_window, missing_windows))
+        if any(rows is None for rows in window_rows):
             return None
+        if self.incremental is not None:
+            self.incremental.set_last_day(self.base_url, self.source_id, date_to)
+        return {'data': merge_olap_rows(window_rows)}
+
+    def iter_olap_rows(self, date_from, date_to, chunk_mode=None, chunk_workers=DEFAULT_CHUNK_WORKERS):
+        """Возвращает итератор строк отчета или None, если данные получить не удалось.
+
+        Строки передаются обработке по одной без объединения окон (одинаковые строки разных окон
+        суммирует свертка): единственное окно с сервера разбирается потоково прямо из ответа
+        (и с кэшем записывается в него по мере чтения), несколько недостающих окон загружаются
+        параллельно сразу в кэш, а записи кэша разбираются потоково по одной.
+        """
+        if self.cache is not None:
+            rows = self._iter_cached_rows(date_from, date_to, chunk_mode, chunk_workers)
+        else:
+            windows = split_date_range(date_from, date_to, resolve_chunk_mode(chunk_mode, date_from, date_to))
+            if len(windows) == 1:
+                rows = self._open_window_stream(date_from, date_to)
+            else:
+                with ThreadPoolExecutor(max_workers=max(1, chunk_workers), thread_name_prefix="iiko-chunk") as executor:
+                    payloads = list(executor.map(lambda window: self._fetch_window(*window), windows))
+                rows = None
+                if all(payload is not None for payload in payloads):
+                    rows = chain.from_iterable(payload.get('data', []) for payload in payloads)
+        if rows is not None and self.warehouse is not None:
+            rows = self._tee_to_warehouse(rows, date_from, date_to)
+        return rows
+
+    def _iter_cached_rows(self, date_from, date_to, chunk_mode, chunk_workers):
+        """Итератор строк окон кэша и сервера (см. iter_olap_rows) или None при ошибке загрузки"""
+        today = datetime.now()
+        date_to = min(date_to, datetime(today.year, today.month, today.day))
+        if date_to < date_from:
+            return iter(())
+        plan = self._plan_cache_windows(date_from, date_to, chunk_mode)
+        missing_windows = [window for window, cached in plan if not cached]
+        streamed = None
+        if len(missing_windows) == 1:
+            streamed = self._open_window_stream(*missing_windows[0])
+            if streamed is None:
+                return None
+            streamed = self.cache.put_stream(self.base_url, self.source_id, *missing_windows[0], streamed)
+        elif missing_windows:
+            with ThreadPoolExecutor(max_workers=max(1, chunk_workers), thread_name_prefix="iiko-chunk") as executor:
+                counts = list(executor.map(self._prefetch_window, missing_windows))
+            if any(count is None for count in counts):
+                return None
+        return self._chain_windows(plan, streamed, date_to)
+
+    def _chain_windows(self, plan, streamed, date_to):
+        """Перебирает строки окон по порядку; streamed - поток единственного окна с сервера"""
+        for window, cached in plan:
+            if streamed is not None and not cached:
+                rows = streamed
+            else:
+                rows = self.cache.iter_rows(self.base_url, self.source_id, *window)
+                if rows is None:
+                    # Запись успела устареть или вытесниться
+                    rows = self._fetch_cached_window(window)
+            if rows is None:
+                raise ReportFetchError(f"Не удалось получить данные за {window[0]:%d.%m.%Y}-{window[1]:%d.%m.%Y}")
+            yield from rows
+        if self.incremental is not None:
+            self.incremental.set_last_day(self.base_url, self.source_id, date_to)
+
+    def _open_window_stream(self, date_from, date_to):
+        """Открывает потоковое чтение строк пресета (или отчета OLAP v2) за одно окно дат"""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise JobCancelled()
+        if self.server_aggregation:
+            request = olap_v2_request(self.OLAP_V2_GROUP_FIELDS, self.OLAP_V2_AGGREGATE_FIELDS, date_from, date_to)
+            return self.client.stream_json(
+                "/v2/reports/olap", None, 'data', self.cancel_event, self.on_bytes, request
+            )
         date_from_str = date_from.strftime('%Y-%m-%dT00:00:00')
         date_to_str = (date_to + timedelta(days=1)).strftime('%Y-%m-%dT00:00:00')
-        url = f"{self.base_url}/v2/reports/olap/byPresetId/{self.preset_id}"
         params = {
-            'key': self.token,
             'dateFrom': date_from_str,
             'dateTo': date_to_str
         }
-        response = self.session.get(url, params=params)
-        if response.status_code == 200:
-            return response.json()
-        return None
+        return self.client.stream_json(
+            f"/v2/reports/olap/byPresetId/{self.preset_id}", params, 'data', self.cancel_event, self.on_bytes
+        )
+
+    def _fetch_window(self, date_from, date_to):
+        """Загружает пресет за одно окно дат"""
+        rows = self._open_window_stream(date_from, date_to)
+        if rows is None:
+            return None
+        return {'data': list(rows)}
 
-    def safe_get(self, dictionary, key, default=""):
-        """Безопасное получение значения из словаря"""
-        value = dictionary.get(key, default)
+
+class IikoRevenueReporter(IikoOlapReporter):
+    """Отчет "Выручка для динамики": загрузка пресета как у IikoOlapReporter и свертка группа × категория"""
+    WAREHOUSE_REPORT = "revenue"
+    # Группа блюд нужна для строк без категории (см. _aggregate_batch)
+    OLAP_V2_GROUP_FIELDS = ('RestorauntGroup', 'DishCategory', 'DishGroup')
+    OLAP_V2_AGGREGATE_FIELDS = ('DishDiscountSumInt',)
+
+    def _normalize_value(self, value):
+        """Нормализует значение измерения: строки обрезаются, прочие значения приводятся к str"""
         return value.strip() if isinstance(value, str) else str(value)
 
-    def process_report_data(self, json_data):
-        """Обработка данных отчета с улучшенной обработкой ошибок"""
-        if not json_data or not isinstance(json_data, dict) or 'data' not in json_data:
-            return None
+    def _column(self, items, key, default=''):
+        """Значения поля по всем строкам пакета; при отсутствии поля подставляется default"""
+        try:
+            return list(map(itemgetter(key), items))
+        except KeyError:
+            return [item.get(key, default) for item in items]
 
+    def _encode_column(self, values, lookup, table):
+        """Кодирует сырые значения столбца кодами нормализованных значений.
+
+        lookup (сырое значение -> код) и table (нормализованное значение -> код) пополняются
+        только новыми значениями, поэтому нормализация выполняется один раз на уникальное значение.
+        Пустым после нормализации значениям соответствует код -1.
+        """
         try:
-            groups = set()
-            categories = set()
-            data_by_group_category = defaultdict(lambda: defaultdict(float))
+            new_values = set(values).difference(lookup)
+        except TypeError:
+            # Нехешируемые значения (списки, словари) кодируются по нормализованному представлению
+            values = [self._normalize_value(value) for value in values]
+            new_values = set(values).difference(lookup)
+        for raw in new_values:
+            name = self._normalize_value(raw)
+            lookup[raw] = table.setdefault(name, len(table)) if name else -1
+        return np.fromiter(map(lookup.__getitem__, values), dtype=np.int64, count=len(values))
 
-            for item in json_data['data']:
-                if not isinstance(item, dict):
-                    continue
+    def _to_amount(self, value):
+        """Сумма строки как float; нечисловые значения считаются нулем"""
+        try:
+            return float(value)
+        except (ValueError, TypeError):
+            return 0.0
 
-                # Безопасное извлечение значений
-                group = self.safe_get(item, 'RestorauntGroup')
-                category = self.safe_get(item, 'DishCategory') or self.safe_get(item, 'DishGroup')
-                month = self.safe_get(item, 'Mounth')
+    def _amounts(self, values):
+        """Преобразует суммы в np.float64; пустые и нечисловые значения считаются нулем"""
+        try:
+            amounts = np.array(values, dtype=np.float64)
+        except (ValueError, TypeError):
+            amounts = np.array([
+                value if value.__class__ is float or value.__class__ is int else self._to_amount(value)
+                for value in values
+            ], dtype=np.float64)
+        amounts[np.isnan(amounts)] = 0.0
+        return amounts
 
-                # Пропускаем записи без категории или группы
-                if not group or not category:
-                    continue
+    def _aggregate_batch(self, items, state):
+        """Сворачивает пакет строк в суммы по парам (группа, категория) средствами NumPy"""
+        group_codes = self._encode_column(
+            self._column(items, 'RestorauntGroup'), state['group_lookup'], state['groups']
+        )
+        category_codes = self._encode_column(
+            self._column(items, 'DishCategory'), state['category_lookup'], state['categories']
+        )
+        # Если категория пуста, используется группа блюда
+        fallback = np.flatnonzero(category_codes < 0)
+        if len(fallback):
+            category_codes[fallback] = self._encode_column(
+                [items[i].get('DishGroup', '') for i in fallback.tolist()],
+                state['category_lookup'], state['categories']
+            )
+        amounts = self._amounts(self._column(items, 'DishDiscountSumInt', 0))
 
-                # Очистка и нормализация категорий
-                category = category.strip()
-                if category.startswith(" "):
-                    category = category[1:]
+        # Пропускаем записи без категории или группы
+        valid = (group_codes >= 0) & (category_codes >= 0)
+        if not valid.any():
+            return
+        category_count = len(state['categories'])
+        pairs = group_codes[valid] * category_count + category_codes[valid]
+        sums = np.bincount(pairs, weights=amounts[valid], minlength=len(state['groups']) * category_count)
+        sums = sums.tolist()
+        totals = state['totals']
+        for pair in np.flatnonzero(np.bincount(pairs)).tolist():
+            key = divmod(pair, category_count)
+            totals[key] = totals.get(key, 0.0) + sums[pair]
 
-                groups.add(group)
-                categories.add(category)
+    def process_report_data(self, json_data):
+        """Сворачивает строки отчета в таблицу группа × категория.
 
-                try:
-                    amount = float(item.get('DishDiscountSumInt', 0))
-                except (ValueError, TypeError):
-                    amount = 0.0
+        Строки обрабатываются пакетами по REVENUE_BATCH_SIZE: значения измерений кодируются
+        словарями, суммы считаются np.bincount, поэтому потоковый разбор ответа сохраняет
+        низкое потребление памяти. Результат: {'groups', 'categories', 'data', 'has_data', 'rows'}.
+        """
+        if not json_data or not isinstance(json_data, dict) or 'data' not in json_data:
+            return None
 
-                data_by_group_category[group][category] += amount
+        load_numpy()
+        try:
+            state = {
+                'group_lookup': {}, 'groups': {},
+                'category_lookup': {}, 'categories': {},
+                'totals': {}
+            }
+            rows_count = 0
+            # json_data['data'] может быть итератором потокового разбора - строки читаются пакетами
+            rows = iter(json_data['data'])
+            while True:
+                batch = list(islice(rows, REVENUE_BATCH_SIZE))
+                if not batch:
+                    break
+                rows_count += len(batch)
+                items = batch
+                if not all(map(isinstance, batch, repeat(dict))):
+                    items = [item for item in batch if isinstance(item, dict)]
+                if items:
+                    self._aggregate_batch(items, state)
 
-            if not groups or not categories:
+            if not state['totals']:
                 return None
 
+            group_names = {code: name for name, code in state['groups'].items()}
+            category_names = {code: name for name, code in state['categories'].items()}
+            data_by_group_category = defaultdict(lambda: defaultdict(float))
+            for (group_code, category_code), amount in state['totals'].items():
+                data_by_group_category[group_names[group_code]][category_names[category_code]] += amount
+
             # Преобразуем в списки и сортируем
-            groups = sorted(groups)
-            categories = sorted(categories)
+            groups = sorted(data_by_group_category)
+            categories = sorted({category for values in data_by_group_category.values() for category in values})
 
             return {
                 'groups': groups,
                 'categories': categories,
                 'data': data_by_group_category,
-                'has_data': len(groups) > 0 and len(categories) > 0
+                'has_data': len(groups) > 0 and len(categories) > 0,
+                'rows': rows_count
             }
 
-        except Exception as e:
+        except Exception:
+            logger.exception("❌ Ошибка обработки данных отчета выручки")
             return None
-        
+
+
 class WriteoffReporter:
-    def __init__(self, base_url, login, password):
+    # Справочники актов: название в кэше справочников и хранилище, атрибут словаря, метод загрузки
+    DIRECTORIES = (
+        ('stores', 'stores_cache', 'load_stores_cache'),
+        ('accounts', 'accounts_cache', 'load_accounts_cache'),
+        ('conceptions', 'conceptions_cache', 'load_conceptions_cache'),
+        ('products', 'products_cache', 'load_products_cache'),
+    )
+
+    def __init__(self, base_url, login, password, cancel_event=None, on_bytes=None, client=None,
+                 warehouse=None, base_name=None, directory_cache=None, products_on_demand=False):
         self.base_url = base_url
+        self.base_name = base_name or base_url  # Имя базы в хранилище
+        self.warehouse = warehouse  # ReportWarehouse; задан - справочники и акты сохраняются в нем
+        self.directory_cache = directory_cache  # DirectoryCache; задан - справочники берутся из него
+        self.directories_cached = 0  # Справочников, взятых из кэша при последней загрузке
+        # Товары не загружаются справочником целиком: названия ищутся только для товаров актов
+        # (resolve_product_names), сначала в хранилище, затем на сервере
+        self.products_on_demand = products_on_demand
+        self.products_stats = (0, 0, 0)  # Товаров в актах, найдено в хранилище, загружено с сервера
         self.login = login
         self.password = password
-        self.token = None
-        self.session = requests.Session()
-        self.session.verify = False
+        self.client = client or CLIENT_POOL.get(base_url, login, password)
+        self.cancel_event = cancel_event
+        self.on_bytes = on_bytes
         self.stores_cache = None
         self.accounts_cache = None
         self.conceptions_cache = None
         self.products_cache = None
 
+    @property
+    def token(self):
+        return self.client.token
+
+    @property
+    def session(self):
+        return self.client.session
+
     def auth(self):
-        """Авторизация в системе"""
-        auth_url = f"{self.base_url}/auth"
-        password_hash = hashlib.sha1(self.password.encode()).hexdigest()
-        data = {
-            'login': self.login,
-            'pass': password_hash
-        }
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-        response = self.session.post(auth_url, data=data, headers=headers)
-        if response.status_code == 200:
-            self.token = response.text.strip()
-            return True
-        return False
+        """Авторизация в системе (используется кэшированный токен общего клиента)"""
+        return self.client.auth()
+
+    def _stream_json(self, path, params, key=None):
+        """Потоковое чтение массива ответа: справочники не копируются в память целиком"""
+        return self.client.stream_json(path, params, key, self.cancel_event, self.on_bytes)
+
+    def _store_names(self, kind, names):
+        """Сохраняет загруженный справочник в кэш справочников и хранилище"""
+        if names is None:
+            return
+        if self.directory_cache is not None:
+            try:
+                self.directory_cache.put(self.base_url, kind, names)
+            except OSError as e:
+                logger.error(f"❌ {self.base_name}: не удалось записать справочник в кэш: {str(e)}")
+        if self.warehouse is None:
+            return
+        try:
+            self.warehouse.save_names(self.base_name, kind, names)
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"❌ {self.base_name}: не удалось записать справочник в хранилище: {str(e)}")
+
+    def load_directories(self, max_workers=DIRECTORY_WORKERS):
+        """Загружает справочники: актуальные берутся из кэша справочников, остальные загружаются
+        с сервера одновременно (не более max_workers запросов)"""
+        missing = []
+        for kind, attribute, loader in self.DIRECTORIES:
+            if kind == "products" and self.products_on_demand:
+                continue
+            names = self.directory_cache.get(self.base_url, kind) if self.directory_cache is not None else None
+            if names is None:
+                missing.append(getattr(self, loader))
+            else:
+                setattr(self, attribute, names)
+        self.directories_cached = len(self.DIRECTORIES) - len(missing) - int(self.products_on_demand)
+        if len(missing) == 1:
+            missing[0]()
+        elif missing:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing))),
+                                    thread_name_prefix="iiko-directory") as executor:
+                # Ошибки загрузки справочника записываются в лог самим загрузчиком, отмена прерывает отчет
+                list(executor.map(lambda load: load(), missing))
+
+    @classmethod
+    def from_warehouse(cls, warehouse, base_name, base_url):
+        """Репортер только для названий: справочники берутся из хранилища, сервер не используется"""
+        reporter = cls.__new__(cls)
+        reporter.base_url = base_url
+        reporter.base_name = base_name
+        reporter.warehouse = warehouse
+        reporter.client = None
+        reporter.directory_cache = None
+        reporter.directories_cached = 0
+        reporter.products_on_demand = False
+        reporter.products_stats = (0, 0, 0)
+        reporter.stores_cache = warehouse.load_names(base_name, "stores")
+        reporter.accounts_cache = warehouse.load_names(base_name, "accounts")
+        reporter.conceptions_cache = warehouse.load_names(base_name, "conceptions")
+        reporter.products_cache = warehouse.load_names(base_name, "products")
+        return reporter
 
     def load_stores_cache(self):
         """Загружает справочник складов"""
-        api_url = f"{self.base_url}/v2/entities/list"
+        api_path = "/v2/entities/list"
         params = {
-            'key': self.token,
             'rootType': 'Account',
             'includeDeleted': 'false'
         }
         try:
-            response = self.session.get(api_url, params=params)
-            if response.status_code == 200:
+            entities = self._stream_json(api_path, params)
+            if entities is not None:
                 self.stores_cache = {
                     str(acc["id"]): acc["name"]
-                    for acc in response.json()
+                    for acc in entities
                     if isinstance(acc, dict) and 
                     acc.get("type") == "INVENTORY_ASSETS" and 
                     "id" in acc and "name" in acc
                 }
+                self._store_names("stores", self.stores_cache)
         except Exception as e:
-            print(f"Error loading stores: {str(e)}")
+            logger.error(f"❌ Ошибка загрузки складов: {str(e)}")
 
     def load_accounts_cache(self):
         """Загружает справочник счетов"""
-        api_url = f"{self.base_url}/v2/entities/accounts/list"
-        params = {'key': self.token, 'includeDeleted': 'false'}
+        api_path = "/v2/entities/accounts/list"
+        params = {'includeDeleted': 'false'}
         try:
-            response = self.session.get(api_url, params=params)
-            if response.status_code == 200:
+            entities = self._stream_json(api_path, params)
+            if entities is not None:
                 self.accounts_cache = {
                     str(acc["id"]): acc["name"]
-                    for acc in response.json()
+                    for acc in entities
                     if isinstance(acc, dict) and "id" in acc and "name" in acc
                 }
+                self._store_names("accounts", self.accounts_cache)
         except Exception as e:
-            print(f"Error loading accounts: {str(e)}")
+            logger.error(f"❌ Ошибка загрузки счетов: {str(e)}")
 
     def load_conceptions_cache(self):
         """Загружает справочник концепций"""
-        api_url = f"{self.base_url}/v2/entities/list"
+        api_path = "/v2/entities/list"
         params = {
-            'key': self.token,
             'rootType': 'Conception',
             'includeDeleted': 'false'
         }
         try:
-            response = self.session.get(api_url, params=params)
-            if response.status_code == 200:
+            entities = self._stream_json(api_path, params)
+            if entities is not None:
                 self.conceptions_cache = {
                     str(item["id"]): item["name"]
-                    for item in response.json()
+                    for item in entities
                     if isinstance(item, dict) and 
                     item.get("rootType") == "Conception" and 
                     "id" in item and "name" in item
                 }
+                self._store_names("conceptions", self.conceptions_cache)
         except Exception as e:
-            print(f"Error loading conceptions: {str(e)}")
+            logger.error(f"❌ Ошибка загрузки концепций: {str(e)}")
 
     def load_products_cache(self):
         """Загружает справочник товаров"""
-        api_url = f"{self.base_url}/v2/entities/products/list"
-        params = {'key': self.token}
+        api_path = "/v2/entities/products/list"
+        params = {}
         try:
-            response = self.session.get(api_url, params=params)
-            if response.status_code == 200:
+            entities = self._stream_json(api_path, params)
+            if entities is not None:
                 self.products_cache = {
                     product["id"]: product["name"]
-                    for product in response.json()
+                    for product in entities
                     if isinstance(product, dict) and 
                     "id" in product and "name" in product
                 }
+                self._store_names("products", self.products_cache)
         except Exception as e:
-            print(f"Error loading products: {str(e)}")
+            logger.error(f"❌ Ошибка загрузки товаров: {str(e)}")
 
-    def fetch_writeoff_docs(self, date_from, date_to):
-        """Получает акты списания за период"""
-        api_url = f"{self.base_url}/v2/documents/writeoff"
-        params = {
-            'key': self.token,
-            'dateFrom': date_from.strftime('%Y-%m-%d'),
-            'dateTo': date_to.strftime('%Y-%m-%d')
+    def resolve_product_names(self, docs, batch_size=PRODUCT_BATCH_SIZE, max_workers=DIRECTORY_WORKERS):
+        """Находит названия товаров, которые встречаются в актах docs.
+
+        Названия берутся из хранилища (индекс id -> название сохраняется между запусками),
+        отсутствующие запрашиваются у сервера пакетами по batch_size id (не более max_workers
+        запросов одновременно) и добавляются в хранилище. Возвращает число товаров в актах.
+        """
+        ids = {
+            str(item['productId'])
+            for doc in docs if isinstance(doc, dict)
+            for item in doc.get('items') or [] if isinstance(item, dict) and item.get('productId')
         }
+        names = {}
+        if self.warehouse is not None and ids:
+            try:
+                names = self.warehouse.lookup_names(self.base_name, "products", ids)
+            except (sqlite3.Error, OSError) as e:
+                logger.error(f"❌ {self.base_name}: не удалось прочитать названия товаров из хранилища: {str(e)}")
+        missing = sorted(ids.difference(names))
+        batches = [missing[start:start + batch_size] for start in range(0, len(missing), batch_size)]
+
+        def fetch_batch(batch):
+            try:
+                entities = self._stream_json("/v2/entities/products/list", {'ids': batch})
+                if entities is None:
+                    return {}
+                return {
+                    str(product["id"]): product["name"]
+                    for product in entities
+                    if isinstance(product, dict) and "id" in product and "name" in product
+                }
+            except Exception as e:
+                logger.error(f"❌ Ошибка загрузки товаров: {str(e)}")
+                return {}
+
+        fetched = {}
+        if len(batches) == 1:
+            fetched = fetch_batch(batches[0])
+        elif batches:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches))),
+                                    thread_name_prefix="iiko-products") as executor:
+                for batch_names in executor.map(fetch_batch, batches):
+                    fetched.update(batch_names)
+        if fetched and self.warehouse is not None:
+            try:
+                self.warehouse.add_names(self.base_name, "products", fetched)
+            except (sqlite3.Error, OSError) as e:
+                logger.error(f"❌ {self.base_name}: не удалось записать названия товаров в хранилище: {str(e)}")
+        names.update(fetched)
+        self.products_cache = {**(self.products_cache or {}), **names}
+        self.products_stats = (len(ids), len(ids) - len(missing), len(fetched))
+        return len(ids)
+
+    def fetch_writeoff_docs(self, date_from, date_to, chunk_mode=None, chunk_workers=DEFAULT_CHUNK_WORKERS):
+        """Получает акты списания за период.
+
+        При заданном chunk_mode ("day", "week", "month" или "auto") период разбивается на окна,
+        которые загружаются параллельно (не более chunk_workers одновременно). Акты окон
+        объединяются без повторов (по id) и упорядочиваются по дате.
+        """
         try:
-            response = self.session.get(api_url, params=params)
-            if response.status_code == 200:
-                return response.json().get("response", [])
-            return None
+            windows = split_date_range(date_from, date_to, resolve_chunk_mode(chunk_mode, date_from, date_to))
+            if len(windows) == 1:
+                window_docs = [self._fetch_writeoff_window(date_from, date_to)]
+            else:
+                with ThreadPoolExecutor(max_workers=max(1, chunk_workers), thread_name_prefix="iiko-chunk") as executor:
+                    window_docs = list(executor.map(lambda window: self._fetch_writeoff_window(*window), windows))
+            if any(docs is None for docs in window_docs):
+                return None
+            # Порядок актов не зависит от разбивки: всегда по дате
+            docs = self.merge_writeoff_docs(window_docs)
+            if self.warehouse is not None:
+                try:
+                    self.warehouse.save_writeoff_docs(self.base_name, self.base_url, date_from, date_to, docs)
+                except (sqlite3.Error, OSError) as e:
+                    logger.error(f"❌ {self.base_name}: не удалось записать акты списания в хранилище: {str(e)}")
+            return docs
         except Exception as e:
-            print(f"Error fetching writeoff docs: {str(e)}")
+            logger.error(f"❌ Ошибка получения актов списания: {str(e)}")
             return None
 
+    def _fetch_writeoff_window(self, date_from, date_to):
+        """Загружает акты списания за одно окно дат; None - сервер не вернул данные"""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise JobCancelled()
+        params = {
+            'dateFrom': date_from.strftime('%Y-%m-%d'),
+            'dateTo': date_to.strftime('%Y-%m-%d')
+        }
+        docs = self._stream_json("/v2/documents/writeoff", params, key="response")
+        return list(docs) if docs is not None else None
+
+    @staticmethod
+    def merge_writeoff_docs(window_docs):
+        """Объединяет акты окон: акт, попавший в несколько окон, остается один раз; порядок - по дате"""
+        merged = {}
+        for docs in window_docs:
+            for doc in docs:
+                if not isinstance(doc, dict):
+                    continue
+                key = doc.get('id') or f"{doc.get('dateIncoming')}|{doc.get('documentNumber')}"
+                merged[key] = doc
+        # Сортировка устойчива: акты с одинаковой датой остаются в порядке ответа сервера
+        return sorted(merged.values(), key=lambda doc: str(doc.get('dateIncoming') or ''))
+
     def get_store_name(self, store_id):
         return self.stores_cache.get(store_id, 'Неизвестно') if self.stores_cache else 'Неизвестно'
 
@@ -1252,7 +4867,506 @@ class WriteoffReporter:
         return {'NEW': 'Новый', 'PROCESSED': 'Да', 'DELETED': 'Удалённый'}.get(status, status)
 
 
-if __name__ == "__main__":
+class PrefetchScheduler:
+    """Предзагрузка по расписанию: отчеты выбранных баз загружаются заранее, без окна.
+
+    Строки пресетов попадают в кэш окон и локальное хранилище, акты списания и справочники -
+    в хранилище, поэтому утренний экспорт не ждет серверы iiko. Старт запуска смещается на
+    случайные 0..jitter секунд, старт каждой базы - на 0..base_jitter секунд, а с одного сервера
+    одновременно загружается не больше per_host баз.
+    """
+
+    def __init__(self, runner, selected_bases, login, password, times=PREFETCH_TIMES, periods=PREFETCH_PERIODS,
+                 reports=PREFETCH_REPORTS, jitter=PREFETCH_JITTER_SECONDS, base_jitter=PREFETCH_BASE_JITTER_SECONDS,
+                 per_host=PREFETCH_PER_HOST, max_workers=DEFAULT_MAX_WORKERS, server_aggregation=False):
+        self.runner = runner
+        self.selected_bases = selected_bases
+        self.login = login
+        self.password = password
+        self.times = sorted(datetime.strptime(value, '%H:%M').time() for value in times)
+        self.periods = periods
+        self.reports = reports
+        self.jitter = max(0, jitter)
+        self.max_workers = max(1, max_workers)
+        self.server_aggregation = server_aggregation
+        runner.host_limiter = HostLimiter(per_host)
+        runner.start_jitter = max(0, base_jitter)
+
+    def next_run(self, now):
+        """Ближайшее время запуска после now"""
+        for run_time in self.times:
+            planned = datetime.combine(now.date(), run_time)
+            if planned > now:
+                return planned
+        return datetime.combine(now.date() + timedelta(days=1), self.times[0])
+
+    def run_forever(self):
+        """Выполняет запуски по расписанию до отмены (Ctrl+C)"""
+        cancel_event = self.runner.jobs.cancel_event
+        while True:
+            now = datetime.now()
+            planned = self.next_run(now) + timedelta(seconds=random.uniform(0, self.jitter))
+            self.runner.log_message(f"Следующая предзагрузка: {planned.strftime('%d.%m.%Y %H:%M:%S')}")
+            if cancel_event.wait((planned - now).total_seconds()):
+                return
+            self.run_once()
+
+    def run_once(self):
+        """Загружает все отчеты за все периоды; возвращает True, если все базы загружены"""
+        started = time.perf_counter()
+        all_ok = True
+        try:
+            for period in self.periods:
+                start_date, end_date = period_dates(period)
+                for report in self.reports:
+                    self.runner.jobs.check_cancelled()
+                    self.runner.log_message(
+                        f"Предзагрузка {report} за период '{period}': "
+                        f"{start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}"
+                    )
+                    # Метрики этапов собираются отдельно для каждого отчета и периода
+                    results = self.runner.measured(
+                        f"Предзагрузка {report} ({period})", lambda: self._prefetch(report, start_date, end_date)
+                    )
+                    self.runner.log_fetch_summary(results, self.selected_bases)
+                    all_ok = all_ok and all(result.ok for result in results.values())
+        finally:
+            # Сессии освобождаются после каждого запуска, чтобы не занимать лицензии до следующего
+            CLIENT_POOL.logout_all()
+            SNAPSHOTS.flush(timeout=60)
+        status = "✅" if all_ok else "⚠"
+        self.runner.log_message(f"{status} Предзагрузка завершена за {time.perf_counter() - started:.1f} с")
+        return all_ok
+
+    def _prefetch(self, report, start_date, end_date):
+        """Загружает один отчет выбранных баз; данные сохраняются в кэш и хранилище загрузчиками"""
+        runner = self.runner
+        if report == "plans":
+            return runner.fetch_plans(
+                self.selected_bases, self.login, self.password, start_date, end_date, self.max_workers, "auto",
+                server_aggregation=self.server_aggregation
+            )
+        if report == "revenue":
+            return runner.fetch_revenue(
+                self.selected_bases, self.login, self.password, start_date, end_date, self.max_workers, "auto",
+                server_aggregation=self.server_aggregation
+            )
+
+        def on_result(result):
+            if result.ok:
+                runner.log_message(f"✅ Акты списания {result.base_name}: {len(result.data[1])}")
+            else:
+                runner.log_message(f"❌ {result.error}")
+
+        fetch = lambda name: runner._fetch_writeoff_data(
+            name, self.login, self.password, start_date, end_date, chunk_mode="auto"
+        )
+        return runner.run_parallel_fetch(self.selected_bases, fetch, on_result, self.max_workers)
+
+
+def build_arg_parser():
+    """Параметры командной строки пакетного режима"""
+    parser = argparse.ArgumentParser(
+        prog="IIKO_Report",
+        description="Отчеты iiko. Без аргументов открывается окно программы, "
+                    "с командой отчет строится без окна и сохраняется в Excel."
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="команда")
+    subparsers.add_parser("bases", help="список баз из файла конфигурации").add_argument(
+        "--config", default=BASES_CONFIG_PATH, help="файл конфигурации баз"
+    )
+    clear = subparsers.add_parser("clear-directories", help="сбросить кэш справочников актов списания")
+    clear.add_argument("--config", default=BASES_CONFIG_PATH, help="файл конфигурации баз")
+    clear.add_argument("--bases", nargs="+", metavar="БАЗА", help="базы из конфигурации (по умолчанию все)")
+    commands = {
+        "plans": "отчет \"Планы\"",
+        "revenue": "отчет \"Выручка динамика\"",
+        "writeoff": "акты списания",
+    }
+    warehouse = subparsers.add_parser("warehouse", help="сводки по локальному хранилищу, без обращения к серверам")
+    warehouse.add_argument("query", choices=["loads", "revenue", "plans"],
+                           help="loads - загрузки, revenue - выручка баз по группам и категориям, "
+                                "plans - итоги \"Планы\" по базам и группам")
+    warehouse.add_argument("--bases", nargs="+", metavar="БАЗА", help="базы (по умолчанию все из хранилища)")
+    warehouse.add_argument("--report", choices=["plans", "revenue", "writeoff"], help="отчет (для loads)")
+    warehouse.add_argument("--period", choices=PERIODS[:-1], default="Текущий месяц",
+                           help="период загрузки отчета")
+    warehouse.add_argument("--from", dest="date_from", metavar="ДД.ММ.ГГГГ", help="начало периода (вместо --period)")
+    warehouse.add_argument("--to", dest="date_to", metavar="ДД.ММ.ГГГГ", help="конец периода (вместо --period)")
+    warehouse.add_argument("--compare-period", choices=PERIODS[:-1], help="период для сравнения")
+    warehouse.add_argument("--compare-from", metavar="ДД.ММ.ГГГГ", help="начало периода для сравнения")
+    warehouse.add_argument("--compare-to", metavar="ДД.ММ.ГГГГ", help="конец периода для сравнения")
+    warehouse.add_argument("--log-level", choices=["debug", "info", "warning"], default="info", help="уровень лога")
+    schedule = subparsers.add_parser("schedule", help="предзагрузка отчетов по расписанию в кэш и хранилище")
+    schedule.add_argument("--config", default=BASES_CONFIG_PATH, help="файл конфигурации баз")
+    schedule.add_argument("--bases", nargs="+", metavar="БАЗА", help="базы из конфигурации (по умолчанию все)")
+    schedule.add_argument("--at", action="append", metavar="ЧЧ:ММ",
+                          help=f"время запуска, можно несколько раз (по умолчанию {', '.join(PREFETCH_TIMES)})")
+    schedule.add_argument("--period", action="append", choices=PERIODS[:-1],
+                          help=f"период, можно несколько раз (по умолчанию: {', '.join(PREFETCH_PERIODS)})")
+    schedule.add_argument("--reports", nargs="+", choices=PREFETCH_REPORTS, default=list(PREFETCH_REPORTS),
+                          help="загружаемые отчеты")
+    schedule.add_argument("--once", action="store_true", help="выполнить одну предзагрузку сразу и завершиться")
+    schedule.add_argument("--jitter", type=int, default=PREFETCH_JITTER_SECONDS, metavar="СЕК",
+                          help="случайная задержка старта запуска")
+    schedule.add_argument("--base-jitter", type=int, default=PREFETCH_BASE_JITTER_SECONDS, metavar="СЕК",
+                          help="случайная задержка старта каждой базы")
+    schedule.add_argument("--per-host", type=int, default=PREFETCH_PER_HOST,
+                          help="баз одного сервера одновременно")
+    schedule.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS, help="баз одновременно")
+    schedule.add_argument("--server-aggregation", action="store_true",
+                          help="сворачивать \"Планы\" и выручку на сервере (отчет OLAP v2 вместо пресета)")
+    schedule.add_argument("--login", default=os.environ.get("IIKO_LOGIN"), help="логин (или переменная IIKO_LOGIN)")
+    schedule.add_argument("--password", default=os.environ.get("IIKO_PASSWORD"),
+                          help="пароль (или переменная IIKO_PASSWORD)")
+    schedule.add_argument("--log-level", choices=["debug", "info", "warning"], default="info", help="уровень лога")
+    schedule.add_argument("--log-file", action="store_true", help=f"дублировать лог в {LOG_FILE}")
+    schedule.add_argument("--trace-memory", action="store_true", help="замерять пик памяти этапов (медленнее)")
+    for command, title in commands.items():
+        sub = subparsers.add_parser(command, help=title)
+        sub.add_argument("--config", default=BASES_CONFIG_PATH, help="файл конфигурации баз")
+        sub.add_argument("--bases", nargs="+", metavar="БАЗА", help="базы из конфигурации (по умолчанию все)")
+        sub.add_argument("--period", choices=PERIODS[:-1], default="Текущий месяц", help="период отчета")
+        sub.add_argument("--from", dest="date_from", metavar="ДД.ММ.ГГГГ", help="начало периода (вместо --period)")
+        sub.add_argument("--to", dest="date_to", metavar="ДД.ММ.ГГГГ", help="конец периода (вместо --period)")
+        sub.add_argument("--output", "-o", help="путь Excel-файла (по умолчанию - как в окне программы)")
+        sub.add_argument("--login", default=os.environ.get("IIKO_LOGIN"), help="логин (или переменная IIKO_LOGIN)")
+        sub.add_argument("--password", default=os.environ.get("IIKO_PASSWORD"),
+                         help="пароль (или переменная IIKO_PASSWORD)")
+        sub.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS, help="баз одновременно")
+        sub.add_argument("--from-warehouse", action="store_true", help="взять данные из локального хранилища")
+        cassette = sub.add_mutually_exclusive_group()
+        cassette.add_argument("--record", metavar="ПУТЬ", help="записать обмены с серверами iiko в кассету")
+        cassette.add_argument("--replay", metavar="ПУТЬ", help="взять ответы серверов из кассеты, без сети")
+        sub.add_argument("--replay-timing", choices=REPLAY_TIMINGS, default="max",
+                         help="воспроизведение с исходными задержками сервера или без задержек")
+        sub.add_argument("--chunk", choices=[mode or "none" for mode in CHUNK_MODES.values()], default="auto",
+                         help="разбивка периода на окна (none - без разбивки)")
+        if command != "writeoff":
+            sub.add_argument("--no-cache", action="store_true", help="загрузить все окна с сервера заново")
+            sub.add_argument("--recheck-days", type=int, metavar="ДНЕЙ",
+                             help="инкрементальный режим: перепроверять последние ДНЕЙ дней")
+            sub.add_argument("--server-aggregation", action="store_true",
+                             help="сворачивать данные на сервере (отчет OLAP v2 вместо пресета)")
+            sub.add_argument("--pipeline", action="store_true",
+                             help="строить лист базы сразу после ее загрузки, пока остальные базы загружаются")
+        if command == "writeoff":
+            sub.add_argument("--all-products", action="store_true",
+                             help="загрузить весь справочник товаров (по умолчанию - только товары актов)")
+        if command == "plans":
+            sub.add_argument("--totals", choices=sorted(set(TOTALS_MODES.values())), default="sum",
+                             help="итоги недель и групп: формулы SUM, значения или формулы SUBTOTAL")
+        sub.add_argument("--log-level", choices=["debug", "info", "warning"], default="info", help="уровень лога")
+        sub.add_argument("--log-file", action="store_true", help=f"дублировать лог в {LOG_FILE}")
+        sub.add_argument("--metrics", metavar="ПУТЬ", help=f"JSON-файл метрик этапов (по умолчанию - в {METRICS_DIR})")
+        sub.add_argument("--trace-memory", action="store_true", help="замерять пик памяти этапов (медленнее)")
+    return parser
+
+
+def batch_period(args):
+    """Период пакетного отчета: --from/--to или --period"""
+    if args.date_from or args.date_to:
+        start_date = datetime.strptime(args.date_from or args.date_to, '%d.%m.%Y')
+        end_date = datetime.strptime(args.date_to or args.date_from, '%d.%m.%Y')
+        return start_date, end_date
+    return period_dates(args.period)
+
+
+def compare_period(args):
+    """Период сравнения сводки хранилища: --compare-from/--compare-to, --compare-period или None"""
+    if args.compare_from or args.compare_to:
+        start_date = datetime.strptime(args.compare_from or args.compare_to, '%d.%m.%Y')
+        end_date = datetime.strptime(args.compare_to or args.compare_from, '%d.%m.%Y')
+        return start_date, end_date
+    if args.compare_period:
+        return period_dates(args.compare_period)
+    return None
+
+
+def setup_batch_logging(args):
+    """Лог пакетного режима: stderr и, по флагу --log-file, файл LOG_FILE"""
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s", "%H:%M:%S"))
+    logger.addHandler(handler)
+    logger.setLevel(getattr(logging, getattr(args, "log_level", "info").upper()))
+    if getattr(args, "log_file", False):
+        try:
+            os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+            file_handler = RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8"
+            )
+            file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+            logger.addHandler(file_handler)
+        except OSError as e:
+            logger.warning(f"⚠ Не удалось открыть файл лога {LOG_FILE}: {str(e)}")
+
+
+def batch_bases(runner, args):
+    """Базы пакетного режима: --bases или все базы конфигурации; None, если есть неизвестные"""
+    selected_bases = args.bases or list(runner.available_bases)
+    unknown = [base_name for base_name in selected_bases if base_name not in runner.available_bases]
+    if unknown:
+        logger.error(f"❌ Базы нет в конфигурации: {', '.join(unknown)}")
+        return None
+    return selected_bases
+
+
+def batch_cassette(args):
+    """Кассета пакетного режима по --record/--replay; подключается к общему пулу соединений"""
+    path = args.record or args.replay
+    if not path:
+        return None
+    cassette = HttpCassette(path, "record" if args.record else "replay", args.replay_timing)
+    CLIENT_POOL.use_cassette(cassette)
+    if args.replay:
+        # Логин и пароль в кассету не записываются, при воспроизведении подойдут любые
+        args.login = args.login or "replay"
+        args.password = args.password or "replay"
+    if getattr(args, "no_cache", None) is False:
+        # Кэш OLAP не читается: при записи все окна должны попасть в кассету, при воспроизведении - прийти из нее
+        args.no_cache = True
+    return cassette
+
+
+def log_cassette_stats(cassette):
+    """Итог записи или воспроизведения кассеты"""
+    if cassette.mode == "record":
+        logger.info(f"Кассета {cassette.path}: записано обменов {cassette.recorded}")
+    elif cassette.missed:
+        logger.warning(
+            f"⚠ Кассета {cassette.path}: воспроизведено обменов {cassette.recorded}, нет в кассете {cassette.missed}"
+        )
+    else:
+        logger.info(f"Кассета {cassette.path}: воспроизведено обменов {cassette.recorded}")
+
+
+def run_schedule(args):
+    """Предзагрузка по расписанию (или однократно с --once); возвращает код завершения процесса"""
+    setup_batch_logging(args)
+    jobs = BatchJobContext()
+    runner = IikoReportRunner(jobs, args.config)
+    if not runner.available_bases:
+        return 2
+    selected_bases = batch_bases(runner, args)
+    if selected_bases is None:
+        return 2
+    if not args.login or not args.password:
+        logger.error("❌ Укажите --login и --password (или переменные IIKO_LOGIN и IIKO_PASSWORD)")
+        return 2
+    try:
+        scheduler = PrefetchScheduler(
+            runner, selected_bases, args.login, args.password,
+            times=args.at or PREFETCH_TIMES,
+            periods=args.period or PREFETCH_PERIODS,
+            reports=args.reports,
+            jitter=args.jitter,
+            base_jitter=args.base_jitter,
+            per_host=args.per_host,
+            max_workers=args.workers,
+            server_aggregation=args.server_aggregation
+        )
+        runner.trace_memory = args.trace_memory
+    except ValueError as e:
+        logger.error(f"❌ Неверное время запуска: {str(e)}")
+        return 2
+    try:
+        if args.once:
+            return 0 if scheduler.run_once() else 3
+        scheduler.run_forever()
+    except (KeyboardInterrupt, JobCancelled):
+        jobs.cancel_event.set()
+        logger.warning("⚠ Предзагрузка остановлена")
+        return 130
+    finally:
+        CLIENT_POOL.logout_all()
+        SNAPSHOTS.flush(timeout=10)
+    return 0
+
+
+def format_total(value):
+    """Итог для вывода: целые числа без дробной части, остальные - с точностью до копеек"""
+    value = value or 0
+    return str(int(value)) if float(value).is_integer() else f"{value:.2f}"
+
+
+def warehouse_table(key_headers, value_headers, current, previous=None):
+    """Строки таблицы сводки (через табуляцию): {ключ: итоги} и, при сравнении, итоги периода сравнения"""
+    headers = list(key_headers)
+    for header in value_headers:
+        headers.extend([header, f"{header} (сравнение)", f"{header} Δ%"] if previous is not None else [header])
+    lines = ['\t'.join(headers)]
+    keys = set(current) | set(previous or ())
+    empty = (0,) * len(value_headers)
+    for key in sorted(keys, key=lambda key: [part or '' for part in key]):
+        cells = [part or '' for part in key]
+        values = current.get(key, empty)
+        if previous is None:
+            cells.extend(format_total(value) for value in values)
+        else:
+            for value, base in zip(values, previous.get(key, empty)):
+                change = f"{((value or 0) - base) / base * 100:+.1f}" if base else ''
+                cells.extend([format_total(value), format_total(base), change])
+        lines.append('\t'.join(cells))
+    return lines
+
+
+def run_warehouse(args):
+    """Сводки по локальному хранилищу (выручка нескольких баз, итоги планов, сравнение периодов) без
+    обращения к серверам; печатает таблицу через табуляцию и возвращает код завершения процесса"""
+    setup_batch_logging(args)
+    if args.query == "loads":
+        print('\t'.join(("Отчет", "База", "С", "По", "Загружено", "Строк")))
+        for load in WAREHOUSE.list_loads(args.report, args.bases):
+            print('\t'.join(str(value) for value in load))
+        return 0
+    try:
+        start_date, end_date = batch_period(args)
+        compare = compare_period(args)
+    except ValueError as e:
+        logger.error(f"❌ Неверная дата: {str(e)}")
+        return 2
+    if args.query == "revenue":
+        key_headers, value_headers = ("Группа", "Категория"), ("Выручка",)
+
+        def totals(date_from, date_to):
+            rollup = WAREHOUSE.revenue_rollup(date_from, date_to, args.bases)
+            return {key: (total,) for key, total in rollup.items()}
+    else:
+        key_headers, value_headers = ("База", "Группа"), ("Выручка", "Гости", "Блюда", "Чеки")
+
+        def totals(date_from, date_to):
+            return WAREHOUSE.plan_totals(date_from, date_to, args.bases)
+
+    current = totals(start_date, end_date)
+    previous = totals(*compare) if compare else None
+    if not current and not previous:
+        # Строки хранятся по периоду загрузки: сводка строится за тот же период, за который загружался отчет
+        logger.warning(
+            f"⚠ В хранилище нет загрузок за {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}"
+        )
+        return 1
+    for line in warehouse_table(key_headers, value_headers, current, previous):
+        print(line)
+    return 0
+
+
+def run_batch(args):
+    """Строит отчет без окна; возвращает код завершения процесса"""
+    setup_batch_logging(args)
+    jobs = BatchJobContext()
+    runner = IikoReportRunner(jobs, args.config)
+    if not runner.available_bases:
+        return 2
+    if args.command == "bases":
+        for base_name in runner.available_bases:
+            print(base_name)
+        return 0
+    if args.command == "clear-directories":
+        selected_bases = batch_bases(runner, args)
+        if selected_bases is None:
+            return 2
+        removed = runner.clear_directory_cache(selected_bases)
+        runner.log_message(f"✅ Кэш справочников сброшен (баз: {len(selected_bases)}, записей: {removed})")
+        return 0
+
+    selected_bases = batch_bases(runner, args)
+    if selected_bases is None:
+        return 2
+    try:
+        start_date, end_date = batch_period(args)
+    except ValueError as e:
+        logger.error(f"❌ Неверная дата: {str(e)}")
+        return 2
+    try:
+        cassette = batch_cassette(args)
+    except (OSError, EOFError, ValueError) as e:
+        logger.error(f"❌ Не удалось открыть кассету: {str(e)}")
+        return 2
+    if not args.from_warehouse and (not args.login or not args.password):
+        logger.error("❌ Укажите --login и --password (или переменные IIKO_LOGIN и IIKO_PASSWORD)")
+        return 2
+    max_workers = max(1, args.workers)
+    started = time.perf_counter()
+    runner.log_message(f"Период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}, баз: {len(selected_bases)}")
+    runner.trace_memory = args.trace_memory
+    runner.start_metrics(args.command)
+    try:
+        chunk_mode = None if args.chunk == "none" else args.chunk
+        if not args.from_warehouse:
+            runner.log_chunk_mode(chunk_mode, start_date, end_date, cached=args.command != "writeoff")
+        if args.command == "writeoff":
+            results, filename = runner._build_writeoff_report(
+                selected_bases, args.login, args.password, start_date, end_date, max_workers,
+                args.from_warehouse, args.output, not args.all_products, chunk_mode
+            )
+            saved = filename is not None
+        elif args.pipeline:
+            if args.command == "plans":
+                results, filename = runner.build_plans_report(
+                    selected_bases, args.login, args.password, start_date, end_date, max_workers, chunk_mode,
+                    args.no_cache, args.recheck_days, args.from_warehouse, args.server_aggregation, args.totals,
+                    args.output
+                )
+            else:
+                results, filename = runner.build_revenue_report(
+                    selected_bases, args.login, args.password, start_date, end_date, max_workers, chunk_mode,
+                    args.no_cache, args.recheck_days, args.from_warehouse, args.server_aggregation, args.output
+                )
+            saved = filename is not None
+        else:
+            fetch = runner.fetch_plans if args.command == "plans" else runner.fetch_revenue
+            results = fetch(
+                selected_bases, args.login, args.password, start_date, end_date, max_workers,
+                chunk_mode, args.no_cache, args.recheck_days, args.from_warehouse, args.server_aggregation
+            )
+            runner.log_fetch_summary(results, selected_bases)
+            if args.command == "plans":
+                runner.report_data = runner.plans_data(selected_bases, results)
+                saved = bool(runner.report_data) and runner._export_plans(
+                    start_date, end_date, args.totals, args.output
+                ) is not None
+            else:
+                runner.revenue_data = runner.successful_data(selected_bases, results)
+                saved = bool(runner.revenue_data) and runner._export_revenue(
+                    start_date, end_date, args.output
+                ) is not None
+    except (KeyboardInterrupt, JobCancelled):
+        jobs.cancel_event.set()
+        logger.warning("⚠ Отчет прерван")
+        return 130
+    finally:
+        runner.finish_metrics(args.metrics)
+        CLIENT_POOL.logout_all()
+        if cassette is not None:
+            log_cassette_stats(cassette)
+            CLIENT_POOL.use_cassette(None)
+        # Дописываем снимки, ожидающие записи
+        SNAPSHOTS.flush(timeout=10)
+    runner.log_message(
+        f"Готово за {time.perf_counter() - started:.1f} с: загружено {jobs.counters['bytes']} байт, "
+        f"строк {jobs.counters['rows']}"
+    )
+    if not saved:
+        runner.log_message("❌ Отчет не сохранен")
+        return 1
+    return 0 if all(result.ok for result in results.values()) else 3
+
+
+def main(argv=None):
+    """Точка входа: без команды - окно программы, с командой - пакетный отчет"""
+    args = build_arg_parser().parse_args(argv)
+    if args.command == "schedule":
+        return run_schedule(args)
+    if args.command == "warehouse":
+        return run_warehouse(args)
+    if args.command:
+        return run_batch(args)
+    load_gui_modules()
     root = tk.Tk()
     app = IikoOlapReporterGUI(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,227 @@
+"""Бенчмарк загрузчиков и Excel-экспорта на mock-сервере iiko и синтетических данных.
+
+Для каждого размера (по умолчанию 1 000, 100 000 и 1 000 000 строк) измеряет:
+- пропускную способность (строк/с) и общее время;
+- задержку - ожидание ответа сервера до заголовков (для загрузчиков);
+- пик памяти Python (tracemalloc, отдельным прогоном, чтобы не искажать время).
+
+Загрузчики обращаются к MockIikoServer через обычный пул соединений (*_olap - в режиме
+свертки на сервере, строк в таблице столько, сколько вернул сервер), экспорт пишет
+книгу во временный файл. Для актов списания размер задает число позиций
+(актов в synthetic.ITEMS_PER_DOC раз меньше).
+
+Запуск из корня репозитория:
+    python benchmarks/bench_reporters.py
+    python benchmarks/bench_reporters.py --rows 100000 --only plans_fetch --only plans_export --latency 0.2
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import synthetic
+from mock_iiko_server import MockIikoServer
+from IIKO_Report import (
+    CLIENT_POOL, ExcelReportWriter, IikoOlapReporter, IikoRevenueReporter, OlapColumns, WriteoffReporter,
+    load_excel_modules, load_numpy
+)
+
+DATE_TO = synthetic.DATE_FROM + timedelta(days=29)
+
+
+def _save(writer):
+    """Сохраняет книгу во временный файл и удаляет его"""
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        writer.save(path)
+    finally:
+        os.remove(path)
+
+
+def _writeoff_reporter(url):
+    """Репортер со справочниками из synthetic (без обращения к серверу)"""
+    reporter = WriteoffReporter(url, "bench", "bench")
+    reporter.stores_cache = {item['id']: item['name'] for item in synthetic.stores()}
+    reporter.accounts_cache = {item['id']: item['name'] for item in synthetic.accounts()}
+    reporter.conceptions_cache = {item['id']: item['name'] for item in synthetic.conceptions()}
+    reporter.products_cache = {item['id']: item['name'] for item in synthetic.products()}
+    return reporter
+
+
+# Каждый бенчмарк: prepare(server, size) -> state (не входит в замер), run(state) -> (строк, клиент или None)
+
+def prepare_plans_fetch(server, size):
+    server.rows = size
+    return IikoOlapReporter(server.url, "bench", "bench", "plans")
+
+
+def run_plans_fetch(reporter):
+    data = reporter.get_olap_report(synthetic.DATE_FROM, DATE_TO)
+    return len(data['data']), reporter.client
+
+
+def prepare_plans_fetch_olap(server, size):
+    server.rows = size
+    return IikoOlapReporter(server.url, "bench", "bench", "plans", server_aggregation=True)
+
+
+def prepare_plans_columns(server, size):
+    return list(synthetic.plan_rows(size))
+
+
+def run_plans_columns(rows):
+    return len(OlapColumns.from_records(rows)), None
+
+
+def prepare_plans_export(server, size):
+    return OlapColumns.from_records(synthetic.plan_rows(size))
+
+
+def run_plans_export(columns):
+    writer = ExcelReportWriter()
+    rows = writer.add_plans_sheet("Бенчмарк", columns, synthetic.DATE_FROM, DATE_TO)
+    _save(writer)
+    return rows, None
+
+
+def prepare_revenue_fetch(server, size):
+    server.rows = size
+    return IikoRevenueReporter(server.url, "bench", "bench", "revenue")
+
+
+def run_revenue_fetch(reporter):
+    # Без кэша и разбивки строки сворачиваются по мере чтения ответа
+    rows = reporter.iter_olap_rows(synthetic.DATE_FROM, DATE_TO)
+    processed = reporter.process_report_data({'data': rows})
+    return processed['rows'], reporter.client
+
+
+def prepare_revenue_fetch_olap(server, size):
+    server.rows = size
+    return IikoRevenueReporter(server.url, "bench", "bench", "revenue", server_aggregation=True)
+
+
+def prepare_revenue_export(server, size):
+    reporter = IikoRevenueReporter(server.url, "bench", "bench", "revenue")
+    return reporter.process_report_data({'data': synthetic.revenue_rows(size)})
+
+
+def run_revenue_export(data):
+    writer = ExcelReportWriter()
+    writer.add_revenue_sheet("Бенчмарк", data, synthetic.DATE_FROM, DATE_TO)
+    _save(writer)
+    return len(data['groups']) * len(data['categories']), None
+
+
+def prepare_writeoff_fetch(server, size):
+    server.docs = max(1, size // synthetic.ITEMS_PER_DOC)
+    return WriteoffReporter(server.url, "bench", "bench")
+
+
+def run_writeoff_fetch(reporter):
+    reporter.load_directories()
+    docs = reporter.fetch_writeoff_docs(synthetic.DATE_FROM, DATE_TO)
+    return sum(len(doc['items']) for doc in docs), reporter.client
+
+
+def prepare_writeoff_export(server, size):
+    docs = list(synthetic.writeoff_docs(max(1, size // synthetic.ITEMS_PER_DOC)))
+    return docs, _writeoff_reporter(server.url)
+
+
+def run_writeoff_export(state):
+    docs, reporter = state
+    writer = ExcelReportWriter()
+    writer.add_writeoff_sheet("Бенчмарк", docs, reporter)
+    _save(writer)
+    return sum(len(doc['items']) for doc in docs), None
+
+
+BENCHMARKS = {
+    'plans_fetch': (prepare_plans_fetch, run_plans_fetch),
+    'plans_fetch_olap': (prepare_plans_fetch_olap, run_plans_fetch),
+    'plans_columns': (prepare_plans_columns, run_plans_columns),
+    'plans_export': (prepare_plans_export, run_plans_export),
+    'revenue_fetch': (prepare_revenue_fetch, run_revenue_fetch),
+    'revenue_fetch_olap': (prepare_revenue_fetch_olap, run_revenue_fetch),
+    'revenue_export': (prepare_revenue_export, run_revenue_export),
+    'writeoff_fetch': (prepare_writeoff_fetch, run_writeoff_fetch),
+    'writeoff_export': (prepare_writeoff_export, run_writeoff_export),
+}
+
+
+def measure(server, name, size, trace_memory):
+    """Один прогон бенчмарка: время, строки, ожидание сервера и (по флагу) пик памяти"""
+    prepare, run = BENCHMARKS[name]
+    state = prepare(server, size)
+    gc.collect()
+    client = None
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        rows, client = run(state)
+        seconds = time.perf_counter() - started
+        # Ожидание сервера - время до заголовков ответов, накопленное клиентом за этот прогон
+        latency = client.request_seconds if client is not None else None
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        # Счетчик общего клиента пула обнуляется, чтобы следующий прогон считался с нуля
+        if client is not None:
+            client.request_seconds = 0.0
+    return {'seconds': seconds, 'rows': rows, 'latency': latency, 'peak_memory': peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, action='append', help="Количество строк (можно указать несколько раз)")
+    parser.add_argument('--only', action='append', choices=list(BENCHMARKS), help="Запустить только эти бенчмарки")
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка ответа mock-сервера, секунды")
+    parser.add_argument('--no-memory', action='store_true', help="Не делать прогон с замером памяти")
+    parser.add_argument('--json', help="Сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+
+    # Тяжелые модули импортируются заранее, чтобы их импорт не попал в замер первого бенчмарка
+    load_numpy()
+    load_excel_modules()
+    server = MockIikoServer(latency=args.latency).start()
+    results = []
+    print(f"{'Бенчмарк':<18} {'Строк':>9} {'Время, с':>9} {'Строк/с':>11} {'Сервер, с':>9} {'Память, МБ':>10}")
+    try:
+        for size in args.rows or [1000, 100000, 1000000]:
+            for name in args.only or list(BENCHMARKS):
+                result = measure(server, name, size, trace_memory=False)
+                if not args.no_memory:
+                    result['peak_memory'] = measure(server, name, size, trace_memory=True)['peak_memory']
+                result.update(benchmark=name, size=size)
+                results.append(result)
+                latency = "" if result['latency'] is None else f"{result['latency']:.3f}"
+                memory = "" if result['peak_memory'] is None else f"{result['peak_memory'] / 1024 / 1024:.1f}"
+                print(
+                    f"{name:<18} {result['rows']:>9} {result['seconds']:>9.3f} "
+                    f"{result['rows'] / max(result['seconds'], 1e-9):>11.0f} {latency:>9} {memory:>10}",
+                    flush=True
+                )
+    finally:
+        CLIENT_POOL.logout_all()
+        server.stop()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({'created_at': datetime.now().isoformat(timespec='seconds'), 'results': results}, f,
+                      ensure_ascii=False, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""Локальная замена REST API iiko для бенчмарков и ручной проверки без боевых серверов.
+
+Обслуживает /auth, /logout, /v2/reports/olap/byPresetId/{id}, POST /v2/reports/olap,
+/v2/entities/* и /v2/documents/writeoff. Ответы генерируются модулем synthetic и передаются
+порциями (chunked), поэтому размер ответа ограничен только параметрами, а не памятью сервера.
+Пресеты с идентификатором, начинающимся с "revenue", отдают строки "Выручка динамика",
+остальные - строки "Планы". Отчет OLAP v2 сворачивает те же строки по полям groupByRowFields
+(с DishCategory - строки выручки, без нее - строки "Планы").
+
+Запуск отдельным процессом (адрес печатается при старте):
+    python benchmarks/mock_iiko_server.py --rows 100000 --docs 2000 --latency 0.3
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+
+# Строк JSON в одной порции ответа
+ROWS_PER_CHUNK = 2000
+
+
+class MockIikoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def _send_text(self, status, text, content_type="text/plain; charset=utf-8"):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        if data:
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+
+    def _send_json_array(self, items, key=None):
+        """Отдает массив (или объект {key: массив}) порциями по ROWS_PER_CHUNK элементов"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self._write_chunk((f'{{"{key}":[' if key else "[").encode("utf-8"))
+        batch = []
+        first = True
+        for item in items:
+            batch.append(json.dumps(item, ensure_ascii=False))
+            if len(batch) >= ROWS_PER_CHUNK:
+                self._write_chunk((("" if first else ",") + ",".join(batch)).encode("utf-8"))
+                first = False
+                batch = []
+        if batch:
+            self._write_chunk((("" if first else ",") + ",".join(batch)).encode("utf-8"))
+        self._write_chunk(b"]}" if key else b"]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        path = urlsplit(self.path).path
+        self.server.count("POST " + path)
+        self._delay()
+        if path.endswith("/auth"):
+            return self._send_text(200, f"mock-token-{self.server.count('token')}")
+        if path.endswith("/v2/reports/olap"):
+            try:
+                request = json.loads(body)
+                group_fields = request['groupByRowFields']
+                aggregate_fields = request['aggregateFields']
+            except (ValueError, KeyError, TypeError):
+                return self._send_text(400, "bad report request")
+            rows = self.server.aggregate(group_fields, aggregate_fields)
+            return self._send_json_array(rows, "data")
+        self._send_text(404, "not found")
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path
+        query = parse_qs(url.query)
+        # Запросы пресетов считаются вместе, без идентификатора пресета
+        self.server.count("GET " + (path.rsplit("/", 1)[0] if "/byPresetId/" in path else path))
+        self._delay()
+        if path.endswith("/logout"):
+            return self._send_text(200, "")
+        if "/v2/reports/olap/byPresetId/" in path:
+            preset_id = path.rsplit("/", 1)[-1]
+            if preset_id.startswith("revenue"):
+                rows = synthetic.revenue_rows(self.server.rows)
+            else:
+                rows = synthetic.plan_rows(self.server.rows)
+            return self._send_json_array(rows, "data")
+        if path.endswith("/v2/entities/list"):
+            root_type = query.get("rootType", [""])[0]
+            return self._send_json_array(synthetic.conceptions() if root_type == "Conception" else synthetic.stores())
+        if path.endswith("/v2/entities/accounts/list"):
+            return self._send_json_array(synthetic.accounts())
+        if path.endswith("/v2/entities/products/list"):
+            return self._send_json_array(synthetic.products(query.get("ids")))
+        if path.endswith("/v2/documents/writeoff"):
+            # Акты отбираются по дате, как на сервере iiko: dateFrom и dateTo включительно
+            date_from = query.get("dateFrom", [""])[0]
+            date_to = query.get("dateTo", ["9999"])[0]
+            docs = (
+                doc for doc in synthetic.writeoff_docs(self.server.docs)
+                if date_from <= doc['dateIncoming'][:10] <= date_to
+            )
+            return self._send_json_array(docs, "response")
+        self._send_text(404, "not found")
+
+
+class MockIikoServer(ThreadingHTTPServer):
+    """Mock-сервер iiko в фоновом потоке.
+
+    rows - строк в ответе OLAP-пресета, docs - актов списания в ответе,
+    latency - задержка перед ответом на каждый запрос (секунды).
+    Параметры можно менять между запросами.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, rows=1000, docs=100, latency=0.0, host="127.0.0.1", port=0):
+        super().__init__((host, port), MockIikoHandler)
+        self.rows = rows
+        self.docs = docs
+        self.latency = latency
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/resto/api"
+
+    def count(self, name):
+        """Увеличивает счетчик запросов name и возвращает новое значение"""
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            return self.requests[name]
+
+    def aggregate(self, group_fields, aggregate_fields):
+        """Свертка синтетических строк на "сервере": суммы aggregate_fields по group_fields"""
+        if "DishCategory" in group_fields:
+            rows = synthetic.revenue_rows(self.rows)
+        else:
+            rows = synthetic.plan_rows(self.rows)
+        totals = {}
+        for row in rows:
+            key = tuple(row.get(field) for field in group_fields)
+            sums = totals.get(key)
+            if sums is None:
+                sums = totals[key] = [0] * len(aggregate_fields)
+            for index, field in enumerate(aggregate_fields):
+                sums[index] += row.get(field) or 0
+        for key, sums in totals.items():
+            item = dict(zip(group_fields, key))
+            item.update(zip(aggregate_fields, sums))
+            yield item
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="mock-iiko", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--rows", type=int, default=1000, help="Строк в ответе OLAP-пресета")
+    parser.add_argument("--docs", type=int, default=100, help="Актов списания в ответе")
+    parser.add_argument("--latency", type=float, default=0.0, help="Задержка ответа, секунды")
+    args = parser.parse_args()
+
+    server = MockIikoServer(args.rows, args.docs, args.latency, args.host, args.port)
+    print(f"Mock iiko: {server.url}")
+    print(json.dumps(
+        {"Mock": {"url": server.url, "preset_id": "plans", "revenue_preset_id": "revenue"}},
+        ensure_ascii=False
+    ))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
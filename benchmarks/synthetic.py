@@ -0,0 +1,109 @@
+"""Синтетические данные iiko для бенчмарков: строки OLAP-пресетов, справочники и акты списания.
+
+Поля совпадают с ответами iiko (RestorauntGroup, DayOfWeekOpen, DishCategory, items, ...).
+Генераторы детерминированы (seed) и выдают данные по одной записи, поэтому mock-сервер
+отдает большие ответы, не собирая их в памяти целиком.
+"""
+import random
+from datetime import datetime, timedelta
+
+# Начало периода синтетических данных
+DATE_FROM = datetime(2024, 9, 1)
+
+DAY_NAMES = ("Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье")
+
+# Размеры справочников
+GROUPS = 40
+CATEGORIES = 60
+STORES = 20
+ACCOUNTS = 30
+CONCEPTIONS = 5
+PRODUCTS = 2000
+
+# Позиций в одном акте списания
+ITEMS_PER_DOC = 5
+
+
+def _day(index, days):
+    return DATE_FROM + timedelta(days=index % days)
+
+
+def plan_rows(count, days=30, seed=1):
+    """Строки пресета "Планы": заведение, неделя месяца, день недели и показатели"""
+    rnd = random.Random(seed)
+    for index in range(count):
+        day = _day(index, days)
+        yield {
+            'RestorauntGroup': f"Заведение {rnd.randrange(GROUPS)}",
+            'WeekInMonthOpen': str((day.day - 1) // 7 + 1),
+            'DayOfWeekOpen': f"{day.weekday() + 1}. {DAY_NAMES[day.weekday()]}",
+            'OpenDate.Typed': day.strftime('%Y-%m-%dT00:00:00'),
+            'DishDiscountSumInt': round(rnd.uniform(100, 50000), 2),
+            'GuestNum': rnd.randint(1, 300),
+            'DishAmountInt': rnd.randint(1, 900),
+            'UniqOrderId': rnd.randint(1, 200),
+        }
+
+
+def revenue_rows(count, seed=2):
+    """Строки пресета "Выручка динамика": заведение, категория блюд и сумма со скидкой"""
+    rnd = random.Random(seed)
+    for index in range(count):
+        yield {
+            'RestorauntGroup': f"Заведение {rnd.randrange(GROUPS)}",
+            'DishCategory': f"Категория {rnd.randrange(CATEGORIES)}",
+            'DishGroup': "Группа блюд",
+            'Mounth': f"{DATE_FROM.month:02d}. Сентябрь",
+            'DishDiscountSumInt': round(rnd.uniform(0, 5000), 2),
+        }
+
+
+def stores():
+    """Склады (/v2/entities/list?rootType=Account)"""
+    for index in range(STORES):
+        yield {'id': f"store-{index}", 'name': f"Склад {index}", 'type': "INVENTORY_ASSETS", 'rootType': "Account"}
+
+
+def conceptions():
+    """Концепции (/v2/entities/list?rootType=Conception)"""
+    for index in range(CONCEPTIONS):
+        yield {'id': f"conception-{index}", 'name': f"Концепция {index}", 'rootType': "Conception"}
+
+
+def accounts():
+    """Счета (/v2/entities/accounts/list)"""
+    for index in range(ACCOUNTS):
+        yield {'id': f"account-{index}", 'name': f"Счет списания {index}"}
+
+
+def products(ids=None):
+    """Товары (/v2/entities/products/list); ids - только перечисленные товары"""
+    if ids is not None:
+        wanted = set(ids)
+        return ({'id': product_id, 'name': f"Товар {product_id}"} for product_id in sorted(wanted))
+    return ({'id': f"product-{index}", 'name': f"Товар product-{index}"} for index in range(PRODUCTS))
+
+
+def writeoff_docs(count, days=30, seed=3):
+    """Акты списания (/v2/documents/writeoff) по ITEMS_PER_DOC позиций"""
+    rnd = random.Random(seed)
+    for index in range(count):
+        day = _day(index, days)
+        yield {
+            'id': f"doc-{index}",
+            'dateIncoming': (day + timedelta(minutes=index % 1440)).strftime('%Y-%m-%dT%H:%M:%S.000'),
+            'documentNumber': str(100000 + index),
+            'status': rnd.choice(("PROCESSED", "PROCESSED", "NEW")),
+            'storeId': f"store-{rnd.randrange(STORES)}",
+            'accountId': f"account-{rnd.randrange(ACCOUNTS)}",
+            'conceptionId': f"conception-{rnd.randrange(CONCEPTIONS)}",
+            'comment': "Списание",
+            'items': [
+                {
+                    'productId': f"product-{rnd.randrange(PRODUCTS)}",
+                    'amount': rnd.randint(1, 20),
+                    'cost': round(rnd.uniform(10, 3000), 2),
+                }
+                for _ in range(ITEMS_PER_DOC)
+            ],
+        }
@@ -0,0 +1,176 @@
+"""Тесты авторизации: общий кэш токенов IikoClient и предварительная авторизация кнопкой "Авторизация"."""
+import time
+
+import pytest
+
+import IIKO_Report
+from IIKO_Report import TOKEN_TTL_SECONDS, BatchJobContext, IikoClient, IikoClientPool
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b""):
+        self.status_code = status_code
+        self.content = body
+        self.text = body.decode("utf-8")
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        yield self.content
+
+    def close(self):
+        pass
+
+
+class FakeIikoServer:
+    """Сессия с сервером iiko в памяти: /auth выдает новый токен, запросы данных проверяют ключ"""
+
+    def __init__(self, password="secret", reject_status=401):
+        self.password_hash = IIKO_Report.hashlib.sha1(password.encode()).hexdigest()
+        self.reject_status = reject_status
+        self.valid_token = None
+        self.auth_calls = 0
+        self.data_calls = 0
+
+    def post(self, url, data=None, **kwargs):
+        self.auth_calls += 1
+        if data['pass'] != self.password_hash:
+            return FakeResponse(401, b"Wrong password")
+        self.valid_token = f"token-{self.auth_calls}"
+        return FakeResponse(200, self.valid_token.encode())
+
+    def get(self, url, params=None, **kwargs):
+        self.data_calls += 1
+        if params['key'] != self.valid_token:
+            return FakeResponse(self.reject_status)
+        return FakeResponse(200, b'{"data":[{"a":1}]}')
+
+    def close(self):
+        pass
+
+
+def test_client_reuses_token_within_ttl():
+    server = FakeIikoServer()
+    client = IikoClient("http://iiko/resto/api", "user", "secret", server)
+    assert client.auth() and client.auth()
+    assert server.auth_calls == 1
+    # Токен устарел (дольше TOKEN_TTL_SECONDS без обращений) - выполняется новая авторизация
+    client.token_time = time.monotonic() - TOKEN_TTL_SECONDS - 1
+    assert client.auth()
+    assert (server.auth_calls, client.token) == (2, "token-2")
+    assert client.auth(force=True) and server.auth_calls == 3
+
+
+def test_client_wrong_password():
+    server = FakeIikoServer()
+    client = IikoClient("http://iiko/resto/api", "user", "wrong", server)
+    assert not client.auth()
+    assert client.token is None and not client.has_valid_token()
+
+
+@pytest.mark.parametrize("status", [401, 403])
+def test_stream_json_reauthenticates_rejected_token(status):
+    server = FakeIikoServer(reject_status=status)
+    client = IikoClient("http://iiko/resto/api", "user", "secret", server)
+    assert client.auth()
+    # Сервер отозвал ключ: запрос отклоняется, клиент авторизуется заново и повторяет его
+    server.valid_token = "revoked"
+    assert list(client.stream_json("/v2/reports/olap", key='data')) == [{'a': 1}]
+    assert (server.auth_calls, server.data_calls, client.token) == (2, 2, "token-2")
+
+
+def test_stream_json_gives_up_after_second_rejection():
+    server = FakeIikoServer()
+    server.post = lambda url, data=None, **kwargs: FakeResponse(200, b"never-valid")
+    client = IikoClient("http://iiko/resto/api", "user", "secret", server)
+    assert client.stream_json("/v2/reports/olap", key='data') is None
+    assert server.data_calls == 2
+
+
+def test_logout_without_requests_module(monkeypatch):
+    # В режиме --replay модуль requests не загружен: ошибка выхода только записывается в лог
+    monkeypatch.setattr(IIKO_Report, "requests", None)
+    server = FakeIikoServer()
+    client = IikoClient("http://iiko/resto/api", "user", "secret", server)
+    assert client.auth()
+
+    def fail(url, params=None, **kwargs):
+        raise OSError("connection reset")
+    server.get = fail
+    client.logout()
+    assert client.token is None
+
+
+class FakeWidget:
+    def __init__(self):
+        self.options = {}
+
+    def config(self, **options):
+        self.options.update(options)
+
+
+class FakeVar:
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def make_gui(pool, servers, password="secret"):
+    """Окно без Tk: виджеты заменены заглушками, задание выполняется сразу в текущем потоке"""
+    gui = object.__new__(IIKO_Report.IikoOlapReporterGUI)
+    gui.available_bases = {}
+    for index, (name, server) in enumerate(servers.items()):
+        gui.available_bases[name] = {"url": f"http://base{index}.iiko.it/resto/api"}
+        pool.servers[f"base{index}.iiko.it"] = server
+    gui.jobs = BatchJobContext()
+    gui.start_jitter = 0
+    gui.host_limiter = None
+    gui.logs = []
+    gui.log_message = gui.logs.append
+    gui.login_entry = FakeVar("user")
+    gui.password_entry = FakeVar(password)
+    gui.max_workers_var = FakeVar("4")
+    gui.base_checkbuttons = {name: FakeWidget() for name in servers}
+    gui.report_button, gui.revenue_button, gui.writeoff_button = FakeWidget(), FakeWidget(), FakeWidget()
+    gui.start_job = lambda job_name, target, on_done=None, total=0: on_done("done", target())
+    return gui
+
+
+@pytest.fixture
+def client_pool(monkeypatch):
+    """Общий пул подключений, сессии которого - серверы iiko в памяти (по хосту базы)"""
+    IIKO_Report.load_gui_modules()
+    pool = IikoClientPool()
+    pool.servers = {}
+    pool._session_for = lambda base_url: pool.servers[IIKO_Report.urlsplit(base_url).netloc]
+    monkeypatch.setattr(IIKO_Report, "CLIENT_POOL", pool)
+    return pool
+
+
+def test_auth_button_preauthorizes_all_bases(client_pool):
+    servers = {"Анапа": FakeIikoServer(), "Курск": FakeIikoServer(), "Сочи": FakeIikoServer(password="other")}
+    gui = make_gui(client_pool, servers)
+    gui.auth()
+
+    assert [server.auth_calls for server in servers.values()] == [1, 1, 1]
+    texts = {name: widget.options["text"] for name, widget in gui.base_checkbuttons.items()}
+    assert "✅" in texts["Анапа"] and "✅" in texts["Курск"] and "❌" in texts["Сочи"]
+    assert gui.report_button.options["state"] == IIKO_Report.tk.NORMAL
+    assert "✅ Авторизация успешна: 2 из 3 баз" in gui.logs
+
+    # Отчет после авторизации берет токен из общего пула без повторного запроса /auth
+    client = IIKO_Report.CLIENT_POOL.get(gui.available_bases["Анапа"]["url"], "user", "secret")
+    assert client.auth() and list(client.stream_json("/v2/reports/olap", key='data')) == [{'a': 1}]
+    assert servers["Анапа"].auth_calls == 1
+
+    # Повторное нажатие не авторизуется заново в базах с действующим токеном
+    gui.auth()
+    assert [server.auth_calls for server in servers.values()] == [1, 1, 2]
+    assert any("Курск: авторизация успешна (токен из кэша)" in message for message in gui.logs)
+
+
+def test_auth_button_all_bases_fail(client_pool):
+    gui = make_gui(client_pool, {"Анапа": FakeIikoServer()}, password="wrong")
+    gui.auth()
+    assert "state" not in gui.report_button.options
+    assert "❌ Не удалось авторизоваться ни в одной базе" in gui.logs
@@ -0,0 +1,215 @@
+"""Тесты чистых вспомогательных функций и классов IIKO_Report (без сети и окна)."""
+import gzip
+import json
+from datetime import datetime
+
+import openpyxl
+import pytest
+
+from IIKO_Report import (
+    CASSETTE_TOKEN, ExcelReportWriter, HttpCassette, JsonArrayStream, OlapColumns, cache_windows,
+    merge_olap_rows, split_date_range,
+)
+
+
+def _chunks(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+JSON_DOCUMENTS = [
+    (b'{"data":[1.5]}', "data"),
+    (b'[1.5e+10, -2, 3E-2, 0, true, null, "x", {"a": [1.25]}, 12345678901234567890]', None),
+    ('{"k": 1, "data": [{"Имя": "Ж", "v": -0.5}, 7.0e1], "tail": [2]}'.encode("utf-8"), "data"),
+]
+
+
+@pytest.mark.parametrize("document, key", JSON_DOCUMENTS)
+def test_json_array_stream_split_at_every_byte(document, key):
+    expected = json.loads(document)[key] if key else json.loads(document)
+    for cut in range(len(document) + 1):
+        assert list(JsonArrayStream([document[:cut], document[cut:]], key)) == expected
+
+
+@pytest.mark.parametrize("document, key", JSON_DOCUMENTS)
+def test_json_array_stream_small_chunks(document, key):
+    expected = json.loads(document)[key] if key else json.loads(document)
+    for size in (1, 2, 3, 7):
+        assert list(JsonArrayStream(_chunks(document, size), key)) == expected
+
+
+def test_json_array_stream_missing_key():
+    assert list(JsonArrayStream([b'{"other": [1]}'], "data")) == []
+
+
+def test_json_array_stream_truncated():
+    with pytest.raises(ValueError):
+        list(JsonArrayStream([b'[1, 2'], None))
+
+
+@pytest.mark.parametrize("mode, expected", [
+    (None, [("2024-03-06", "2024-03-20")]),
+    ("day", [("2024-03-06", "2024-03-06"), ("2024-03-07", "2024-03-07")]),
+    ("week", [("2024-03-06", "2024-03-10"), ("2024-03-11", "2024-03-17"), ("2024-03-18", "2024-03-20")]),
+    ("month", [("2024-03-06", "2024-03-20")]),
+])
+def test_split_date_range(mode, expected):
+    date_to = datetime(2024, 3, 7) if mode == "day" else datetime(2024, 3, 20)
+    windows = split_date_range(datetime(2024, 3, 6), date_to, mode)
+    assert [(start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")) for start, end in windows] == expected
+
+
+def test_split_date_range_months_cover_period():
+    windows = split_date_range(datetime(2024, 1, 15), datetime(2024, 4, 10), "month")
+    assert [(start.day, end.day) for start, end in windows] == [(15, 31), (1, 29), (1, 31), (1, 10)]
+
+
+def test_cache_windows_long_period_uses_whole_months():
+    windows = cache_windows(datetime(2024, 1, 1), datetime(2024, 12, 31))
+    assert len(windows) == 12
+    windows = cache_windows(datetime(2024, 1, 1), datetime(2024, 12, 31), refresh_from=datetime(2024, 12, 30))
+    # Декабрь до дней перепроверки - по дням, последние два дня - отдельными окнами
+    assert len(windows) == 11 + 31
+    assert windows[-1] == (datetime(2024, 12, 31), datetime(2024, 12, 31))
+
+
+def test_cache_windows_short_period_by_days():
+    assert len(cache_windows(datetime(2024, 3, 1), datetime(2024, 3, 31))) == 31
+
+
+def test_merge_olap_rows_sums_equal_dimensions():
+    chunks = [
+        [{'RestorauntGroup': "А", 'WeekInMonthOpen': 1, 'DishDiscountSumInt': 10, 'GuestNum': 2}],
+        [
+            {'RestorauntGroup': "А", 'WeekInMonthOpen': "1", 'DishDiscountSumInt': 5.5, 'GuestNum': None},
+            {'RestorauntGroup': "Б", 'WeekInMonthOpen': 1, 'DishDiscountSumInt': "3", 'GuestNum': 1},
+            "не строка",
+        ],
+    ]
+    merged = merge_olap_rows(chunks)
+    assert merged == [
+        {'RestorauntGroup': "А", 'WeekInMonthOpen': 1, 'DishDiscountSumInt': 15.5, 'GuestNum': 2},
+        {'RestorauntGroup': "Б", 'WeekInMonthOpen': 1, 'DishDiscountSumInt': "3", 'GuestNum': 1},
+    ]
+    # Исходные строки не изменяются
+    assert chunks[0][0]['DishDiscountSumInt'] == 10
+
+
+def test_merge_olap_rows_string_measures():
+    merged = merge_olap_rows([[{'g': 1, 'DishDiscountSumInt': "1.5"}], [{'g': 1, 'DishDiscountSumInt': "2"}]])
+    assert merged == [{'g': 1, 'DishDiscountSumInt': 3.5}]
+
+
+PLAN_RECORDS = [
+    {'RestorauntGroup': "Кафе", 'WeekInMonthOpen': 1, 'DayOfWeekOpen': "2. Вторник",
+     'DishDiscountSumInt': 50, 'GuestNum': 5, 'DishAmountInt': 7, 'UniqOrderId': 3},
+    {'RestorauntGroup': "Бар", 'WeekInMonthOpen': "1", 'DayOfWeekOpen': "3. Среда",
+     'DishDiscountSumInt': 1, 'GuestNum': 1, 'DishAmountInt': 1, 'UniqOrderId': 1},
+    {'RestorauntGroup': "Кафе", 'WeekInMonthOpen': 2, 'DayOfWeekOpen': "1. Понедельник",
+     'DishDiscountSumInt': 30.5, 'GuestNum': None, 'DishAmountInt': 2},
+    {'RestorauntGroup': "Кафе", 'WeekInMonthOpen': 1, 'DayOfWeekOpen': "1. Понедельник",
+     'DishDiscountSumInt': 100, 'GuestNum': 10, 'DishAmountInt': 12, 'UniqOrderId': 4},
+]
+
+
+def test_olap_columns_from_records():
+    columns = OlapColumns.from_records(PLAN_RECORDS + [None])
+    assert len(columns) == 4
+    assert columns.group_values == ["Бар", "Кафе"]
+    order = columns.plan_sort_order()
+    assert [columns.day_label(index) for index in order] == [
+        "3. Среда", "1. Понедельник", "2. Вторник", "1. Понедельник"
+    ]
+    # Пустой показатель - пустая ячейка, отсутствующий - ноль
+    assert columns.measure('GuestNum', 2) is None
+    assert columns.measure('UniqOrderId', 2) == 0
+    assert columns.measure('DishDiscountSumInt', 2) == 30.5
+    assert isinstance(columns.measure('DishDiscountSumInt', 0), int)
+    groups = list(columns.iter_plan_groups())
+    assert [(group, [week for week, _ in weeks]) for group, weeks in groups] == [("Бар", [1]), ("Кафе", [1, 2])]
+
+
+# Столбец D итогов группы "Кафе" (строки 10-16): неделя 1 - строка 13, вся группа - строка 16
+@pytest.mark.parametrize("totals_mode, week_total, group_total", [
+    ("sum", "=SUM(D11:D12)", "=SUM(D10,D11,D12,D14)"),
+    ("subtotal", "=SUBTOTAL(9,D11:D12)", "=SUBTOTAL(9,D10:D15)"),
+    ("values", 150, 180.5),
+])
+def test_plans_sheet_totals_modes(tmp_path, totals_mode, week_total, group_total):
+    writer = ExcelReportWriter(totals_mode)
+    days = writer.add_plans_sheet(
+        "База", OlapColumns.from_records(PLAN_RECORDS), datetime(2024, 3, 1), datetime(2024, 3, 31)
+    )
+    assert days == 4
+    path = tmp_path / "plans.xlsx"
+    writer.save(str(path))
+    ws = openpyxl.load_workbook(path)["База"]
+    rows = [list(row) for row in ws.iter_rows(min_row=6, max_col=4, values_only=True)]
+    assert [row[0] or row[1] for row in rows] == [
+        "Бар", 1, "1 всего", "Бар всего", "Кафе", 1, 1, "1 всего", 2, "2 всего", "Кафе всего"
+    ]
+    assert ws["D13"].value == week_total
+    assert ws["D16"].value == group_total
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = body
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for start in range(0, len(self.content), 4):
+            yield self.content[start:start + 4]
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Сервер iiko в памяти: /auth выдает токен, остальные запросы - тело по адресу"""
+
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.calls = 0
+
+    def get(self, url, params=None, **kwargs):
+        self.calls += 1
+        return FakeResponse(200, self.bodies[url])
+
+    def post(self, url, params=None, **kwargs):
+        self.calls += 1
+        return FakeResponse(200, b"secret-token")
+
+    def close(self):
+        pass
+
+
+def test_http_cassette_record_and_replay(tmp_path):
+    path = str(tmp_path / "session.cassette")
+    url = "http://iiko/resto/api/v2/reports/olap/byPresetId/p"
+    server = FakeSession({url: b'{"data":[{"a":1},{"a":2}]}'})
+    recording = HttpCassette(path, mode="record").wrap(server)
+    assert recording.post("http://iiko/resto/api/auth", data={'login': "u", 'pass': "hash"}).content == b"secret-token"
+    response = recording.get(url, params={'key': "secret-token", 'dateFrom': "2024-03-01"}, stream=True)
+    assert b"".join(response.iter_content(64)) == b'{"data":[{"a":1},{"a":2}]}'
+    response.close()
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        text = f.read()
+    assert "secret-token" not in text and "hash" not in text
+
+    cassette = HttpCassette(path)
+    replay = cassette.wrap(None)
+    assert replay.post("http://iiko/resto/api/auth", data={'login': "u", 'pass': "hash"}).content == CASSETTE_TOKEN.encode()
+    # Ключ авторизации не входит в сопоставление запросов
+    response = replay.get(url, params={'key': CASSETTE_TOKEN, 'dateFrom': "2024-03-01"}, stream=True)
+    chunks = list(response.iter_content(64))
+    assert [len(chunk) for chunk in chunks] == [4] * 6 + [2]
+    assert list(JsonArrayStream(chunks, 'data')) == [{'a': 1}, {'a': 2}]
+    assert replay.get(url, params={'dateFrom': "2024-04-01"}).status_code == 404
+    assert (cassette.recorded, cassette.missed) == (2, 1)
+    assert server.calls == 2
+
+
+def test_http_cassette_rejects_unknown_mode(tmp_path):
+    with pytest.raises(ValueError):
+        HttpCassette(str(tmp_path / "x.cassette"), mode="rewind")
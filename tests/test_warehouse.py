@@ -0,0 +1,78 @@
+"""Тесты сводок по локальному хранилищу: команда warehouse (выручка баз, итоги планов, сравнение периодов)."""
+from datetime import datetime
+
+import pytest
+
+import IIKO_Report
+from IIKO_Report import ReportWarehouse, main
+
+SEPTEMBER = (datetime(2024, 9, 1), datetime(2024, 9, 30))
+AUGUST = (datetime(2024, 8, 1), datetime(2024, 8, 31))
+
+
+def revenue_row(group, category, amount):
+    return {'RestorauntGroup': group, 'DishCategory': category, 'DishGroup': 'Кухня',
+            'Mounth': '09', 'DishDiscountSumInt': amount}
+
+
+def plan_row(group, dish_sum, guests):
+    return {'RestorauntGroup': group, 'WeekInMonthOpen': '1', 'DayOfWeekOpen': '1. Понедельник',
+            'DishDiscountSumInt': dish_sum, 'GuestNum': guests, 'DishAmountInt': 10, 'UniqOrderId': 5}
+
+
+@pytest.fixture
+def warehouse(tmp_path, monkeypatch):
+    warehouse = ReportWarehouse(str(tmp_path / "warehouse.sqlite3"))
+    monkeypatch.setattr(IIKO_Report, "WAREHOUSE", warehouse)
+    url = "http://iiko/resto/api"
+    warehouse.save_rows('revenue', "Анапа", url, "preset", *SEPTEMBER,
+                        [revenue_row("Бар", "Напитки", 100), revenue_row("Зал", "Горячее", 250.5)])
+    warehouse.save_rows('revenue', "Курск", url, "preset", *SEPTEMBER, [revenue_row("Бар", "Напитки", 40)])
+    warehouse.save_rows('plans', "Анапа", url, "preset", *SEPTEMBER, [plan_row("Зал", 1000, 30)])
+    warehouse.save_rows('plans', "Анапа", url, "preset", *AUGUST, [plan_row("Зал", 800, 20)])
+    warehouse.save_rows('plans', "Курск", url, "preset", *SEPTEMBER, [plan_row("Зал", 500, 10)])
+    return warehouse
+
+
+def table(output):
+    return [line.split('\t') for line in output.strip().splitlines()]
+
+
+def test_revenue_rollup_of_several_bases(warehouse, capsys):
+    assert main(["warehouse", "revenue", "--from", "01.09.2024", "--to", "30.09.2024"]) == 0
+    assert table(capsys.readouterr().out) == [
+        ["Группа", "Категория", "Выручка"],
+        ["Бар", "Напитки", "140"],
+        ["Зал", "Горячее", "250.50"],
+    ]
+    assert main(["warehouse", "revenue", "--from", "01.09.2024", "--to", "30.09.2024", "--bases", "Курск"]) == 0
+    assert table(capsys.readouterr().out)[1:] == [["Бар", "Напитки", "40"]]
+
+
+def test_rollup_uses_latest_source_of_period(warehouse, capsys):
+    # Повторная загрузка периода отчетом OLAP v2 заменяет в сводке строки пресета, а не добавляется к ним
+    warehouse.save_rows('revenue', "Курск", "http://iiko/resto/api", "olap-v2", *SEPTEMBER,
+                        [revenue_row("Бар", "Напитки", 60)])
+    warehouse._connect().execute("UPDATE loads SET loaded_at = '2099-01-01T00:00:00' WHERE preset_id = 'olap-v2'")
+    assert main(["warehouse", "revenue", "--from", "01.09.2024", "--to", "30.09.2024"]) == 0
+    assert table(capsys.readouterr().out)[1] == ["Бар", "Напитки", "160"]
+
+
+def test_plan_totals_period_comparison(warehouse, capsys):
+    assert main(["warehouse", "plans", "--from", "01.09.2024", "--to", "30.09.2024",
+                 "--compare-from", "01.08.2024", "--compare-to", "31.08.2024"]) == 0
+    rows = table(capsys.readouterr().out)
+    assert rows[0][:5] == ["База", "Группа", "Выручка", "Выручка (сравнение)", "Выручка Δ%"]
+    assert rows[1][:8] == ["Анапа", "Зал", "1000", "800", "+25.0", "30", "20", "+50.0"]
+    # В периоде сравнения базы нет - изменение не считается
+    assert rows[2][:5] == ["Курск", "Зал", "500", "0", ""]
+
+
+def test_empty_period_and_loads(warehouse, capsys):
+    assert main(["warehouse", "plans", "--from", "01.01.2020", "--to", "31.01.2020"]) == 1
+    assert main(["warehouse", "loads", "--report", "plans", "--bases", "Анапа"]) == 0
+    rows = table(capsys.readouterr().out)
+    assert sorted(row[:4] for row in rows[1:]) == [
+        ["plans", "Анапа", "2024-08-01", "2024-08-31"],
+        ["plans", "Анапа", "2024-09-01", "2024-09-30"],
+    ]